@@ -30,12 +30,16 @@ setup(
         'numpy',
         'pandas',
         'psutil',
+        'pyarrow',
         'pygeos',
         'pyshp',
+        'shapely >= 2.0',
         'PyYAML',
         'rasterstats',
         'rasterio >= 1.1.0',
+        'scipy',
         'requests',
+        'zstandard',
         'nsaph_utils >= 0.0.5.2',
         'nsaph>=0.0.2.0',
         'git+https://github.com/NSAPH-Data-Platform/nsaph-gis@develop#egg=nsaph-gis',
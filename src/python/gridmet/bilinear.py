@@ -0,0 +1,135 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Vectorized bilinear interpolation of raster values for a collection
+of points. Neighbor cells and weights are computed once for all
+points, values for a block of days are then computed with
+fancy indexing and a weighted sum. Like `rasterstats` bilinear
+interpolation, used by `PointInRaster`, a point with some of the four
+neighbor cells masked gets the value of the nearest of them.
+"""
+
+from typing import Tuple
+
+import numpy
+from rasterio import Affine
+
+from gridmet.gridmet_tools import NO_DATA
+
+
+class BilinearInterpolator:
+    """
+    Bilinear interpolation between the centers of four raster cells
+    surrounding each point. Neighbors are ordered: upper left, upper
+    right, lower left, lower right
+    """
+
+    def __init__(self, affine: Affine, shape: Tuple[int, int],
+                 x: numpy.ndarray, y: numpy.ndarray):
+        """
+        :param affine: Affine transformation of the raster
+        :param shape: Shape of the raster (rows, columns)
+        :param x: Array of x coordinates (longitudes) of the points
+        :param y: Array of y coordinates (latitudes) of the points
+        """
+
+        # fractional indices relative to the cell centers
+        col = (numpy.asarray(x, dtype=numpy.float64) - affine.c) / affine.a \
+            - 0.5
+        row = (numpy.asarray(y, dtype=numpy.float64) - affine.f) / affine.e \
+            - 0.5
+        c0 = numpy.floor(col).astype(numpy.int64)
+        r0 = numpy.floor(row).astype(numpy.int64)
+        dx = col - c0
+        dy = row - r0
+
+        self.rows = numpy.stack([r0, r0, r0 + 1, r0 + 1])
+        self.cols = numpy.stack([c0, c0 + 1, c0, c0 + 1])
+        self.weights = numpy.stack([
+            (1 - dx) * (1 - dy),
+            dx * (1 - dy),
+            (1 - dx) * dy,
+            dx * dy
+        ])
+        # the nearest neighbor, rounding halves to even as rasterstats
+        self.nearest = (2 * numpy.rint(dy) + numpy.rint(dx))\
+            .astype(numpy.int64)
+        self.outside = (
+            (self.rows < 0) | (self.rows >= shape[0])
+            | (self.cols < 0) | (self.cols >= shape[1])
+        )
+        self.inside = ~self.outside.any(axis=0)
+        # indices outside the raster are replaced with 0, such
+        # neighbors are masked
+        self.rows[self.outside] = 0
+        self.cols[self.outside] = 0
+
+    def is_masked(self, layer) -> numpy.ndarray:
+        """
+        Checks which points can not be interpolated, because they
+        are outside of the raster or at least one of the four
+        neighbor cells does not contain data
+
+        :param layer: 2D layer
+        :return: boolean array, True for masked points
+        """
+
+        data = numpy.ma.getdata(layer)[self.rows, self.cols]
+        mask = numpy.ma.getmaskarray(layer)[self.rows, self.cols]
+        mask |= (data == NO_DATA) | self.outside
+        if numpy.issubdtype(data.dtype, numpy.floating):
+            mask |= numpy.isnan(data)
+        return mask.any(axis=0)
+
+    def interpolate(self, block) -> numpy.ndarray:
+        """
+        Interpolates values for all points. A neighbor cell is masked
+        on a day if it is masked, contains no data or NaN on that day,
+        or if it is outside of the raster. If any of the four neighbors
+        of a point is masked, the value of the nearest neighbor is
+        used instead, NaN if the nearest neighbor is masked as well
+
+        :param block: 3D block of layers (days x rows x columns)
+            or a single 2D layer
+        :return: Array of interpolated values with the shape
+            (points, days) for a 3D block or (points,) for a 2D layer
+        """
+
+        data = numpy.ma.getdata(block)
+        mask = numpy.ma.getmaskarray(block)
+        if data.ndim == 2:
+            data = data[numpy.newaxis, :, :]
+            mask = mask[numpy.newaxis, :, :]
+        # shape: days x 4 x points
+        raw = data[:, self.rows, self.cols]
+        values = raw.astype(numpy.float64)
+        masked = mask[:, self.rows, self.cols] | (raw == NO_DATA) \
+            | numpy.isnan(values) | self.outside
+        result = (values * self.weights).sum(axis=1)
+        partial = masked.any(axis=1)
+        if partial.any():
+            points = numpy.arange(values.shape[2])
+            nearest = values[:, self.nearest, points]
+            nearest[masked[:, self.nearest, points]] = numpy.nan
+            result[partial] = nearest[partial]
+        result = result.T
+        if numpy.ndim(block) == 2:
+            return result[:, 0]
+        return result
@@ -0,0 +1,673 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Collectors receive the results of computations row by row and
+store them, e.g. in a CSV or Parquet file or directly in a
+PostgreSQL table
+"""
+
+import csv
+import datetime
+import io
+import math
+import shutil
+import struct
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import List, Optional, Tuple, Callable, Union, Sequence
+
+import numpy
+import pyarrow
+import pyarrow.parquet
+
+from nsaph_utils.utils.io_utils import fopen
+
+from gridmet.compression import open_compressed, sync, is_compressed
+from gridmet.metrics import Metrics
+from gridmet.registry import Registry
+
+
+class Collector(ABC):
+    def __init__(self):
+        self.metrics: Optional[Metrics] = None
+        '''If set, time spent writing and bytes written are
+        accumulated in the metrics'''
+
+    @abstractmethod
+    def writerow(self, data: List):
+        pass
+
+    def write_columns(self, *columns: Union[numpy.ndarray, str, Sequence]):
+        """
+        Writes a block of rows given column by column, e.g. all
+        geographies for a single day. Each column is either a numpy
+        array of values (NaN means missing value), a string that is
+        the same for all rows (e.g., the date) or a sequence of
+        strings (e.g., labels of geographies).
+
+        :param columns: Columns, all arrays and sequences must have
+            the same length
+        """
+
+        n = None
+        for column in columns:
+            if not isinstance(column, str):
+                n = len(column)
+                break
+        data = []
+        for column in columns:
+            if isinstance(column, str):
+                data.append([column] * n)
+            elif isinstance(column, numpy.ndarray):
+                data.append([None if v != v else v for v in column.tolist()])
+            else:
+                data.append(column)
+        for row in zip(*data):
+            self.writerow(list(row))
+
+    def flush(self):
+        pass
+
+    def checkpoint(self) -> Optional[int]:
+        """
+        Writes all collected data to the file, so that the file can
+        be truncated at the returned offset and appended later
+
+        :return: Offset in the file or None if the collector does not
+            support checkpoints
+        """
+        return None
+
+    def append_file(self, path: str):
+        """
+        Appends all data rows (without header) from a file
+        written by a collector of the same type
+
+        :param path: path to the file
+        """
+        raise NotImplementedError()
+
+
+class CSVWriter(Collector):
+    def __init__(self, out_stream, precision: Optional[int] = None):
+        """
+        :param out_stream: Text stream to write into
+        :param precision: Optional number of decimal places to round
+            values written by `write_columns()`. By default, values are
+            written with all significant digits, the same way as
+            `writerow()` does
+        """
+
+        super().__init__()
+        self.out = out_stream
+        self.precision = precision
+        self.writer = csv.writer(out_stream,
+                                 delimiter=',',
+                                 quoting=csv.QUOTE_NONE)
+        self.terminator = self.writer.dialect.lineterminator
+        self.write_stage = "compress" if is_compressed(out_stream) \
+            else "flush"
+        '''Stage of metrics measuring writes into the stream'''
+
+    def writerow(self, row: List):
+        self.writer.writerow(row)
+
+    def format_values(self, values: numpy.ndarray) -> List[str]:
+        """
+        Converts values to strings, missing values (NaN) to
+        empty strings
+
+        :param values: 1D array of values
+        :return: list of strings
+        """
+
+        if self.precision is not None:
+            values = numpy.round(values, self.precision)
+        text = list(map(repr, values.tolist()))
+        for i in numpy.flatnonzero(numpy.isnan(values)).tolist():
+            text[i] = ""
+        return text
+
+    def write_columns(self, *columns: Union[numpy.ndarray, str, Sequence]):
+        """
+        Serializes a block of rows at once, the output is the same as
+        if every row was written with `writerow()`. Constant columns
+        are concatenated only once for the whole block.
+
+        :param columns: see `Collector.write_columns()`
+        """
+
+        t0 = time.perf_counter()
+        lines = None
+        pending = ""
+        for column in columns:
+            if isinstance(column, str):
+                pending += "," + column
+                continue
+            if isinstance(column, numpy.ndarray):
+                text = self.format_values(column)
+            elif len(column) > 0 and not isinstance(column[0], str):
+                text = [str(c) for c in column]
+            else:
+                text = column
+            if lines is None:
+                if pending:
+                    prefix = pending[1:] + ","
+                    lines = [prefix + t for t in text]
+                else:
+                    lines = text
+            else:
+                separator = pending + ","
+                lines = [l + separator + t for l, t in zip(lines, text)]
+            pending = ""
+        if not lines:
+            return
+        if pending:
+            lines = [l + pending for l in lines]
+        text = self.terminator.join(lines)
+        t1 = time.perf_counter()
+        self.out.write(text)
+        self.out.write(self.terminator)
+        if self.metrics is not None:
+            self.metrics.add("serialize", t1 - t0)
+            self.metrics.add(self.write_stage, time.perf_counter() - t1)
+            self.metrics.count("bytes", len(text) + len(self.terminator))
+
+    def flush(self):
+        self.out.flush()
+
+    def checkpoint(self) -> Optional[int]:
+        return sync(self.out)
+
+    def append_file(self, path: str):
+        with open(path, "rt", newline='') as part:
+            part.readline()
+            shutil.copyfileobj(part, self.out)
+
+
+class ListCollector(Collector):
+    def __init__(self):
+        super().__init__()
+        self.collection = []
+
+    def writerow(self, data: List):
+        self.collection.append(data)
+
+    def get_result(self):
+        return self.collection
+
+
+class ParquetWriter(Collector):
+    """
+    Writes results into a Parquet file with typed columns. Rows are
+    buffered and every call to `flush()` writes them as a row group,
+    i.e. there is a row group per day or per block of days. Blocks
+    written by `write_columns()` are buffered as Arrow arrays, without
+    converting values to Python objects.
+
+    Columns before "date" contain values (float32), "date" column is
+    stored as date32, the column following the date is the
+    label of the geography, stored as int32 if `numeric_ids` is True.
+    All other columns are stored as strings.
+    """
+
+    def __init__(self, path: str, columns: List[str],
+                 numeric_ids: bool = True):
+        """
+        :param path: Path to the resulting file
+        :param columns: Column names
+        :param numeric_ids: Whether labels of geographies are integers
+            (e.g., zip codes or county FIPS codes)
+        """
+
+        super().__init__()
+        self.path = path
+        self.columns = columns
+        date_idx = columns.index("date")
+        types = [pyarrow.float32()] * date_idx + [pyarrow.date32()]
+        for i in range(date_idx + 1, len(columns)):
+            if i == date_idx + 1 and numeric_ids:
+                types.append(pyarrow.int32())
+            else:
+                types.append(pyarrow.string())
+        self.schema = pyarrow.schema([
+            pyarrow.field(columns[i], types[i]) for i in range(len(columns))
+        ])
+        self.date_idx = date_idx
+        self.rows = []
+        self.batches: List[pyarrow.RecordBatch] = []
+        self.cache = dict()
+        '''Sequences (e.g., labels of geographies) converted by the
+        last call to `write_columns()`, by column index'''
+        self.sink = pyarrow.OSFile(path, "wb")
+        self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+
+    def writerow(self, data: List):
+        self.rows.append(data)
+
+    def write_columns(self, *columns: Union[numpy.ndarray, str, Sequence]):
+        """
+        Buffers a block of rows as Arrow arrays. Values are converted
+        from numpy arrays directly, constant columns (e.g., the date)
+        are converted once and repeated, sequences (e.g., labels of
+        geographies) are converted once while the same sequence is
+        passed with every block.
+
+        :param columns: see `Collector.write_columns()`
+        """
+
+        t0 = time.perf_counter()
+        n = None
+        for column in columns:
+            if not isinstance(column, str):
+                n = len(column)
+                break
+        if not n:
+            return
+        arrays = []
+        for i, column in enumerate(columns):
+            field = self.schema.field(i)
+            if isinstance(column, str):
+                array = self.convert(i, [column])\
+                    .take(numpy.zeros(n, dtype=numpy.int32))
+            elif isinstance(column, numpy.ndarray):
+                if pyarrow.types.is_floating(field.type):
+                    array = pyarrow.array(
+                        column.astype(field.type.to_pandas_dtype(),
+                                      copy=False),
+                        mask=numpy.isnan(column)
+                    )
+                else:
+                    array = self.convert(i, column.tolist())
+            else:
+                cached = self.cache.get(i)
+                if cached is not None and cached[0] is column:
+                    array = cached[1]
+                else:
+                    array = self.convert(i, list(column))
+                    self.cache[i] = (column, array)
+            arrays.append(array)
+        self.batches.append(
+            pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+        )
+        if self.metrics is not None:
+            self.metrics.add("serialize", time.perf_counter() - t0)
+
+    @staticmethod
+    def to_date(value) -> Optional[datetime.date]:
+        if isinstance(value, str):
+            return datetime.date.fromisoformat(value)
+        return value
+
+    def convert(self, i: int, values: List):
+        field = self.schema.field(i)
+        if i == self.date_idx:
+            values = [self.to_date(v) for v in values]
+        elif pyarrow.types.is_integer(field.type):
+            values = [None if v is None or v == "" else int(v)
+                      for v in values]
+        elif pyarrow.types.is_string(field.type):
+            values = [None if v is None else str(v) for v in values]
+        return pyarrow.array(values, type=field.type)
+
+    def flush(self):
+        if self.rows:
+            t0 = time.perf_counter()
+            columns = list(zip(*self.rows))
+            self.batches.append(pyarrow.RecordBatch.from_arrays(
+                [self.convert(i, list(columns[i]))
+                 for i in range(len(columns))],
+                schema=self.schema
+            ))
+            self.rows = []
+            if self.metrics is not None:
+                self.metrics.add("serialize", time.perf_counter() - t0)
+        if not self.batches:
+            return
+        t0 = time.perf_counter()
+        position = self.sink.tell()
+        table = pyarrow.Table.from_batches(self.batches, schema=self.schema)
+        self.writer.write_table(table, row_group_size=table.num_rows)
+        self.batches = []
+        if self.metrics is not None:
+            self.metrics.add("compress", time.perf_counter() - t0)
+            self.metrics.count("bytes", self.sink.tell() - position)
+
+    def append_file(self, path: str):
+        self.flush()
+        source = pyarrow.parquet.ParquetFile(path)
+        for i in range(source.num_row_groups):
+            self.writer.write_table(source.read_row_group(i))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.sink.close()
+
+
+class PostgresCopyWriter(Collector):
+    """
+    Streams results into a PostgreSQL table with
+    `COPY ... FROM STDIN` in binary format, bypassing intermediate
+    files. Rows are encoded into a buffer and every call to `flush()`
+    sends the buffer to the database, i.e. there is a COPY command
+    per day or per block of days. All COPY commands are executed
+    in the transaction of the connection, the caller is responsible
+    for committing it.
+
+    Before the rows of a date are copied, the rows of that date already
+    contained in the table are deleted in the same transaction, so
+    that a task can be executed again (e.g., after a failure of
+    another task or to recompute a year) without violating the
+    primary key (geography, date).
+
+    Column types follow the data model created by `Registry`:
+    columns before "date" contain values (numeric), "date" column
+    is stored as date (its name in the table is `observation_date`),
+    the column following the date is the label of the geography,
+    stored as integer if `numeric_ids` is True. All other columns
+    are stored as text.
+    """
+
+    SIGNATURE = b"PGCOPY\n\xff\r\n\0"
+    PG_EPOCH = datetime.date(2000, 1, 1).toordinal()
+    NUMERIC_POS = 0x0000
+    NUMERIC_NEG = 0x4000
+    NUMERIC_NBASE = 10000
+
+    def __init__(self, connection, table: str, columns: List[str],
+                 numeric_ids: bool = True):
+        """
+        :param connection: Open database connection (psycopg2)
+        :param table: Name of the table, optionally qualified with schema
+        :param columns: Column names, as they are used in CSV files
+        :param numeric_ids: Whether labels of geographies are integers
+            (e.g., zip codes or county FIPS codes)
+        """
+
+        super().__init__()
+        self.connection = connection
+        self.table = table
+        date_idx = columns.index("date")
+        self.columns = [
+            Registry.DATE_COLUMN if i == date_idx else columns[i]
+            for i in range(len(columns))
+        ]
+        encoders: List[Callable] = [self.encode_numeric] * date_idx
+        encoders.append(self.encode_date)
+        for i in range(date_idx + 1, len(columns)):
+            if i == date_idx + 1 and numeric_ids:
+                encoders.append(self.encode_int)
+            else:
+                encoders.append(self.encode_text)
+        self.encoders = encoders
+        self.tuple_header = struct.pack("!h", len(columns))
+        self.buffer = io.BytesIO()
+        self.rows = 0
+        self.date_idx = date_idx
+        self.dates = set()
+        '''Dates of the buffered rows'''
+        self.replaced = set()
+        '''Dates, which rows have been deleted in this transaction'''
+
+    def sql(self, binary: bool = True) -> str:
+        columns = ", ".join(self.columns)
+        if binary:
+            options = "FORMAT binary"
+        else:
+            options = "FORMAT csv, HEADER true"
+        return "COPY {} ({}) FROM STDIN WITH ({})".format(
+            self.table, columns, options
+        )
+
+    @classmethod
+    def encode_numeric(cls, value) -> Optional[bytes]:
+        """
+        Encodes a number in the binary format of PostgreSQL numeric type:
+        number of digits, weight, sign and display scale followed by
+        base 10000 digits
+
+        :param value: a number
+        :return: encoded value or None for missing values
+        """
+
+        if isinstance(value, str):
+            if value == "":
+                return None
+            value = float(value)
+        if math.isnan(value):
+            return None
+        d = Decimal(repr(float(value)))
+        sign = cls.NUMERIC_NEG if d.is_signed() else cls.NUMERIC_POS
+        text = format(abs(d), 'f')
+        if '.' in text:
+            int_part, frac_part = text.split('.')
+        else:
+            int_part, frac_part = text, ""
+        dscale = len(frac_part)
+        int_part = int_part.zfill((len(int_part) + 3) // 4 * 4)
+        frac_part = frac_part.ljust((len(frac_part) + 3) // 4 * 4, '0')
+        digits = [int(int_part[i:i + 4]) for i in range(0, len(int_part), 4)]
+        weight = len(digits) - 1
+        digits += [
+            int(frac_part[i:i + 4]) for i in range(0, len(frac_part), 4)
+        ]
+        while digits and digits[0] == 0:
+            digits.pop(0)
+            weight -= 1
+        while digits and digits[-1] == 0:
+            digits.pop()
+        if not digits:
+            weight = 0
+            sign = cls.NUMERIC_POS
+        return struct.pack("!hhHH{:d}H".format(len(digits)), len(digits),
+                           weight, sign, dscale, *digits)
+
+    @classmethod
+    def encode_date(cls, value) -> Optional[bytes]:
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = datetime.date.fromisoformat(value)
+        return struct.pack("!i", value.toordinal() - cls.PG_EPOCH)
+
+    @staticmethod
+    def encode_int(value) -> Optional[bytes]:
+        if value is None or value == "":
+            return None
+        return struct.pack("!i", int(value))
+
+    @staticmethod
+    def encode_text(value) -> Optional[bytes]:
+        if value is None:
+            return None
+        return str(value).encode("utf-8")
+
+    def replace(self, dates):
+        """
+        Deletes rows of the given dates from the table, unless they
+        have been already deleted by this writer, i.e. the rows of
+        these dates in the table have been written by it
+
+        :param dates: Dates as `datetime.date` or ISO strings
+        """
+
+        dates = {
+            datetime.date.fromisoformat(d) if isinstance(d, str) else d
+            for d in dates
+        } - self.replaced
+        if not dates:
+            return
+        sql = "DELETE FROM {} WHERE {} = ANY(%s)".format(
+            self.table, Registry.DATE_COLUMN
+        )
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, (sorted(dates),))
+        self.replaced.update(dates)
+
+    def writerow(self, data: List):
+        self.dates.add(data[self.date_idx])
+        out = self.buffer
+        out.write(self.tuple_header)
+        for encoder, value in zip(self.encoders, data):
+            field = None if value is None else encoder(value)
+            if field is None:
+                out.write(b"\xff\xff\xff\xff")
+            else:
+                out.write(struct.pack("!i", len(field)))
+                out.write(field)
+        self.rows += 1
+
+    def flush(self):
+        if self.rows == 0:
+            return
+        self.replace(self.dates)
+        self.buffer.write(struct.pack("!h", -1))
+        data = io.BytesIO()
+        data.write(self.SIGNATURE)
+        data.write(struct.pack("!ii", 0, 0))
+        data.write(self.buffer.getbuffer())
+        data.seek(0)
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(self.sql(), data)
+        self.buffer = io.BytesIO()
+        self.rows = 0
+        self.dates = set()
+
+    def append_file(self, path: str):
+        """
+        Appends all data rows from a CSV file with a header line,
+        replacing the rows of the same dates
+
+        :param path: path to the file
+        """
+
+        self.flush()
+        with fopen(path, "rt") as part:
+            reader = csv.reader(part)
+            next(reader, None)
+            self.replace({row[self.date_idx] for row in reader})
+        with fopen(path, "rt") as part, self.connection.cursor() as cursor:
+            cursor.copy_expert(self.sql(binary=False), part)
+
+
+class OutputOptions:
+    """
+    Options defining how the results are written, in addition
+    to the format defined by the name of the resulting file
+    """
+
+    def __init__(self, database: Optional[Tuple[str, str]] = None,
+                 precision: Optional[int] = None,
+                 compression_level: Optional[int] = None,
+                 compression_threads: int = 1,
+                 resumable: bool = False):
+        """
+        :param database: Optional tuple (path to database connection
+            parameters file, section in the file). If given, the data is
+            copied directly into the database table. Rows replace
+            the rows of the same dates in the table, the data is
+            committed when the collector is closed
+        :param precision: Optional number of decimal places for values
+            written into CSV files
+        :param compression_level: Compression level for compressed
+            CSV files, the default depends on the compression
+        :param compression_threads: Number of threads used to compress
+            CSV files
+        :param resumable: Whether tasks save checkpoints, allowing
+            to resume an interrupted task
+        """
+
+        self.database = database
+        self.precision = precision
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.resumable = resumable
+
+    def for_parts(self) -> "OutputOptions":
+        """
+        :return: Options for temporary uncompressed part files
+        """
+        return OutputOptions(precision=self.precision)
+
+
+def is_parquet(path: str) -> bool:
+    return path.endswith(".parquet")
+
+
+@contextmanager
+def open_collector(path: str, mode: str, header: List[str],
+                   numeric_ids: bool = True,
+                   options: Optional[OutputOptions] = None,
+                   metrics: Optional[Metrics] = None):
+    """
+    Opens a collector writing into a file or a database table.
+    The format of the file is defined by its extension: `.parquet` for
+    Parquet, otherwise CSV, optionally compressed (`.csv.gz`
+    or `.csv.zst`)
+
+    :param path: Path to the file or, if `options.database` is given,
+        the name of the table
+    :param mode: Mode to open the file, e.g. "wt" or "at"
+    :param header: Column names. For CSV files, header line is written
+        unless the file is opened for appending
+    :param numeric_ids: Whether labels of geographies are integers,
+        used only for Parquet files and database tables
+    :param options: Output options
+    :param metrics: Optional metrics of the task writing the results
+    :return: Collector
+    """
+
+    if options is None:
+        options = OutputOptions()
+    if options.database:
+        # database driver is needed only to write into a database
+        from nsaph.db import Connection
+        with Connection(*options.database) as connection:
+            writer = PostgresCopyWriter(connection, path, header, numeric_ids)
+            writer.metrics = metrics
+            try:
+                yield writer
+                writer.flush()
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+    elif is_parquet(path):
+        if 'a' in mode:
+            raise ValueError("Appending is not supported for Parquet files: "
+                             + path)
+        writer = ParquetWriter(path, header, numeric_ids)
+        writer.metrics = metrics
+        try:
+            yield writer
+        finally:
+            writer.close()
+    else:
+        with open_compressed(path, mode, options.compression_level,
+                             options.compression_threads,
+                             options.resumable) as out:
+            writer = CSVWriter(out, options.precision)
+            writer.metrics = metrics
+            if 'a' not in mode:
+                writer.writerow(header)
+            yield writer
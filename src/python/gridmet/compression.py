@@ -0,0 +1,257 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Compressed text streams for the resulting files.
+
+Gzip files can be compressed by several threads: the output is split
+into independent blocks, every block is compressed as a separate gzip
+member and the members are written in order. A sequence of gzip
+members is a valid gzip file, readable by `gzip`, `zcat` or pandas.
+Zstandard files use multithreading built into the zstd library.
+
+Both writers can be synchronized: all data written so far is
+compressed into complete gzip members (zstd frames) and written to
+the file. The file can be truncated at such point and appended
+later, remaining a valid compressed stream.
+"""
+
+import gzip
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import zstandard
+
+from nsaph_utils.utils.io_utils import fopen
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    """
+    Binary stream compressing blocks of data in a thread pool
+    into a multi-member gzip file
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, path: str, mode: str = "wb", level: int = 9,
+                 threads: int = 4, block_size: int = BLOCK_SIZE):
+        """
+        :param path: Path to the file
+        :param mode: "wb" to create a new file or "ab" to append
+            members to an existing file
+        :param level: Compression level, 1 to 9
+        :param threads: Number of compressing threads
+        :param block_size: Size of uncompressed blocks in bytes
+        """
+
+        super().__init__()
+        self.raw = open(path, mode)
+        self.level = level
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = 2 * threads
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self.submit()
+        return len(data)
+
+    def submit(self):
+        block = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.pending.append(
+            self.executor.submit(gzip.compress, block, self.level, mtime=0)
+        )
+        while len(self.pending) > self.max_pending:
+            self.write_next()
+        self.write_completed()
+
+    def write_next(self):
+        self.raw.write(self.pending.popleft().result())
+
+    def write_completed(self):
+        while self.pending and self.pending[0].done():
+            self.write_next()
+
+    def flush(self):
+        """
+        Writes blocks that have already been compressed. Data, that
+        has not yet filled a block, stays in memory until the block
+        is filled or the stream is closed
+        """
+
+        if self.raw.closed:
+            return
+        self.write_completed()
+        self.raw.flush()
+
+    def sync(self) -> int:
+        """
+        Compresses all buffered data and writes it to the file
+
+        :return: Size of the file, it ends with a complete gzip member
+        """
+
+        if self.buffer:
+            self.submit()
+        while self.pending:
+            self.write_next()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        return self.raw.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self.submit()
+            while self.pending:
+                self.write_next()
+            self.raw.close()
+        finally:
+            self.executor.shutdown()
+            super().close()
+
+
+class ZstdWriter(io.BufferedIOBase):
+    """
+    Binary stream compressing data into a Zstandard file
+    """
+
+    def __init__(self, path: str, mode: str = "wb", level: int = 3,
+                 threads: int = 1):
+        """
+        :param path: Path to the file
+        :param mode: "wb" to create a new file or "ab" to append
+            frames to an existing file
+        :param level: Compression level
+        :param threads: Number of compressing threads
+        """
+
+        super().__init__()
+        self.raw = open(path, mode)
+        compressor = zstandard.ZstdCompressor(
+            level=level, threads=threads if threads > 1 else 0
+        )
+        self.writer = compressor.stream_writer(self.raw, closefd=False)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.writer.write(data)
+        return len(data)
+
+    def flush(self):
+        if self.raw.closed:
+            return
+        self.writer.flush()
+        self.raw.flush()
+
+    def sync(self) -> int:
+        """
+        Ends current frame and writes it to the file
+
+        :return: Size of the file, it ends with a complete frame
+        """
+
+        self.writer.flush(zstandard.FLUSH_FRAME)
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        return self.raw.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.writer.close()
+            self.raw.close()
+        finally:
+            super().close()
+
+
+def sync(stream) -> Optional[int]:
+    """
+    Writes all data written into a text stream to the file, so that
+    the file can be truncated at the returned offset and appended later
+
+    :param stream: Text stream returned by `open_compressed()`
+    :return: Offset in the file or None if the stream can not
+        be synchronized (e.g., a single member gzip stream)
+    """
+
+    stream.flush()
+    raw = getattr(stream, "buffer", None)
+    if isinstance(raw, (ParallelGzipWriter, ZstdWriter)):
+        return raw.sync()
+    if isinstance(raw, io.BufferedWriter):
+        raw.flush()
+        os.fsync(raw.fileno())
+        return raw.tell()
+    return None
+
+
+def is_compressed(stream) -> bool:
+    """
+    :param stream: Text stream returned by `open_compressed()`
+    :return: True if the data written into the stream is compressed
+    """
+
+    raw = getattr(stream, "buffer", stream)
+    return isinstance(raw, (ParallelGzipWriter, ZstdWriter, gzip.GzipFile))
+
+
+def open_compressed(path: str, mode: str, level: Optional[int] = None,
+                    threads: int = 1, resumable: bool = False):
+    """
+    Opens a text file for writing, compressed according to its
+    extension: `.gz` for gzip, `.zst` for Zstandard, other files
+    are not compressed
+
+    :param path: Path to the file
+    :param mode: "wt" or "at"
+    :param level: Compression level, the default depends on the format
+    :param threads: Number of threads used for compression
+    :param resumable: If True, the stream always supports `sync()`
+    :return: Text stream
+    """
+
+    append = 'a' in mode
+    if path.endswith(".zst"):
+        writer = ZstdWriter(path, "ab" if append else "wb",
+                            level if level is not None else 3, threads)
+        return io.TextIOWrapper(writer, encoding="utf-8")
+    if path.endswith(".gz") and (threads > 1 or resumable):
+        writer = ParallelGzipWriter(path, "ab" if append else "wb",
+                                    level if level is not None else 9,
+                                    threads)
+        return io.TextIOWrapper(writer, encoding="utf-8")
+    if path.endswith(".gz") and level is not None:
+        return gzip.open(path, mode, compresslevel=level)
+    return fopen(path, mode)
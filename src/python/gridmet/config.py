@@ -21,6 +21,7 @@ import datetime
 from enum import Enum
 from typing import Optional
 
+from gridmet.memory import parse_size
 from nsaph_gis.constants import Geography, RasterizationStrategy
 from nsaph_utils.utils.context import Context, Argument, Cardinality
 
@@ -49,6 +50,12 @@ class DateFilter:
             return False
         return True
 
+    def __str__(self):
+        return "{}:{}".format(
+            self.min.isoformat() if self.min else "",
+            self.max.isoformat() if self.max else ""
+        )
+
 
 class Shape(Enum):
     """Type of shape"""
@@ -59,6 +66,71 @@ class Shape(Enum):
     """Polygon"""
 
 
+class WeightingStrategy(Enum):
+    """
+    Strategies implemented in this package in addition to
+    rasterization strategies defined by
+    `nsaph_gis.constants.RasterizationStrategy`
+    """
+
+    area_weighted = "area_weighted"
+    """Every grid cell is weighted by the exact fraction of its area
+    covered by the shape"""
+
+
+class BandsLayout(Enum):
+    """How multiple bands are processed and stored"""
+
+    separate = "separate"
+    """Every band is processed independently into its own file"""
+    fused = "fused"
+    """All bands for a year are processed in a single pass,
+    every band is stored in its own file"""
+    wide = "wide"
+    """All bands for a year are processed in a single pass and
+    stored in one file with a column per band"""
+
+
+class OutputFormat(Enum):
+    """Format of the resulting files"""
+
+    csv = "csv"
+    """CSV, compressed if `compress` is set, see `Compression`"""
+    parquet = "parquet"
+    """Apache Parquet with typed columns"""
+    postgres = "postgres"
+    """Rows are copied directly into PostgreSQL tables of
+    the gridmet data model, no files are created"""
+
+
+class Compression(Enum):
+    """Compression of CSV files, used if `compress` is set"""
+
+    gzip = "gzip"
+    """Gzip, multi-member if compressed by several threads"""
+    zstd = "zstd"
+    """Zstandard"""
+
+
+class Engine(Enum):
+    """How aggregations over shapes are executed"""
+
+    eager = "eager"
+    """Every task reads and aggregates its days in its own loop"""
+    chunked = "chunked"
+    """Variables are opened lazily as arrays chunked along time,
+    chunks of all tasks are aggregated by a shared scheduler"""
+
+
+class Scheduler(Enum):
+    """Local scheduler executing chunks with chunked engine"""
+
+    threads = "threads"
+    """Pool of threads, reading of netCDF files is serialized"""
+    processes = "processes"
+    """Pool of processes, every process opens its own files"""
+
+
 class GridmetVariable(Enum):
     """
     `Gridmet Bands <https://gee.stac.cloud/WUtw2spmec7AM9rk6xMXUtStkMtbviDtHK?t=bands>`
@@ -110,7 +182,8 @@ class GridmetContext(Context):
                          aliases=['s'],
                          default=RasterizationStrategy.default.value,
                          help="Rasterization Strategy",
-                         valid_values=[v.value for v in RasterizationStrategy])
+                         valid_values=[v.value for v in RasterizationStrategy]
+                                      + [v.value for v in WeightingStrategy])
     _destination = Argument("destination",
                             aliases=['dest', 'd'],
                             cardinality=Cardinality.single,
@@ -163,6 +236,178 @@ class GridmetContext(Context):
                        default="",
                        help="Path to shape files",
                        )
+    _geometry_cache = Argument("geometry_cache",
+                               cardinality=Cardinality.single,
+                               default="",
+                               help="Directory to cache parsed shape "
+                                    + "files. Empty value disables "
+                                    + "caching"
+                               )
+    _layout = Argument("layout",
+                       cardinality=Cardinality.single,
+                       default=BandsLayout.separate.value,
+                       help="How multiple bands are processed: "
+                            + "separately, in a single pass per year "
+                            + "(fused) or in a single pass per year into "
+                            + "one file with a column per band (wide)",
+                       valid_values=[v.value for v in BandsLayout]
+                       )
+    _format = Argument("format",
+                       cardinality=Cardinality.single,
+                       default=OutputFormat.csv.value,
+                       help="Format of the resulting files",
+                       valid_values=[v.value for v in OutputFormat]
+                       )
+    _precision = Argument("precision",
+                          type=int,
+                          help="Number of decimal places for values in "
+                               + "CSV files, by default all significant "
+                               + "digits are written",
+                          required=False)
+    _compression = Argument("compression",
+                            cardinality=Cardinality.single,
+                            default=Compression.gzip.value,
+                            help="Compression of CSV files, "
+                                 + "used if compress is set",
+                            valid_values=[v.value for v in Compression]
+                            )
+    _compression_level = Argument("compression_level",
+                                  type=int,
+                                  help="Compression level, by default 9 "
+                                       + "for gzip and 3 for zstd",
+                                  required=False)
+    _compression_threads = Argument("compression_threads",
+                                    type=int,
+                                    cardinality=Cardinality.single,
+                                    default=1,
+                                    help="Number of threads compressing "
+                                         + "a single file. Gzip files "
+                                         + "compressed by several threads "
+                                         + "consist of several members"
+                                    )
+    _db = Argument("db",
+                   cardinality=Cardinality.single,
+                   default="database.ini",
+                   help="Path to a database connection parameters file, "
+                        + "used with postgres format"
+                   )
+    _connection = Argument("connection",
+                           cardinality=Cardinality.single,
+                           default="nsaph2",
+                           help="Section in the database connection "
+                                + "parameters file"
+                           )
+    _segments = Argument("segments",
+                         type=int,
+                         cardinality=Cardinality.single,
+                         default=1,
+                         help="Number of concurrent connections used "
+                              + "to download a single file"
+                         )
+    _prefetch = Argument("prefetch",
+                         type=int,
+                         cardinality=Cardinality.single,
+                         default=0,
+                         help="Number of tasks (year, band), for which "
+                              + "data is downloaded in background ahead "
+                              + "of computations. 0 means no overlap "
+                              + "between downloads and computations"
+                         )
+    _processes = Argument("processes",
+                          aliases=["threads"],
+                          type=int,
+                          cardinality=Cardinality.single,
+                          default=1,
+                          help="Number of processes to execute tasks "
+                               + "(year, band) in parallel"
+                          )
+    _day_workers = Argument("day_workers",
+                            type=int,
+                            cardinality=Cardinality.single,
+                            default=1,
+                            help="Number of processes computing ranges of "
+                                 + "days within a single task (year, band)"
+                            )
+    _read_ahead = Argument("read_ahead",
+                           type=int,
+                           cardinality=Cardinality.single,
+                           default=0,
+                           help="Number of day layers (or blocks of days) "
+                                + "read in background ahead of "
+                                + "computations. 0 means no overlap "
+                                + "between reading and computations"
+                           )
+    _resume = Argument("resume",
+                       type=bool,
+                       default=False,
+                       help="Save checkpoints while computing and resume "
+                            + "interrupted tasks from the last checkpoint "
+                            + "instead of starting from the first day. "
+                            + "Supported for separate layout, "
+                            + "except points"
+                       )
+    _incremental = Argument("incremental",
+                            type=bool,
+                            default=False,
+                            help="Compute only days missing in existing "
+                                 + "resulting files and append them. The "
+                                 + "dates contained in a file are recorded "
+                                 + "in a sidecar index. Supported for CSV "
+                                 + "files with separate layout, except "
+                                 + "points"
+                            )
+    _force = Argument("force",
+                      type=bool,
+                      default=False,
+                      help="Compute all files, even if their manifests show "
+                           + "that they have been computed from the same "
+                           + "inputs, parameters and code"
+                      )
+    _metrics = Argument("metrics",
+                        default="",
+                        help="Directory to export metrics of every task "
+                             + "as JSON and Prometheus textfile. Empty "
+                             + "value means metrics are only logged"
+                        )
+    _memory_limit = Argument("memory_limit",
+                             default="",
+                             help="Limit of memory used by a process, "
+                                  + "e.g. 4G or 512M. Days are read and "
+                                  + "aggregated in blocks fitting into "
+                                  + "the limit. Empty value means no limit"
+                             )
+    _engine = Argument("engine",
+                       cardinality=Cardinality.single,
+                       default=Engine.eager.value,
+                       help="How aggregations over shapes are executed: "
+                            + "eagerly by every task or as a graph of "
+                            + "chunks along time executed by a shared "
+                            + "local scheduler (chunked)",
+                       valid_values=[v.value for v in Engine]
+                       )
+    _scheduler = Argument("scheduler",
+                          cardinality=Cardinality.single,
+                          default=Scheduler.threads.value,
+                          help="Scheduler executing chunks with "
+                               + "chunked engine",
+                          valid_values=[v.value for v in Scheduler]
+                          )
+    _engine_workers = Argument("engine_workers",
+                               type=int,
+                               cardinality=Cardinality.single,
+                               default=1,
+                               help="Number of threads or processes "
+                                    + "of the scheduler executing chunks "
+                                    + "with chunked engine"
+                               )
+    _day_block = Argument("day_block",
+                          type=int,
+                          cardinality=Cardinality.single,
+                          default=1,
+                          help="Number of days to read and aggregate "
+                               + "at once (\"cube\" mode). "
+                               + "1 means processing day by day"
+                          )
 
     def __init__(self, doc = None):
         """
@@ -180,7 +425,7 @@ class GridmetContext(Context):
         self.strategy = None
         """
         Rasterization strategy
-        :type: RasterizationStrategy
+        :type: RasterizationStrategy or WeightingStrategy
         """
 
         self.destination = None
@@ -203,6 +448,72 @@ class GridmetContext(Context):
         :type: Shape
         """
         self.shape_files = None
+        self.geometry_cache = None
+        '''Directory to cache parsed shape files'''
+        self.layout = None
+        """
+        How multiple bands are processed and stored
+
+        :type: BandsLayout
+        """
+        self.format = None
+        """
+        Format of the resulting files
+
+        :type: OutputFormat
+        """
+        self.precision = None
+        '''Number of decimal places for values in CSV files'''
+        self.compression = None
+        """
+        Compression of CSV files
+
+        :type: Compression
+        """
+        self.compression_level = None
+        '''Compression level'''
+        self.compression_threads = None
+        '''Number of threads compressing a single file'''
+        self.db = None
+        '''Path to a database connection parameters file'''
+        self.connection = None
+        '''Section in the database connection parameters file'''
+        self.segments = None
+        '''Number of concurrent connections to download a file'''
+        self.prefetch = None
+        '''Number of tasks to download ahead of computations'''
+        self.processes = None
+        '''Number of processes to execute tasks in parallel'''
+        self.day_workers = None
+        '''Number of processes computing ranges of days within a task'''
+        self.day_block = None
+        '''Number of days to read and aggregate at once'''
+        self.read_ahead = None
+        '''Number of layers or blocks read ahead of computations'''
+        self.resume = None
+        '''Whether to save checkpoints and resume interrupted tasks'''
+        self.incremental = None
+        '''Whether to compute only new days and append them'''
+        self.force = None
+        '''Whether to compute files with up to date manifests'''
+        self.metrics = None
+        '''Directory to export metrics of tasks'''
+        self.memory_limit: Optional[int] = None
+        '''Limit of memory used by a process in bytes'''
+        self.engine = None
+        """
+        How aggregations over shapes are executed
+
+        :type: Engine
+        """
+        self.scheduler = None
+        """
+        Scheduler executing chunks with chunked engine
+
+        :type: Scheduler
+        """
+        self.engine_workers = None
+        '''Number of workers of the scheduler'''
 
         self.points = None
         '''Path to CSV file containing points'''
@@ -223,7 +534,21 @@ class GridmetContext(Context):
         if attr == self._geography.name:
             return Geography[value]
         if attr == self._strategy.name:
+            if value in [v.value for v in WeightingStrategy]:
+                return WeightingStrategy(value)
             return RasterizationStrategy[value]
+        if attr == self._format.name:
+            return OutputFormat(value)
+        if attr == self._compression.name:
+            return Compression(value)
+        if attr == self._layout.name:
+            return BandsLayout(value)
+        if attr == self._engine.name:
+            return Engine(value)
+        if attr == self._scheduler.name:
+            return Scheduler(value)
+        if attr == self._memory_limit.name:
+            return parse_size(value)
         if attr == self._dates.name:
             if value:
                 return DateFilter(value)
@@ -0,0 +1,275 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Resumable HTTP downloads.
+
+Data is downloaded into temporary part files next to the target,
+that are renamed into the target only when the download is complete.
+If the server supports HTTP Range requests, an interrupted download
+is resumed from where it has stopped, and a single file can be
+downloaded by several concurrent connections (segments).
+"""
+
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Optional, List, Tuple
+
+import requests
+
+
+class RemoteFileInfo:
+    """
+    Metadata of a remote file, obtained with HTTP HEAD request
+    """
+
+    def __init__(self, url: str, timeout: float = 60):
+        response = requests.head(url, allow_redirects=True, timeout=timeout)
+        response.raise_for_status()
+        headers = response.headers
+        self.url = response.url
+        length = headers.get("Content-Length")
+        self.size: Optional[int] = int(length) if length else None
+        self.last_modified: Optional[str] = headers.get("Last-Modified")
+        self.etag: Optional[str] = headers.get("ETag")
+        self.accepts_ranges = headers.get("Accept-Ranges", "") == "bytes"
+
+    def validator(self) -> str:
+        """
+        :return: a string identifying the version of the remote file,
+            suitable for If-Range header
+        """
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified or ""
+
+    def timestamp(self) -> Optional[float]:
+        if not self.last_modified:
+            return None
+        return parsedate_to_datetime(self.last_modified).timestamp()
+
+
+class ResumableDownload:
+    """
+    Downloads a single URL into a target file
+    """
+
+    BLOCK_SIZE = 65536
+    RETRIES = 5
+
+    def __init__(self, url: str, target: str, segments: int = 1,
+                 timeout: float = 60):
+        """
+        :param url: URL to download
+        :param target: Path to the resulting file
+        :param segments: Number of concurrent connections used to
+            download the file, used only if the server supports
+            range requests
+        :param timeout: Timeout for connecting and reading, in seconds
+        """
+
+        self.url = url
+        self.target = target
+        self.segments = max(segments, 1)
+        self.timeout = timeout
+        self.info: Optional[RemoteFileInfo] = None
+
+    def part(self, i: int) -> str:
+        return "{}.part{:d}".format(self.target, i)
+
+    def version_file(self) -> str:
+        return self.target + ".version"
+
+    def is_up_to_date(self) -> bool:
+        """
+        Checks if the target exists and has the same size and
+        modification time as the remote file
+
+        :return: True if the target does not need to be downloaded
+        """
+
+        if not os.path.isfile(self.target):
+            return False
+        if self.info.size is not None \
+                and os.path.getsize(self.target) != self.info.size:
+            return False
+        timestamp = self.info.timestamp()
+        if timestamp is not None \
+                and int(os.path.getmtime(self.target)) < int(timestamp):
+            return False
+        return True
+
+    def execute(self) -> bool:
+        """
+        Downloads the file unless it is up to date
+
+        :return: True if the file has been downloaded, False if it was
+            up to date
+        """
+
+        self.info = RemoteFileInfo(self.url, self.timeout)
+        if self.is_up_to_date():
+            return False
+
+        ranges = self.split()
+        version = "{}\n{:d}".format(self.info.validator(), len(ranges))
+        self.discard_stale_parts(version)
+        with open(self.version_file(), "wt") as f:
+            f.write(version)
+
+        if len(ranges) > 1:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [
+                    executor.submit(self.download_segment, i, ranges[i])
+                    for i in range(len(ranges))
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            self.download_segment(0, ranges[0])
+
+        self.assemble(len(ranges))
+        return True
+
+    def split(self) -> List[Tuple[int, Optional[int]]]:
+        """
+        :return: list of byte ranges (start, end), the end is inclusive,
+            None means end of file
+        """
+
+        size = self.info.size
+        if not size or not self.info.accepts_ranges or self.segments < 2:
+            return [(0, None)]
+        n = min(self.segments, max(size // self.BLOCK_SIZE, 1))
+        bounds = [size * i // n for i in range(n + 1)]
+        return [(bounds[i], bounds[i + 1] - 1) for i in range(n)]
+
+    def discard_stale_parts(self, version: str):
+        """
+        Removes partial downloads left from a different version of the
+        remote file or a different number of segments
+
+        :param version: Version of the current download
+        """
+
+        previous = None
+        if os.path.isfile(self.version_file()):
+            with open(self.version_file()) as f:
+                previous = f.read()
+        if previous == version:
+            return
+        d = os.path.dirname(os.path.abspath(self.target))
+        prefix = os.path.basename(self.target) + ".part"
+        for f in os.listdir(d):
+            if f.startswith(prefix):
+                os.remove(os.path.join(d, f))
+
+    def download_segment(self, i: int, byte_range: Tuple[int, Optional[int]]):
+        """
+        Downloads one segment into its part file, resuming from the
+        current size of the part file. Retries if the connection
+        is dropped
+
+        :param i: Index of the segment
+        :param byte_range: (start, end) of the segment
+        """
+
+        start, end = byte_range
+        if end is not None:
+            expected = end - start + 1
+        elif self.info.size is not None:
+            expected = self.info.size - start
+        else:
+            expected = None
+        path = self.part(i)
+        for attempt in range(self.RETRIES):
+            done = os.path.getsize(path) if os.path.isfile(path) else 0
+            if expected is not None and done >= expected:
+                return
+            try:
+                self.fetch(path, start + done, end, resume=done > 0)
+                if expected is None or os.path.getsize(path) >= expected:
+                    return
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as x:
+                logging.warning("%s [segment %d, attempt %d]: %s",
+                                self.url, i, attempt + 1, str(x))
+        raise IOError("Could not download {} [segment {:d}]"
+                      .format(self.url, i))
+
+    def fetch(self, path: str, start: int, end: Optional[int], resume: bool):
+        headers = dict()
+        if start > 0 or end is not None:
+            headers["Range"] = "bytes={:d}-{}".format(
+                start, "" if end is None else str(end)
+            )
+            validator = self.info.validator()
+            if validator:
+                headers["If-Range"] = validator
+        with requests.get(self.info.url, headers=headers, stream=True,
+                          timeout=self.timeout) as response:
+            response.raise_for_status()
+            mode = "ab" if resume else "wb"
+            if response.status_code != 206 and "Range" in headers:
+                if end is not None:
+                    raise IOError("Remote file has changed or range "
+                                  "requests are not supported: " + self.url)
+                # The whole file is sent, start from scratch
+                mode = "wb"
+            with open(path, mode) as writer:
+                for chunk in response.iter_content(self.BLOCK_SIZE):
+                    writer.write(chunk)
+
+    def assembling_file(self) -> str:
+        return self.target + ".assembling"
+
+    def assemble(self, n: int):
+        """
+        Concatenates part files into a temporary file, validates its
+        size and atomically renames it into the target. Part files are
+        removed only after the target has been replaced, so that
+        a failed assembly can be repeated from the same parts
+
+        :param n: Number of parts
+        """
+
+        tmp = self.assembling_file()
+        try:
+            with open(tmp, "wb") as writer:
+                for i in range(n):
+                    with open(self.part(i), "rb") as reader:
+                        shutil.copyfileobj(reader, writer)
+            size = os.path.getsize(tmp)
+            if self.info.size is not None and size != self.info.size:
+                raise IOError("Size mismatch for {}: expected {:d}, got {:d}"
+                              .format(self.url, self.info.size, size))
+            timestamp = self.info.timestamp()
+            if timestamp is not None:
+                os.utime(tmp, (timestamp, timestamp))
+            os.replace(tmp, self.target)
+        except BaseException:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            raise
+        for i in range(n):
+            os.remove(self.part(i))
+        os.remove(self.version_file())
@@ -0,0 +1,380 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Chunked execution of aggregations over shapes.
+
+A downloaded variable is opened lazily as an array (days x lat x lon)
+split along time into chunks, aligned with the chunks of the netCDF
+variable. Aggregation of a task is a graph of chunk nodes: every node
+reads its chunk and applies zonal weights along space, producing
+means (geographies x days); the results are gathered along time, in
+the order of days, into the collector of the task.
+
+Nodes of all tasks added to the engine (e.g., all years and bands of
+a run) are executed by a single local scheduler, a pool of threads or
+processes with a given number of workers. Results are gathered in the
+main process, so the resulting files are the same as produced by
+eager execution, and checkpoints, incremental mode and manifests work
+the same way.
+
+The engine does not use xarray and dask: chunks are read by
+netCDF4 directly and nodes are executed by `concurrent.futures`
+pools, so no additional dependencies are required. Unlike a dask
+graph, the nodes are independent, every one of them reads and
+aggregates a whole chunk, which is enough for aggregations over
+shapes, that are the only computations executed by the engine.
+
+The HDF5 library, reading netCDF files, is not thread safe, so the
+reads of all nodes executed by threads are serialized, even from
+different files, only aggregations run concurrently. With the
+scheduler of processes the reads run in parallel.
+"""
+
+import logging
+import sys
+import threading
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+from netCDF4._netCDF4 import Dataset
+
+from gridmet.collectors import Collector, open_collector
+from gridmet.config import Scheduler
+from gridmet.manifest import Manifest
+from gridmet.memory import MemoryBudget, AUTO_MAX_DAYS, \
+    AGGREGATION_BYTES_PER_CELL
+from gridmet.metrics import Metrics
+from gridmet.prefetch import block_ranges, get_chunk_days
+from gridmet.task import ComputeShapesTask
+from gridmet.weights import ZonalWeights
+
+
+class ChunkedVariable:
+    """
+    Variable of a netCDF file restricted to a window of the grid and
+    read in chunks of days. The file is opened on the first read in
+    every process, so the object can be passed to worker processes
+    """
+
+    # HDF5 library is not thread safe even for different files,
+    # so reads by all threads of a process are serialized
+    lock = threading.Lock()
+
+    def __init__(self, path: str, name: str, window: Tuple[slice, slice]):
+        """
+        :param path: Path to the netCDF file
+        :param name: Name of the variable
+        :param window: Rows and columns of the grid to read
+        """
+
+        self.path = path
+        self.name = name
+        self.window = window
+        self.dataset = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["dataset"] = None
+        return state
+
+    def read(self, start: int, end: int):
+        """
+        :param start: Index of the first day of the chunk
+        :param end: Index after the last day of the chunk
+        :return: 3D block (days x lat x lon)
+        """
+
+        rows, cols = self.window
+        with self.lock:
+            if self.dataset is None:
+                self.dataset = Dataset(self.path)
+            return self.dataset[self.name][start:end, rows, cols]
+
+    def close(self):
+        with self.lock:
+            if self.dataset is not None:
+                self.dataset.close()
+                self.dataset = None
+
+
+_graph: Dict[int, Tuple[ChunkedVariable, ZonalWeights]] = dict()
+
+
+def set_graph(graph: Dict[int, Tuple[ChunkedVariable, ZonalWeights]]):
+    """
+    Makes variables and weights of the tasks available to chunk nodes
+    executed in the current process
+
+    :param graph: Variable and weights of every task by its key
+    """
+
+    _graph.clear()
+    _graph.update(graph)
+
+
+def aggregate_chunk(key: int, start: int,
+                    end: int) -> Tuple[numpy.ndarray, Metrics]:
+    """
+    Chunk node: reads a chunk of a variable and aggregates it
+
+    :param key: Key of the task
+    :param start: Index of the first day of the chunk
+    :param end: Index after the last day of the chunk
+    :return: 2D array of means (geographies x days) and metrics
+        of the node
+    """
+
+    variable, weights = _graph[key]
+    metrics = Metrics()
+    with metrics.stage("read"):
+        block = variable.read(start, end)
+    metrics.count("cells", block.size)
+    with metrics.stage("unpack"):
+        values, valid = weights.split(block)
+    with metrics.stage("aggregate"):
+        means = weights.aggregate(values, valid)
+    metrics.count("rows", means.size)
+    return means, metrics
+
+
+class TaskGraph:
+    """
+    Chunks of a single task and the state of gathering their results
+    """
+
+    def __init__(self, key: int, task: ComputeShapesTask,
+                 manifest: Optional[Manifest]):
+        """
+        :param key: Key of the task in the engine
+        :param task: Compute task
+        :param manifest: Manifest to save after the task is completed
+        """
+
+        self.key = key
+        self.task = task
+        self.manifest = manifest
+        self.days = []
+        self.offset = 0
+        self.ranges: List[Tuple[int, int]] = []
+        self.variable: Optional[ChunkedVariable] = None
+        self.writer: Optional[Collector] = None
+        self.stack: Optional[ExitStack] = None
+        self.t0 = None
+
+    def plan(self, workers: int):
+        """
+        Opens the dataset, finds the days to compute, builds zonal
+        weights and splits the days into chunks, then closes the
+        dataset
+
+        :param workers: Number of workers of the scheduler
+        """
+
+        task = self.task
+        try:
+            self.days = task.prepare()
+            self.offset = task.get_start(self.days)
+            if self.offset < len(self.days):
+                task.get_weights(task.read(self.offset))
+            variable = task.dataset[task.variable]
+            chunk = get_chunk_days(variable)
+            if task.day_block > 1:
+                block = task.day_block
+            elif chunk > 1:
+                block = chunk
+            else:
+                block = AUTO_MAX_DAYS
+            if task.memory_limit:
+                budget = MemoryBudget(task.memory_limit // max(workers, 1))
+                block = budget.day_block(
+                    task.window_cells() * AGGREGATION_BYTES_PER_CELL,
+                    block, chunk
+                )
+            self.ranges = block_ranges(self.offset, len(self.days), block,
+                                       chunk)
+            self.variable = ChunkedVariable(task.infile, task.variable,
+                                            task.window)
+            logging.info("%s: %d days in %d chunks", task.outfile,
+                         len(self.days) - self.offset, len(self.ranges))
+        finally:
+            # chunks are read by ChunkedVariable
+            task.close()
+
+    def open(self):
+        task = self.task
+        self.t0 = datetime.now()
+        mode = "at" if self.offset > 0 else "wt"
+        self.stack = ExitStack()
+        self.writer = self.stack.enter_context(
+            open_collector(task.outfile, mode, task.header(),
+                           options=task.options, metrics=task.metrics)
+        )
+
+    def write(self, start: int, end: int, means: numpy.ndarray):
+        """
+        Writes the results of a chunk node
+
+        :param start: Index of the first day of the chunk
+        :param end: Index after the last day of the chunk
+        :param means: 2D array of means (geographies x days)
+        """
+
+        task = self.task
+        t1 = datetime.now()
+        task.write_block(self.writer, self.days[start:end], means)
+        with task.metrics.stage("flush"):
+            self.writer.flush()
+            task.save_checkpoint(self.writer, end)
+        logging.info("%s:%s - %s \t%s [%s]", task.band.value,
+                     task.to_date(self.days[start]),
+                     task.to_date(self.days[end - 1]),
+                     str(datetime.now() - t1), str(datetime.now() - self.t0))
+
+    def close(self):
+        """
+        Closes the collector and completes the task
+        """
+
+        self.stack.close()
+        self.writer = None
+        self.task.complete(self.days, datetime.now() - self.t0)
+        if self.manifest is not None:
+            self.manifest.save()
+
+
+class ChunkedEngine:
+    """
+    Executes aggregations of several tasks as chunk nodes
+    on a local scheduler
+    """
+
+    def __init__(self, scheduler: Scheduler = Scheduler.threads,
+                 workers: int = 1):
+        """
+        :param scheduler: Pool of threads or processes
+        :param workers: Number of workers
+        """
+
+        self.scheduler = scheduler
+        self.workers = max(workers, 1)
+        self.max_pending = 2 * self.workers
+        self.graphs: List[TaskGraph] = []
+
+    def add(self, task: ComputeShapesTask, force: bool = False):
+        """
+        Adds a task unless its manifest shows that the results have
+        been computed from the same inputs, parameters and code
+
+        :param task: Compute task
+        :param force: Add the task even if it is up to date
+        """
+
+        manifest = task.manifest()
+        if manifest is not None:
+            if manifest.is_up_to_date() and not force:
+                logging.info("Skipping %s, manifest %s matches",
+                             ", ".join(manifest.outputs), manifest.path)
+                return
+            manifest.invalidate()
+        self.graphs.append(TaskGraph(len(self.graphs), task, manifest))
+
+    def executor(self, graph: Dict) -> Executor:
+        if self.scheduler == Scheduler.processes:
+            return ProcessPoolExecutor(max_workers=self.workers,
+                                       initializer=set_graph,
+                                       initargs=(graph,))
+        set_graph(graph)
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def execute(self):
+        """
+        Executes chunk nodes of all added tasks and gathers the results
+        of every task in the order of days. Tasks are completed in the
+        order, in which they have been added
+
+        :return: None
+        """
+
+        if not self.graphs:
+            return
+        t0 = datetime.now()
+        for g in self.graphs:
+            g.plan(self.workers)
+        graph = {
+            g.key: (g.variable, g.task.weights)
+            for g in self.graphs if g.ranges
+        }
+        n = sum(len(g.ranges) for g in self.graphs)
+        logging.info("Executing %d chunks of %d tasks by %d %s",
+                     n, len(self.graphs), self.workers, self.scheduler.value)
+        pending = deque()
+        executor = self.executor(graph)
+        try:
+            for g in self.graphs:
+                for start, end in g.ranges:
+                    future = executor.submit(aggregate_chunk, g.key,
+                                             start, end)
+                    pending.append((g, start, end, future))
+                    while len(pending) > self.max_pending:
+                        self.gather(*pending.popleft())
+                pending.append((g, None, None, None))
+            while pending:
+                self.gather(*pending.popleft())
+        except BaseException:
+            # e.g., rolls back the transaction of a database collector
+            for g in self.graphs:
+                if g.writer is not None:
+                    g.writer = None
+                    g.stack.__exit__(*sys.exc_info())
+            raise
+        finally:
+            executor.shutdown(cancel_futures=True)
+            for g in self.graphs:
+                if g.variable is not None:
+                    g.variable.close()
+            set_graph(dict())
+        logging.info("Executed %d chunks in %s", n, str(datetime.now() - t0))
+
+    @staticmethod
+    def gather(g: TaskGraph, start: Optional[int], end: Optional[int],
+               future):
+        """
+        Writes the result of the next node in order
+
+        :param g: Graph of the task
+        :param start: Index of the first day of the chunk, None
+            marks the end of the task
+        :param end: Index after the last day of the chunk
+        :param future: Future of the node
+        """
+
+        if g.writer is None:
+            g.open()
+        if future is None:
+            g.close()
+            return
+        means, metrics = future.result()
+        g.task.metrics.merge(metrics)
+        g.write(start, end, means)
@@ -0,0 +1,294 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Persistent cache of parsed shapefiles.
+
+Geometries of a shapefile are stored as WKB in an uncompressed
+Feather file together with their bounding boxes and attributes,
+so that subsequent tasks (other bands, years or jobs) memory-map
+the file instead of parsing the shapefile. A cache entry is
+identified by the absolute path, modification times and sizes of
+the shapefile and its index (.shx), attributes (.dbf) and projection
+(.prj) files, a modified shapefile gets a new entry.
+
+Labels of geographies are assigned by `nsaph_gis` while computing
+statistics, they are added to the entry by the first task
+that computes them.
+
+To prewarm the cache for all shapefiles in a directory tree:
+
+    python -m gridmet.geometry_cache --shapes_dir shapes --cache data/geometries
+"""
+
+import argparse
+import glob
+import hashlib
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import numpy
+import pyarrow
+import pyarrow.feather
+import shapefile as pyshp
+import shapely
+from rasterstats.io import read_features
+from shapely.geometry import shape
+
+from nsaph import init_logging
+
+
+class CachedGeometries:
+    """
+    Geometries of a single shapefile, read from the cache
+    """
+
+    ID_COLUMN = "__gridmet_id__"
+    GEOMETRY_COLUMN = "__wkb__"
+    BOUNDS_COLUMNS = ["__minx__", "__miny__", "__maxx__", "__maxy__"]
+
+    def __init__(self, table: pyarrow.Table):
+        self.table = table
+        self._geometries = None
+        self._tree = None
+
+    @property
+    def geometries(self) -> numpy.ndarray:
+        """
+        :return: Array of Shapely geometries, in the order of the shapefile
+        """
+        if self._geometries is None:
+            wkb = self.table.column(self.GEOMETRY_COLUMN)
+            self._geometries = shapely.from_wkb(
+                wkb.to_numpy(zero_copy_only=False)
+            )
+        return self._geometries
+
+    @property
+    def bounds(self) -> numpy.ndarray:
+        """
+        :return: Array of bounding boxes (minx, miny, maxx, maxy)
+        """
+        return numpy.column_stack([
+            self.table.column(c).to_numpy() for c in self.BOUNDS_COLUMNS
+        ])
+
+    @property
+    def ids(self) -> Optional[List[str]]:
+        """
+        :return: Labels of the geographies or None if they have not
+            been computed yet
+        """
+        if self.ID_COLUMN not in self.table.column_names:
+            return None
+        return self.table.column(self.ID_COLUMN).to_pylist()
+
+    @property
+    def tree(self) -> shapely.STRtree:
+        """
+        :return: Spatial index of the geometries
+        """
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.geometries)
+        return self._tree
+
+    def properties(self, name: str) -> List:
+        """
+        :param name: Name of the attribute in the shapefile
+        :return: Values of the attribute for all geometries
+        """
+        return self.table.column(name).to_pylist()
+
+    def __len__(self):
+        return self.table.num_rows
+
+
+class GeometryCache:
+    """
+    Directory with cached shapefiles
+    """
+
+    SIDECAR_EXTENSIONS = [".shx", ".dbf", ".prj"]
+    """Files of a shapefile, that affect cached geometries, attributes
+    or labels of geographies"""
+
+    def __init__(self, directory: str):
+        """
+        :param directory: Directory to store cached geometries
+        """
+
+        self.directory = directory
+
+    def path(self, shapefile: str) -> str:
+        """
+        :param shapefile: Path to the shapefile
+        :return: Path to the cache entry for the current version
+            of the shapefile
+        """
+
+        shapefile = os.path.abspath(shapefile)
+        stat = os.stat(shapefile)
+        key = "{}|{:d}|{:d}".format(shapefile, stat.st_mtime_ns,
+                                    stat.st_size)
+        base = os.path.splitext(shapefile)[0]
+        for ext in self.SIDECAR_EXTENSIONS:
+            for sidecar in [base + ext, base + ext.upper()]:
+                if os.path.isfile(sidecar):
+                    stat = os.stat(sidecar)
+                    key += "|{}|{:d}|{:d}".format(ext, stat.st_mtime_ns,
+                                                  stat.st_size)
+                    break
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(shapefile))[0]
+        return os.path.join(self.directory,
+                            "{}.{}.feather".format(name, digest))
+
+    def load(self, shapefile: str) -> CachedGeometries:
+        """
+        Returns cached geometries of a shapefile, parsing the
+        shapefile if it has not been cached yet
+
+        :param shapefile: Path to the shapefile
+        :return: Cached geometries
+        """
+
+        path = self.path(shapefile)
+        if not os.path.isfile(path):
+            self.write(path, self.parse(shapefile))
+        return CachedGeometries(
+            pyarrow.feather.read_table(path, memory_map=True)
+        )
+
+    def store_ids(self, shapefile: str, ids: List):
+        """
+        Adds labels of the geographies to the cache entry
+
+        :param shapefile: Path to the shapefile
+        :param ids: Labels, in the order of the shapefile
+        """
+
+        path = self.path(shapefile)
+        table = pyarrow.feather.read_table(path)
+        if len(ids) != table.num_rows:
+            raise ValueError("{:d} labels for {:d} geometries in {}".format(
+                len(ids), table.num_rows, shapefile
+            ))
+        column = pyarrow.array([str(i) for i in ids], type=pyarrow.string())
+        name = CachedGeometries.ID_COLUMN
+        if name in table.column_names:
+            table = table.drop([name])
+        self.write(path, table.append_column(name, column))
+
+    @staticmethod
+    def parse(shapefile: str) -> pyarrow.Table:
+        """
+        Reads all features of a shapefile
+
+        :param shapefile: Path to the shapefile
+        :return: Table with a row per feature
+        """
+
+        logging.info("Parsing %s", shapefile)
+        geometries = []
+        properties = []
+        for feature in read_features(shapefile):
+            geometries.append(shape(feature["geometry"]))
+            properties.append(feature.get("properties") or dict())
+        geometries = numpy.array(geometries, dtype=object)
+        bounds = shapely.bounds(geometries).reshape(-1, 4)
+        columns = {
+            CachedGeometries.GEOMETRY_COLUMN:
+                pyarrow.array(shapely.to_wkb(geometries), pyarrow.binary())
+        }
+        for i, name in enumerate(CachedGeometries.BOUNDS_COLUMNS):
+            columns[name] = pyarrow.array(bounds[:, i])
+        names = []
+        for p in properties:
+            for name in p:
+                if name not in names:
+                    names.append(name)
+        for name in names:
+            columns[name] = pyarrow.array([p.get(name) for p in properties])
+        return pyarrow.table(columns)
+
+    def write(self, path: str, table: pyarrow.Table):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = "{}.{:d}.tmp".format(path, os.getpid())
+        # Uncompressed files can be memory-mapped without copying
+        pyarrow.feather.write_feather(table, tmp,
+                                      compression="uncompressed")
+        os.replace(tmp, path)
+
+    def prewarm(self, shapes_dir: str) -> int:
+        """
+        Caches all shapefiles found in a directory tree
+
+        :param shapes_dir: Root directory, e.g. containing shape files
+            organized as ${year}/${geo_type}/{point|polygon}
+        :return: number of shapefiles in the tree
+        """
+
+        shapefiles = sorted(glob.glob(
+            os.path.join(shapes_dir, "**", "*.shp"), recursive=True
+        ))
+        for shapefile in shapefiles:
+            path = self.path(shapefile)
+            if os.path.isfile(path):
+                logging.info("Up to date: %s", shapefile)
+                continue
+            self.write(path, self.parse(shapefile))
+        return len(shapefiles)
+
+
+def total_bounds(shapefile: str, geometry_cache: Optional[str] = None) \
+        -> Optional[Tuple[float, float, float, float]]:
+    """
+    Returns bounding box of all shapes in a shapefile, taken from the
+    cache if it is given, otherwise from the header of the shapefile
+
+    :param shapefile: Path to the shapefile
+    :param geometry_cache: Optional directory with cached geometries
+    :return: (minx, miny, maxx, maxy) or None if the shapefile is empty
+    """
+
+    if geometry_cache:
+        bounds = GeometryCache(geometry_cache).load(shapefile).bounds
+        if len(bounds) == 0:
+            return None
+        return (numpy.nanmin(bounds[:, 0]), numpy.nanmin(bounds[:, 1]),
+                numpy.nanmax(bounds[:, 2]), numpy.nanmax(bounds[:, 3]))
+    with pyshp.Reader(shapefile) as reader:
+        if len(reader) == 0:
+            return None
+        return tuple(reader.bbox)
+
+
+if __name__ == '__main__':
+    init_logging()
+    ap = argparse.ArgumentParser(
+        description="Caches parsed shapefiles for gridmet pipeline"
+    )
+    ap.add_argument("--shapes_dir", required=True,
+                    help="Directory containing shape files")
+    ap.add_argument("--cache", required=True,
+                    help="Directory to store cached geometries")
+    args = ap.parse_args()
+    n = GeometryCache(args.cache).prewarm(args.shapes_dir)
+    logging.info("%d shapefiles cached in %s", n, args.cache)
@@ -17,14 +17,17 @@
 #  limitations under the License.
 #
 
+import math
 import os
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import rasterio
 
 from netCDF4._netCDF4 import Dataset
 import numpy
 import geopy
 
+NO_DATA = -999 # I do not know what it is, but not setting it causes a warning
+
 
 def get_atmos_url(year:int, variable ="PM25") -> str:
     """
@@ -166,6 +169,60 @@ def get_affine_transform(nc_file: str, factor: int = 1):
     return affine
 
 
+def get_window(affine, shape2d: Tuple[int, int],
+               bounds: Tuple[float, float, float, float],
+               factor: int = 1) -> Optional[Tuple[slice, slice]]:
+    """
+    Computes the smallest window of the native grid containing a
+    bounding box, with a margin of one cell
+
+    :param affine: Affine transformation of the (possibly
+        disaggregated) grid
+    :param shape2d: Shape of the native grid: (rows, columns)
+    :param bounds: Bounding box: (minx, miny, maxx, maxy)
+    :param factor: factor used for disaggregation
+    :return: a tuple of slices (rows, columns) or None if the window
+        would cover the whole grid or nothing
+    """
+
+    a = affine.a * factor
+    e = affine.e * factor
+    minx, miny, maxx, maxy = bounds
+    x = sorted([(minx - affine.c) / a, (maxx - affine.c) / a])
+    y = sorted([(miny - affine.f) / e, (maxy - affine.f) / e])
+    row0 = max(math.floor(y[0]) - 1, 0)
+    row1 = min(math.ceil(y[1]) + 1, shape2d[0])
+    col0 = max(math.floor(x[0]) - 1, 0)
+    col1 = min(math.ceil(x[1]) + 1, shape2d[1])
+    if row0 >= row1 or col0 >= col1:
+        return None
+    if (row1 - row0, col1 - col0) == tuple(shape2d):
+        return None
+    return slice(row0, row1), slice(col0, col1)
+
+
+def shift_affine(affine, window: Tuple[slice, slice], factor: int = 1):
+    """
+    Returns affine transformation for a window of the grid
+
+    :param affine: Affine transformation of the (possibly
+        disaggregated) grid
+    :param window: a tuple of slices (rows, columns) of the native grid
+    :param factor: factor used for disaggregation
+    :return: Affine transformation with the origin in the upper left
+        corner of the window
+    """
+
+    rows, cols = window
+    return rasterio.Affine(affine.a,
+                           affine.b,
+                           affine.c + cols.start * affine.a * factor,
+                           affine.d,
+                           affine.e,
+                           affine.f + rows.start * affine.e * factor
+                           )
+
+
 def disaggregate(layer, factor: int):
     """
     Implementation of R `disaggregate` function with method == ''.
@@ -47,12 +47,38 @@
 #
 
 import logging
-from typing import List
+import queue
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import List, Optional
 
 from nsaph import init_logging
 
-from gridmet.config import GridmetContext
-from gridmet.task import GridmetTask
+from gridmet.config import GridmetContext, BandsLayout, Engine
+from gridmet.engine import ChunkedEngine
+from gridmet.task import GridmetTask, GridmetBandsTask
+
+
+def execute_task(task) -> Optional[str]:
+    """
+    Executes a single task in a worker process
+
+    :param task: Task to execute
+    :return: None if the task has succeeded, otherwise the description
+        of the error
+    """
+
+    logging.info("Starting: %s", str(task))
+    t0 = datetime.now()
+    try:
+        task.execute()
+    except BaseException:
+        logging.exception("Failed: %s", str(task))
+        return traceback.format_exc()
+    logging.info("Completed: %s in %s", str(task), str(datetime.now() - t0))
+    return None
 
 
 class Gridmet:
@@ -77,6 +103,10 @@ class Gridmet:
         self.tasks = self.collect_tasks()
 
     def collect_tasks(self) -> List:
+        if self.context.layout != BandsLayout.separate:
+            return [
+                GridmetBandsTask(self.context, y) for y in self.context.years
+            ]
         tasks = [
             GridmetTask(self.context, y, v)
                 for y in self.context.years for v in self.context.variables
@@ -93,8 +123,137 @@ class Gridmet:
         for task in self.tasks:
             task.execute()
 
+    def execute_parallel(self, workers: int):
+        """
+        Executes tasks in the pipeline in parallel using a pool of
+        processes. A failure of one task does not affect other tasks,
+        the summary of failed tasks is logged at the end
+
+        :param workers: Number of worker processes
+        :return: None
+        :raises Exception: if any task has failed
+        """
+
+        t0 = datetime.now()
+        failed = dict()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(execute_task, task): str(task)
+                for task in self.tasks
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    error = future.result()
+                except BaseException:
+                    # e.g. worker process has been killed
+                    error = traceback.format_exc()
+                if error:
+                    failed[name] = error
+        logging.info("Executed %d tasks with %d processes in %s: "
+                     "%d succeeded, %d failed",
+                     len(self.tasks), workers, str(datetime.now() - t0),
+                     len(self.tasks) - len(failed), len(failed))
+        for name in failed:
+            logging.error("Failed: %s\n%s", name, failed[name])
+        if failed:
+            raise Exception("{:d} out of {:d} tasks have failed: {}".format(
+                len(failed), len(self.tasks), ", ".join(failed)
+            ))
+
+    def execute_pipelined(self, prefetch: int):
+        """
+        Executes tasks overlapping downloads with computations.
+        A background thread downloads data for the next tasks, while
+        the main thread computes the tasks, for which the data has already
+        been downloaded
+
+        :param prefetch: Maximum number of tasks, for which the data
+            is downloaded ahead of computation
+        :return: None
+        :raises Exception: if any task has failed
+        """
+
+        t0 = datetime.now()
+        downloaded = queue.Queue()
+        # Limits number of tasks downloaded, but not yet computed
+        slots = threading.Semaphore(prefetch + 1)
+
+        def download():
+            for task in self.tasks:
+                slots.acquire()
+                logging.info("Downloading: %s", str(task))
+                try:
+                    changed = task.download()
+                    downloaded.put((task, changed, None))
+                except BaseException:
+                    logging.exception("Download failed: %s", str(task))
+                    downloaded.put((task, True, traceback.format_exc()))
+
+        downloader = threading.Thread(target=download, daemon=True,
+                                      name="gridmet-downloader")
+        downloader.start()
+
+        failed = dict()
+        for _ in range(len(self.tasks)):
+            task, changed, error = downloaded.get()
+            if not error:
+                logging.info("Computing: %s", str(task))
+                try:
+                    task.compute(changed)
+                except BaseException:
+                    logging.exception("Failed: %s", str(task))
+                    error = traceback.format_exc()
+            if error:
+                failed[str(task)] = error
+            slots.release()
+        downloader.join()
+
+        logging.info("Executed %d tasks in %s: %d succeeded, %d failed",
+                     len(self.tasks), str(datetime.now() - t0),
+                     len(self.tasks) - len(failed), len(failed))
+        if failed:
+            raise Exception("{:d} out of {:d} tasks have failed: {}".format(
+                len(failed), len(self.tasks), ", ".join(failed)
+            ))
+
+    def execute_chunked(self):
+        """
+        Downloads the data for all tasks, then executes aggregations
+        over shapes of all tasks as chunks on a single local scheduler,
+        see `gridmet.engine`. Other computations are executed eagerly
+        before the aggregations
+
+        :return: None
+        """
+
+        engine = ChunkedEngine(self.context.scheduler,
+                               self.context.engine_workers)
+        for task in self.tasks:
+            changed = task.download()
+            task.compute(changed, engine)
+        engine.execute()
+
+    def execute(self):
+        """
+        Executes all tasks in the pipeline, in parallel if more than one
+        process is requested by the context, or overlapping downloads
+        with computations if prefetch is requested, or by the chunked
+        engine
+        :return: None
+        """
+
+        if self.context.engine == Engine.chunked:
+            self.execute_chunked()
+        elif self.context.processes and self.context.processes > 1:
+            self.execute_parallel(self.context.processes)
+        elif self.context.prefetch and self.context.prefetch > 0:
+            self.execute_pipelined(self.context.prefetch)
+        else:
+            self.execute_sequentially()
+
 
 if __name__ == '__main__':
     gridmet = Gridmet()
-    gridmet.execute_sequentially()
+    gridmet.execute()
     print("All tasks have been executed")
@@ -0,0 +1,202 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Manifests of computed files.
+
+A manifest is stored next to the resulting file (`<file>.manifest`)
+and records what the file has been computed from: SHA-256 digests of
+the input files (netCDF, shapefile and its sidecar files, points),
+parameters of the computation and the version of the code. If none
+of them has changed, the computation can be skipped.
+
+Digests of large input files are computed only when their size or
+modification time differs from the one recorded in the manifest, so
+that checking an unchanged file is cheap, while a file that has been
+touched or downloaded again with the same content still matches.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+from typing import List, Dict, Optional
+
+
+BLOCK_SIZE = 1024 * 1024
+SHAPEFILE_EXTENSIONS = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+
+_code_version = None
+
+
+def code_version() -> str:
+    """
+    :return: Digest of the source code of the package
+    """
+
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256()
+        d = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(d, "*.py"))):
+            digest.update(os.path.basename(path).encode("utf-8"))
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def file_digest(path: str) -> str:
+    """
+    :param path: Path to a file
+    :return: SHA-256 digest of the file content
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def input_files(path: str) -> List[str]:
+    """
+    :param path: Path to an input file
+    :return: The file and, for a shapefile, all its existing
+        sidecar files
+    """
+
+    base, ext = os.path.splitext(path)
+    if ext.lower() != ".shp":
+        return [path]
+    return [
+        base + e for e in SHAPEFILE_EXTENSIONS if os.path.isfile(base + e)
+    ]
+
+
+class Manifest:
+    """
+    Record of inputs and parameters, from which resulting files
+    have been computed
+    """
+
+    def __init__(self, outputs: List[str], inputs: List[str],
+                 parameters: Dict):
+        """
+        :param outputs: Resulting files, the manifest is stored next
+            to the first one
+        :param inputs: Input files
+        :param parameters: JSON-serializable parameters of the
+            computation
+        """
+
+        self.outputs = outputs
+        self.path = outputs[0] + ".manifest"
+        self.inputs = [f for path in inputs for f in input_files(path)]
+        self.parameters = parameters
+        self.record: Optional[Dict] = None
+
+    def load(self) -> Optional[Dict]:
+        """
+        :return: Manifest saved by a previous computation or None
+        """
+
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            logging.warning("Ignoring corrupted manifest %s", self.path)
+            return None
+
+    def compute(self, previous: Optional[Dict] = None) -> Dict:
+        """
+        Fingerprints the inputs, parameters and code
+
+        :param previous: Previously saved manifest, its digests are
+            reused for files with the same size and modification time
+        :return: Manifest record
+        """
+
+        known = previous.get("inputs", dict()) if previous else dict()
+        inputs = dict()
+        for path in self.inputs:
+            stat = os.stat(path)
+            entry = known.get(os.path.abspath(path))
+            if not entry or entry["size"] != stat.st_size \
+                    or entry["mtime"] != stat.st_mtime_ns:
+                entry = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "sha256": file_digest(path)
+                }
+            inputs[os.path.abspath(path)] = entry
+        content = {
+            "inputs": [inputs[os.path.abspath(p)]["sha256"]
+                       for p in self.inputs],
+            "parameters": self.parameters,
+            "code": code_version()
+        }
+        fingerprint = hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return {
+            "fingerprint": fingerprint,
+            "inputs": inputs,
+            "parameters": self.parameters,
+            "code": content["code"]
+        }
+
+    def is_up_to_date(self) -> bool:
+        """
+        Checks whether all resulting files exist and have been
+        computed from the same inputs and parameters
+
+        :return: True if the computation can be skipped
+        """
+
+        previous = self.load()
+        self.record = self.compute(previous)
+        if previous is None:
+            return False
+        if not all(os.path.isfile(f) for f in self.outputs):
+            return False
+        return previous.get("fingerprint") == self.record["fingerprint"]
+
+    def invalidate(self):
+        """
+        Removes the manifest before the resulting files are overwritten
+        """
+
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def save(self):
+        """
+        Saves the manifest after the resulting files have been computed
+        """
+
+        if self.record is None:
+            self.record = self.compute()
+        tmp = self.path + ".tmp"
+        with open(tmp, "wt") as f:
+            json.dump(self.record, f, indent=2)
+        os.replace(tmp, self.path)
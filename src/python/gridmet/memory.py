@@ -0,0 +1,158 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Memory budget of compute tasks.
+
+The number of days read and aggregated at once is chosen so that the
+blocks of layers and the temporary arrays derived from them fit into
+the memory left under the limit by the process (e.g., after zonal
+weights have been built). Memory needed for a day is estimated per
+grid cell.
+"""
+
+import logging
+import re
+import resource
+import sys
+from typing import Optional, Union
+
+import psutil
+
+
+# Unpacked value (float64) and mask of a layer read from netCDF
+RAW_BYTES_PER_CELL = 9
+# Raw layer and the arrays of values and validity flags derived from it
+AGGREGATION_BYTES_PER_CELL = 40
+# Fraction of the limit that can be used, the rest is left for
+# the interpreter, fragmentation and estimation errors
+SAFETY = 0.8
+# Maximum number of days in a block chosen automatically
+AUTO_MAX_DAYS = 32
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value: Union[str, int, None]) -> Optional[int]:
+    """
+    :param value: Size in bytes, optionally with a unit:
+        K, M, G or T, e.g. "512M" or "16G"
+    :return: Number of bytes or None if the value is empty
+    """
+
+    if value is None or value == "":
+        return None
+    if isinstance(value, int):
+        return value
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:I?B)?\s*",
+                         str(value).upper())
+    if not match:
+        raise ValueError("Invalid memory size: " + str(value))
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def current_rss() -> int:
+    """
+    :return: Resident memory of the current process in bytes
+    """
+    return psutil.Process().memory_info().rss
+
+
+def peak_rss() -> int:
+    """
+    :return: Peak resident memory of the current process in bytes
+    """
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform != "darwin":
+        maxrss *= 1024
+    return max(maxrss, current_rss())
+
+
+def format_size(n: float) -> str:
+    return "{:.1f} MB".format(n / 1024 ** 2)
+
+
+class MemoryBudget:
+    """
+    Memory available to a task under a limit
+    """
+
+    def __init__(self, limit: int):
+        """
+        :param limit: Limit of resident memory of the process in bytes
+        """
+
+        self.limit = limit
+
+    def available(self) -> int:
+        """
+        :return: Bytes that can be allocated without exceeding the limit
+        """
+        return max(int(self.limit * SAFETY) - current_rss(), 0)
+
+    def day_block(self, bytes_per_day: int, maximum: int,
+                  chunk: int = 1) -> int:
+        """
+        Chooses the number of days to read and aggregate at once
+
+        :param bytes_per_day: Memory needed for a single day
+        :param maximum: Maximum number of days in a block
+        :param chunk: Number of days in a chunk of the netCDF variable,
+            a block larger than a chunk is rounded down to a multiple
+            of the chunk, so that chunks are not decompressed twice
+        :return: Number of days, at least 1
+        """
+
+        available = self.available()
+        n = int(available // max(bytes_per_day, 1))
+        block = max(min(n, maximum), 1)
+        if 1 < chunk <= block:
+            block -= block % chunk
+        if n < 1:
+            logging.warning("A single day needs %s, only %s of %s limit "
+                            "are available", format_size(bytes_per_day),
+                            format_size(available), format_size(self.limit))
+        else:
+            logging.info("Memory: %s available, %s per day, "
+                         "%d days per block", format_size(available),
+                         format_size(bytes_per_day), block)
+        return block
+
+    def fits(self, nbytes: int) -> bool:
+        """
+        :param nbytes: Size of an allocation
+        :return: True if the allocation leaves at least half of the
+            available memory for other data
+        """
+        return nbytes <= self.available() / 2
+
+    def report(self, name: str):
+        """
+        Logs peak resident memory of the process
+        """
+
+        peak = peak_rss()
+        if peak > self.limit:
+            logging.warning("%s: peak RSS %s exceeds the limit %s", name,
+                            format_size(peak), format_size(self.limit))
+        else:
+            logging.info("%s: peak RSS %s, limit %s", name,
+                         format_size(peak), format_size(self.limit))
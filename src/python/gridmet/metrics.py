@@ -0,0 +1,225 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Per-stage timing and throughput metrics of compute tasks.
+
+Every task accumulates time spent in the following stages:
+
+- read: reading layers from netCDF, including decompression
+- unpack: converting masked layers into values and validity flags
+- weights: building zonal weights (rasterization, disaggregation)
+- aggregate: computing means (or interpolating points)
+- serialize: formatting rows of the results
+- compress: writing serialized rows into a compressed stream
+- flush: writing serialized rows into an uncompressed stream,
+  flushing the output and saving checkpoints
+
+and counts cells read, geographies, rows and bytes written. Metrics
+are logged when a task completes and can be exported into a directory
+as a JSON summary and as a Prometheus textfile, that can be scraped
+by node exporter's textfile collector.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Union
+
+
+STAGES = ["read", "unpack", "weights", "aggregate", "serialize",
+          "compress", "flush"]
+COUNTERS = ["cells", "geographies", "rows", "bytes"]
+
+
+class Metrics:
+    """
+    Accumulates time per stage and counters of a single task.
+    Can be updated from several threads
+    """
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {s: 0.0 for s in STAGES}
+        self.counters: Dict[str, int] = {c: 0 for c in COUNTERS}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def set(self, name: str, n: int):
+        with self.lock:
+            self.counters[name] = int(n)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures time spent in the body of a `with` statement
+
+        :param name: Name of the stage
+        """
+
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def merge(self, other: "Metrics"):
+        """
+        Adds metrics collected by another process, computing a part
+        of the same task
+        """
+
+        for stage, seconds in other.seconds.items():
+            self.add(stage, seconds)
+        for name, n in other.counters.items():
+            if name in ("geographies", "peak_rss_bytes"):
+                self.set(name, max(n, self.counters.get(name, 0)))
+            else:
+                self.count(name, n)
+
+    def summary(self, labels: Dict[str, str],
+                total: Optional[float] = None) -> Dict:
+        """
+        :param labels: Labels identifying the task
+        :param total: Total wall time of the task in seconds
+        :return: JSON-serializable summary
+        """
+
+        summary = {
+            "labels": labels,
+            "seconds": {s: round(t, 6) for s, t in self.seconds.items()},
+            "counters": dict(self.counters)
+        }
+        if total is not None:
+            summary["total_seconds"] = round(total, 6)
+            if total > 0:
+                summary["rows_per_second"] = round(
+                    self.counters.get("rows", 0) / total, 1
+                )
+        return summary
+
+    def prometheus(self, labels: Dict[str, str],
+                   total: Optional[float] = None) -> str:
+        """
+        :param labels: Labels identifying the task
+        :param total: Total wall time of the task in seconds
+        :return: Metrics in Prometheus text exposition format
+        """
+
+        lines = [
+            "# HELP gridmet_stage_seconds Time spent by a task in a stage",
+            "# TYPE gridmet_stage_seconds gauge"
+        ]
+        for stage, seconds in self.seconds.items():
+            lines.append("gridmet_stage_seconds{} {:.6f}".format(
+                format_labels(labels, stage=stage), seconds
+            ))
+        lines += [
+            "# HELP gridmet_items Number of items processed by a task",
+            "# TYPE gridmet_items gauge"
+        ]
+        for name, n in self.counters.items():
+            lines.append("gridmet_items{} {:d}".format(
+                format_labels(labels, item=name), n
+            ))
+        if total is not None:
+            lines += [
+                "# HELP gridmet_task_seconds Total wall time of a task",
+                "# TYPE gridmet_task_seconds gauge",
+                "gridmet_task_seconds{} {:.6f}".format(
+                    format_labels(labels), total
+                )
+            ]
+        lines += [
+            "# HELP gridmet_task_completed_timestamp_seconds "
+            "Time when a task was completed",
+            "# TYPE gridmet_task_completed_timestamp_seconds gauge",
+            "gridmet_task_completed_timestamp_seconds{} {:.3f}".format(
+                format_labels(labels), time.time()
+            )
+        ]
+        return "\n".join(lines) + "\n"
+
+    def log(self, name: str, total: Optional[float] = None):
+        stages = ", ".join(
+            "{} {:.2f}s".format(s, t) for s, t in self.seconds.items()
+        )
+        counters = ", ".join(
+            "{} {:d}".format(c, n) for c, n in self.counters.items()
+        )
+        if total is not None:
+            logging.info("%s: total %.2fs, %s; %s", name, total, stages,
+                         counters)
+        else:
+            logging.info("%s: %s; %s", name, stages, counters)
+
+    def export(self, directory: str, name: str, labels: Dict[str, str],
+               total: Optional[float] = None):
+        """
+        Writes `<name>.json` and `<name>.prom` into the directory
+
+        :param directory: Destination directory
+        :param name: Name of the task, used as the file name
+        :param labels: Labels identifying the task
+        :param total: Total wall time of the task in seconds
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        write_atomically(path + ".json", json.dumps(
+            self.summary(labels, total), indent=2
+        ))
+        # node exporter may read the file while it is being written
+        write_atomically(path + ".prom", self.prometheus(labels, total))
+
+
+def format_labels(labels: Dict[str, str], **extra: Union[str, int]) -> str:
+    values = dict(labels)
+    values.update(extra)
+    return "{" + ",".join(
+        '{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+        )
+        for k, v in values.items()
+    ) + "}"
+
+
+def write_atomically(path: str, text: str):
+    tmp = "{}.{:d}.tmp".format(path, os.getpid())
+    with open(tmp, "wt") as f:
+        f.write(text)
+    os.replace(tmp, path)
@@ -0,0 +1,164 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Reading of day layers or blocks of days ahead of computations.
+
+Reading a layer from netCDF includes decompression and unpacking
+of the values, which can take as much time as aggregation. A reader
+thread reads the next layers into a bounded queue while the
+previous ones are being aggregated.
+"""
+
+import logging
+import queue
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, List, Tuple, Optional
+
+
+def get_chunk_days(variable) -> int:
+    """
+    :param variable: netCDF variable (days x lat x lon)
+    :return: Number of days in a chunk of the variable,
+        1 if the variable is not chunked
+    """
+
+    chunking = variable.chunking()
+    if isinstance(chunking, (list, tuple)) and len(chunking) > 0:
+        return max(int(chunking[0]), 1)
+    return 1
+
+
+def block_ranges(start: int, end: int, block: int,
+                 chunk: int = 1) -> List[Tuple[int, int]]:
+    """
+    Splits a range of days into blocks. If the block is larger than
+    a chunk of the variable, the block size is rounded down to a
+    multiple of the chunk and the blocks are aligned with the chunks,
+    so that every chunk is decompressed only once
+
+    :param start: Index of the first day
+    :param end: Index after the last day
+    :param block: Number of days in a block
+    :param chunk: Number of days in a chunk of the variable
+    :return: List of ranges (start, end)
+    """
+
+    block = max(block, 1)
+    if 1 < chunk <= block:
+        block -= block % chunk
+        first = min((start // chunk + 1) * chunk, end)
+        if (first - start) % chunk != 0:
+            ranges = [(start, first)]
+            start = first
+        else:
+            ranges = []
+    else:
+        ranges = []
+    for s in range(start, end, block):
+        ranges.append((s, min(s + block, end)))
+    return ranges
+
+
+class LayerReader:
+    """
+    Iterates over layers or blocks read by a given function, reading
+    ahead in a background thread. Also measures how long it takes to
+    read the data and how long the consumer has to wait for it
+    """
+
+    def __init__(self, read: Callable, ranges: List[Tuple[int, Optional[int]]],
+                 read_ahead: int = 0):
+        """
+        :param read: Function reading a layer or a block, taking two
+            arguments: start and end (None for a single layer)
+        :param ranges: List of (start, end) to read
+        :param read_ahead: Number of layers or blocks to read ahead,
+            0 means reading in the consumer thread
+        """
+
+        self.read = read
+        self.ranges = ranges
+        self.read_ahead = read_ahead
+        self.read_time = timedelta(0)
+        self.wait_time = timedelta(0)
+
+    def __iter__(self):
+        if self.read_ahead < 1:
+            for start, end in self.ranges:
+                t0 = datetime.now()
+                data = self.read(start, end)
+                t = datetime.now() - t0
+                self.read_time += t
+                self.wait_time += t
+                yield data
+            return
+
+        buffer = queue.Queue(maxsize=self.read_ahead)
+        stop = threading.Event()
+        reader = threading.Thread(target=self.produce, args=(buffer, stop),
+                                  name="layer-reader", daemon=True)
+        reader.start()
+        try:
+            for _ in self.ranges:
+                t0 = datetime.now()
+                data = buffer.get()
+                self.wait_time += datetime.now() - t0
+                if isinstance(data, BaseException):
+                    raise data
+                yield data
+        finally:
+            stop.set()
+            while reader.is_alive():
+                try:
+                    buffer.get_nowait()
+                except queue.Empty:
+                    pass
+                reader.join(0.1)
+
+    def produce(self, buffer: queue.Queue, stop: threading.Event):
+        try:
+            for start, end in self.ranges:
+                if stop.is_set():
+                    return
+                t0 = datetime.now()
+                data = self.read(start, end)
+                self.read_time += datetime.now() - t0
+                buffer.put(data)
+        except BaseException as x:
+            buffer.put(x)
+
+    def report(self, name: str, total: timedelta):
+        """
+        Logs time spent in every stage
+
+        :param name: Name of the task
+        :param total: Total time of the task
+        """
+
+        compute = total - self.wait_time
+        if self.read_time > timedelta(0):
+            overlap = 1 - self.wait_time / self.read_time
+        else:
+            overlap = 0
+        logging.info("%s: read %s, waiting for data %s, compute %s, "
+                     "total %s, overlap %.0f%%", name, str(self.read_time),
+                     str(self.wait_time), str(compute), str(total),
+                     100 * max(overlap, 0))
@@ -36,6 +36,9 @@ class Registry:
     the model to a designated path
     """
 
+    SCHEMA = "gridmet"
+    DATE_COLUMN = "observation_date"
+
     def __init__(self, destination:str):
         self.destination = destination
         init_logging()
@@ -45,8 +48,17 @@ class Registry:
             f.write(self.create_yaml())
         return
 
+    @staticmethod
+    def table_name(geography: str, band: str) -> str:
+        """
+        :param geography: Type of geography, e.g. "zip" or "county"
+        :param band: Gridmet band (variable)
+        :return: Name of the table (without schema)
+        """
+        return "{}_{}".format(geography, band)
+
     def create_yaml(self):
-        name = "gridmet"
+        name = self.SCHEMA
         domain = {
             name: {
                 "schema": name,
@@ -62,8 +74,8 @@ class Registry:
             for band in GridmetVariable:
                 bnd = band.value
                 geo = geography.value
-                date_column = "observation_date"
-                tname = "{}_{}".format(geo, bnd)
+                date_column = self.DATE_COLUMN
+                tname = self.table_name(geo, bnd)
                 table = {
                     "columns": [
                         {bnd: {
@@ -18,26 +18,43 @@
 #
 
 import csv
+import json
 import logging
 import os
+import shutil
+import tempfile
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from datetime import date, timedelta, datetime
 from enum import Enum
-from typing import List
+from typing import List, Optional, Tuple
 
+import numpy
+import requests
 from netCDF4._netCDF4 import Dataset
 from rasterstats.io import Raster
 from tqdm import tqdm
 
-from gridmet.config import GridmetVariable, GridmetContext, Shape
+from gridmet.config import GridmetVariable, GridmetContext, Shape, \
+    BandsLayout, OutputFormat, Compression
+from gridmet.bilinear import BilinearInterpolator
+from gridmet.collectors import Collector, CSVWriter, ListCollector, \
+    OutputOptions, open_collector, is_parquet
+from gridmet.download import ResumableDownload
+from gridmet.registry import Registry
+from gridmet.weights import ZonalWeights
 from gridmet.gridmet_tools import find_shape_file, get_nkn_url, get_variable, get_days, \
-    get_affine_transform, disaggregate
-from nsaph_gis.compute_shape import StatsCounter
+    get_affine_transform, get_window, shift_affine, NO_DATA
+from gridmet.geometry_cache import total_bounds
+from gridmet.manifest import Manifest
+from gridmet.memory import MemoryBudget, peak_rss, AUTO_MAX_DAYS, \
+    AGGREGATION_BYTES_PER_CELL, RAW_BYTES_PER_CELL
+from gridmet.metrics import Metrics
+from gridmet.prefetch import LayerReader, block_ranges, get_chunk_days
 from nsaph_gis.constants import Geography, RasterizationStrategy
 from nsaph_gis.geometry import PointInRaster
-from nsaph_utils.utils.io_utils import DownloadTask, fopen, as_stream
-
-NO_DATA = -999 # I do not know what it is, but not setting it causes a warning
+from nsaph_utils.utils.io_utils import DownloadTask, fopen
 
 
 def count_lines(f):
@@ -55,45 +72,6 @@ class Parallel(Enum):
     days = "days"
 
 
-class Collector(ABC):
-    def __init__(self):
-        pass
-
-    @abstractmethod
-    def writerow(self, data: List):
-        pass
-
-    def flush(self):
-        pass
-
-
-class CSVWriter(Collector):
-    def __init__(self, out_stream):
-        super().__init__()
-        self.out = out_stream
-        self.writer = csv.writer(out_stream,
-                                 delimiter=',',
-                                 quoting=csv.QUOTE_NONE)
-
-    def writerow(self, row: List):
-        self.writer.writerow(row)
-
-    def flush(self):
-        self.out.flush()
-
-
-class ListCollector(Collector):
-    def __init__(self):
-        super().__init__()
-        self.collection = []
-
-    def writerow(self, data: List):
-        self.collection.append(data)
-
-    def get_result(self):
-        return self.collection
-
-
 class ComputeGridmetTask(ABC):
     """
     An abstract class for a computational task that processes data in
@@ -104,7 +82,8 @@ class ComputeGridmetTask(ABC):
     origin = date(1900, 1, 1)
 
     def __init__(self, year: int, variable: GridmetVariable, infile: str,
-                 outfile: str, date_filter=None):
+                 outfile: str, date_filter=None, day_block: int = 1,
+                 workers: int = 1, read_ahead: int = 0):
         """
 
         :param date_filter:
@@ -112,6 +91,13 @@ class ComputeGridmetTask(ABC):
         :param variable: Gridemt band (variable)
         :param infile: File with source data in  NCDF4 format
         :param outfile: Resulting CSV file
+        :param day_block: Number of days to read and aggregate at once.
+            If greater than 1, the data is processed in "cube" mode, i.e.
+            as blocks of (days x lat x lon)
+        :param workers: Number of processes, computing ranges of days
+            in parallel
+        :param read_ahead: Number of layers (or blocks) to read in
+            background ahead of computations
         """
 
         self.year = year
@@ -124,6 +110,36 @@ class ComputeGridmetTask(ABC):
         self.variable = None
         self.parallel = {Parallel.points}
         self.date_filter = date_filter
+        self.day_block = day_block
+        self.workers = workers
+        self.read_ahead = read_ahead
+        if workers > 1:
+            self.parallel.add(Parallel.days)
+        self.window = None
+        '''Window (rows, columns) of the grid to read, None means
+        the whole grid'''
+        self.options = OutputOptions()
+        '''How the results are written, if `options.database` is set,
+        the results are copied into the table named by `outfile`'''
+        self.checkpoint_key = None
+        '''Fingerprint of the computation, set if checkpoints
+        are saved'''
+        self.incremental = False
+        '''If True, only days missing in the existing output file
+        are computed and appended to it'''
+        self.metrics = Metrics()
+        '''Time per stage and counters of the task'''
+        self.metrics_dir = None
+        '''Directory to export metrics, None means metrics are
+        only logged'''
+        self.memory_limit = None
+        '''Limit of resident memory in bytes, None means no limit'''
+
+    def __getstate__(self):
+        # netCDF dataset cannot be pickled, every process opens its own
+        state = self.__dict__.copy()
+        state["dataset"] = None
+        return state
 
     @classmethod
     def get_variable(cls, dataset: Dataset,  variable: GridmetVariable):
@@ -151,6 +167,33 @@ class ComputeGridmetTask(ABC):
         self.variable = self.get_variable(self.dataset, self.band)
         return days
 
+    def close(self):
+        """
+        Closes the netCDF dataset opened by `prepare()`
+        """
+
+        if self.dataset is not None:
+            self.dataset.close()
+            self.dataset = None
+
+    def read(self, start: int, end: int = None):
+        """
+        Reads a single layer or a block of layers within the window
+
+        :param start: Index of the (first) day in the dataset
+        :param end: If given, index after the last day of the block
+        :return: 2D layer (lat x lon) or 3D block (days x lat x lon)
+        """
+
+        rows, cols = self.window or (slice(None), slice(None))
+        with self.metrics.stage("read"):
+            if end is None:
+                data = self.dataset[self.variable][start, rows, cols]
+            else:
+                data = self.dataset[self.variable][start:end, rows, cols]
+        self.metrics.count("cells", data.size)
+        return data
+
     def execute(self, mode: str = "wt"):
         """
         Executes computational task
@@ -160,27 +203,465 @@ class ComputeGridmetTask(ABC):
         :return:
         """
 
+        t0 = datetime.now()
         days = self.prepare()
 
-        with fopen(self.outfile, mode) as out:
-            writer = CSVWriter(out)
-            if 'a' not in mode:
-                writer.writerow([self.band.value, "date", self.get_key().lower()])
-            self.collect_data(days, writer)
+        start = self.get_start(days)
+        if start > 0:
+            mode = "at"
+        with open_collector(self.outfile, mode, self.header(),
+                            options=self.options,
+                            metrics=self.metrics) as writer:
+            if Parallel.days in self.parallel and start == 0:
+                self.collect_data_parallel(days, writer)
+            else:
+                self.collect(days[start:], writer, start)
+        self.complete(days, datetime.now() - t0)
+
+    def get_start(self, days: List) -> int:
+        """
+        Finds the first day to compute: after the last checkpoint of
+        an interrupted execution or, in incremental mode, after the
+        days already contained in the output file
+
+        :param days: list of days to process
+        :return: index of the first day, 0 if all days have
+            to be computed
+        """
+
+        start = 0
+        if Parallel.days not in self.parallel:
+            start = self.resume(days)
+        if start == 0 and self.incremental:
+            start = self.incremental_start(days)
+        return start
 
-    def collect_data(self, days: List, collector: Collector):
+    def complete(self, days: List, total: timedelta):
+        """
+        Removes the checkpoint, updates the index of the output file
+        in incremental mode and reports metrics after all days
+        have been written
+
+        :param days: list of days contained in the output
+        :param total: Total time of the task
+        """
+
+        if os.path.isfile(self.checkpoint_file()):
+            os.remove(self.checkpoint_file())
+        if self.incremental and self.is_file_output():
+            self.write_index(days)
+        self.report_metrics(total)
+
+    def metrics_name(self) -> str:
+        """
+        :return: Name identifying the task in exported metrics
+        """
+        if self.options.database:
+            return "{}_{:d}".format(self.outfile.replace(".", "_"),
+                                    self.year)
+        return os.path.basename(self.outfile).split(".")[0]
+
+    def metrics_labels(self) -> dict:
+        return {
+            "task": self.metrics_name(),
+            "band": self.band.value,
+            "year": str(self.year)
+        }
+
+    def report_metrics(self, total: timedelta):
+        """
+        Logs metrics of the task and exports them if `metrics_dir`
+        is set
+
+        :param total: Total time of the task
+        """
+
+        if self.is_file_output() and os.path.isfile(self.outfile):
+            self.metrics.set("file_bytes", os.path.getsize(self.outfile))
+        self.metrics.set("peak_rss_bytes", peak_rss())
+        budget = self.memory_budget()
+        if budget is not None:
+            budget.report(self.metrics_name())
+        seconds = total.total_seconds()
+        self.metrics.log(self.metrics_name(), seconds)
+        if self.metrics_dir:
+            self.metrics.export(self.metrics_dir, self.metrics_name(),
+                                self.metrics_labels(), seconds)
+
+    def is_file_output(self) -> bool:
+        """
+        :return: True if the results are written into a CSV file,
+            that can be appended
+        """
+        return not self.options.database and not is_parquet(self.outfile)
+
+    def index_file(self) -> str:
+        return self.outfile + ".dates"
+
+    def read_index(self) -> Optional[dict]:
+        """
+        :return: Index of the output file: dates contained in the file
+            and the size of the file, None if there is no index
+        """
+
+        if not os.path.isfile(self.index_file()):
+            return None
+        with open(self.index_file()) as f:
+            return json.load(f)
+
+    def write_index(self, days: List):
+        """
+        Records dates contained in the output file after the task has
+        been successfully executed
+
+        :param days: list of days contained in the file
+        """
+
+        index = self.read_index()
+        dates = set(index["dates"]) if index else set()
+        dates.update(self.to_date(day).isoformat() for day in days)
+        tmp = self.index_file() + ".tmp"
+        with open(tmp, "wt") as f:
+            json.dump({
+                "dates": sorted(dates),
+                "offset": os.path.getsize(self.outfile)
+            }, f)
+        os.replace(tmp, self.index_file())
+
+    def is_up_to_date(self) -> bool:
+        """
+        :return: True if the task is incremental and its output file
+            has been indexed, i.e., if the input file has not changed,
+            there is nothing to compute
+        """
+        return self.incremental and self.is_file_output() \
+            and os.path.isfile(self.outfile) \
+            and self.read_index() is not None
+
+    def incremental_start(self, days: List) -> int:
+        """
+        Finds days, that are already contained in the output file,
+        according to its index. New days are expected to follow them.
+        Truncates the output file to the size recorded in the index,
+        discarding data written by an interrupted execution
+
+        :param days: list of days to process
+        :return: index of the first new day, 0 if all days have
+            to be computed
+        """
+
+        if not self.is_file_output():
+            logging.warning("Incremental mode is supported only for "
+                            "CSV files, computing all days")
+            return 0
+        index = self.read_index()
+        if index is None or not os.path.isfile(self.outfile) or \
+                os.path.getsize(self.outfile) < index["offset"]:
+            return 0
+        dates = set(index["dates"])
+        start = 0
+        while start < len(days) and \
+                self.to_date(days[start]).isoformat() in dates:
+            start += 1
+        if any(self.to_date(day).isoformat() in dates
+               for day in days[start:]):
+            logging.warning("New days in %s are not contiguous, "
+                            "computing all days", self.infile)
+            return 0
+        if start > 0:
+            with open(self.outfile, "r+b") as f:
+                f.truncate(index["offset"])
+        logging.info("%s: %d days are up to date, %d new days",
+                     self.outfile, start, len(days) - start)
+        return start
+
+    def checkpoint_file(self) -> str:
+        return self.outfile + ".checkpoint"
+
+    def fingerprint(self, days: List) -> dict:
+        """
+        Identifies the computation saved in a checkpoint
+
+        :param days: list of days to process
+        :return: JSON-serializable dictionary
+        """
+
+        stat = os.stat(self.infile)
+        return {
+            "infile": os.path.abspath(self.infile),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "header": self.header(),
+            "days": len(days),
+            "first": float(days[0]) if len(days) > 0 else None,
+            "last": float(days[-1]) if len(days) > 0 else None
+        }
+
+    def resume(self, days: List) -> int:
+        """
+        Looks for a checkpoint left by an interrupted execution of
+        this task. If found, truncates the output file to the offset
+        saved in the checkpoint
+
+        :param days: list of days to process
+        :return: index of the first day, that has to be computed
+        """
+
+        if not self.options.resumable:
+            return 0
+        self.checkpoint_key = self.fingerprint(days)
+        path = self.checkpoint_file()
+        if not os.path.isfile(path):
+            return 0
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("fingerprint") != self.checkpoint_key:
+            logging.warning("Checkpoint %s does not match the input, "
+                            "starting from the first day", path)
+            return 0
+        offset = checkpoint["offset"]
+        if not os.path.isfile(self.outfile) or \
+                os.path.getsize(self.outfile) < offset:
+            logging.warning("%s is shorter than checkpoint, starting "
+                            "from the first day", self.outfile)
+            return 0
+        with open(self.outfile, "r+b") as f:
+            f.truncate(offset)
+        day = checkpoint["day"]
+        logging.info("Resuming %s from day %d of %d", self.outfile,
+                     day + 1, len(days))
+        return day
+
+    def save_checkpoint(self, collector: Collector, day: int):
+        """
+        Writes collected data to the output file and records in the
+        checkpoint sidecar file the size of the output file
+
+        :param collector: collector for the results
+        :param day: index of the first day, that has not been collected
+        """
+
+        if self.checkpoint_key is None:
+            return
+        offset = collector.checkpoint()
+        if offset is None:
+            return
+        path = self.checkpoint_file()
+        tmp = path + ".tmp"
+        with open(tmp, "wt") as f:
+            json.dump({
+                "fingerprint": self.checkpoint_key,
+                "day": day,
+                "offset": offset
+            }, f)
+        os.replace(tmp, path)
+
+    def manifest(self) -> Optional[Manifest]:
+        """
+        :return: Manifest of the resulting file, None if the results
+            are copied into a database
+        """
+        if self.options.database:
+            return None
+        return Manifest([self.outfile], self.input_files(),
+                        self.parameters())
+
+    def input_files(self) -> List[str]:
+        return [self.infile]
+
+    def parameters(self) -> dict:
+        """
+        :return: Parameters of the computation affecting the results
+        """
+        return {
+            "task": type(self).__name__,
+            "year": self.year,
+            "band": self.band.value,
+            "dates": str(self.date_filter) if self.date_filter else None,
+            "header": self.header(),
+            "precision": self.options.precision
+        }
+
+    def header(self) -> List[str]:
+        return [self.band.value, "date", self.get_key().lower()]
+
+    def memory_budget(self) -> Optional[MemoryBudget]:
+        """
+        :return: Memory budget of the process executing the task,
+            None if memory is not limited
+        """
+
+        if not self.memory_limit:
+            return None
+        if Parallel.days in self.parallel:
+            return MemoryBudget(self.memory_limit // max(self.workers, 1))
+        return MemoryBudget(self.memory_limit)
+
+    def window_cells(self) -> int:
+        """
+        :return: Number of grid cells in a layer read by `read()`
+        """
+
+        shape = self.dataset[self.variable].shape
+        rows, cols = self.window or (slice(None), slice(None))
+        return len(range(*rows.indices(shape[1]))) \
+            * len(range(*cols.indices(shape[2])))
+
+    def get_day_block(self, bytes_per_day: Optional[int] = None) -> int:
+        """
+        Returns the number of days to read and process at once. If
+        memory is limited, `day_block` (or, if it is 1, `AUTO_MAX_DAYS`)
+        is reduced so that the blocks fit into the memory budget
+
+        :param bytes_per_day: Memory needed for a single day, by
+            default estimated for aggregation over shapes
+        :return: Number of days in a block
+        """
+
+        budget = self.memory_budget()
+        if budget is None:
+            return self.day_block
+        if bytes_per_day is None:
+            bytes_per_day = self.window_cells() * (
+                AGGREGATION_BYTES_PER_CELL
+                + RAW_BYTES_PER_CELL * self.read_ahead
+            )
+        maximum = self.day_block if self.day_block > 1 else AUTO_MAX_DAYS
+        return budget.day_block(bytes_per_day, maximum,
+                                get_chunk_days(self.dataset[self.variable]))
+
+    def collect(self, days: List, collector: Collector, offset: int = 0):
+        """
+        Computes statistics for the given days, either day by day
+        or in blocks of days, depending on `day_block` and the
+        memory limit
+
+        :param days: list of days to process
+        :param collector: collector for the results
+        :param offset: index of the first day in the dataset
+        :return: collector
+        """
+
+        day_block = self.get_day_block()
+        if day_block > 1:
+            return self.collect_data_in_blocks(days, collector, offset,
+                                               day_block)
+        return self.collect_data(days, collector, offset)
+
+    def collect_data_parallel(self, days: List, collector: Collector):
+        """
+        Splits days into contiguous ranges and computes them in
+        parallel processes. Every process writes its results
+        into a temporary file, these files are then appended to the
+        collector in the order of dates, so the result is the same
+        as produced by sequential processing
+
+        :param days: list of days to process
+        :param collector: collector for the results
+        :return: None
+        """
+
+        n = min(self.workers, len(days))
+        bounds = [len(days) * i // n for i in range(n + 1)]
+        if self.options.database:
+            d = None
+        else:
+            d = os.path.dirname(os.path.abspath(self.outfile))
+        tmp = tempfile.mkdtemp(dir=d, prefix=".parts_")
+        ext = ".parquet" if is_parquet(self.outfile) else ".csv"
+        try:
+            with ProcessPoolExecutor(max_workers=n) as executor:
+                futures = [
+                    executor.submit(
+                        compute_day_range, self, bounds[i], bounds[i + 1],
+                        os.path.join(tmp, "{:d}{}".format(i, ext))
+                    )
+                    for i in range(n)
+                ]
+                for future in futures:
+                    path, metrics = future.result()
+                    self.metrics.merge(metrics)
+                    with self.metrics.stage("flush"):
+                        collector.append_file(path)
+                        collector.flush()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def collect_data(self, days: List, collector: Collector,
+                     offset: int = 0):
         t0 = datetime.now()
-        for idx in range(len(days)):
+        reader = LayerReader(
+            self.read,
+            [(offset + idx, None) for idx in range(len(days))],
+            self.read_ahead
+        )
+        for idx, layer in enumerate(reader):
             day = days[idx]
-            layer = self.dataset[self.variable][idx, :, :]
             t1 = datetime.now()
             self.compute_one_day(collector, day, layer)
-            collector.flush()
+            with self.metrics.stage("flush"):
+                collector.flush()
+                self.save_checkpoint(collector, offset + idx + 1)
             t3 = datetime.now()
             t = datetime.now() - t0
             logging.info(" \t{} [{}]".format(str(t3 - t1), str(t)))
+        reader.report(str(self.band.value), datetime.now() - t0)
         return collector
 
+    def collect_data_in_blocks(self, days: List, collector: Collector,
+                               offset: int = 0,
+                               day_block: Optional[int] = None):
+        """
+        Same as `collect_data()` but reads the variable as blocks
+        of `day_block` days (days x lat x lon) and aggregates every
+        block at once. Blocks are aligned with the chunks of the
+        variable
+
+        :param days: list of days to process
+        :param collector: collector for the results
+        :param offset: index of the first day in the dataset
+        :param day_block: number of days in a block, by default
+            `self.day_block`
+        :return: collector
+        """
+
+        t0 = datetime.now()
+        chunk = get_chunk_days(self.dataset[self.variable])
+        ranges = block_ranges(offset, offset + len(days),
+                              day_block or self.day_block, chunk)
+        reader = LayerReader(self.read, ranges, self.read_ahead)
+        for (start, end), block in zip(ranges, reader):
+            start -= offset
+            end -= offset
+            t1 = datetime.now()
+            self.compute_block(collector, days[start:end], block)
+            with self.metrics.stage("flush"):
+                collector.flush()
+                self.save_checkpoint(collector, offset + end)
+            t3 = datetime.now()
+            t = datetime.now() - t0
+            logging.info("%s:%s - %s \t%s [%s]", self.band.value,
+                         self.to_date(days[start]),
+                         self.to_date(days[end - 1]), str(t3 - t1), str(t))
+        reader.report(str(self.band.value), datetime.now() - t0)
+        return collector
+
+    def compute_block(self, writer: Collector, days: List, block):
+        """
+        Computes required statistics for a block of days.
+        Default implementation calls `compute_one_day()` for every
+        day in the block, subclasses can override it with a
+        vectorized implementation
+
+        :param writer: CSV Writer to output the result
+        :param days: days in the block
+        :param block: 3D array (days x lat x lon)
+        :return: Nothing
+        """
+
+        for idx in range(len(days)):
+            self.compute_one_day(writer, days[idx], block[idx, :, :])
+
     @abstractmethod
     def compute_one_day(self, writer: Collector, day, layer):
         """
@@ -200,6 +681,29 @@ class ComputeGridmetTask(ABC):
         return self.origin + timedelta(days=day)
 
 
+def compute_day_range(task: ComputeGridmetTask, start: int, end: int,
+                      path: str) -> Tuple[str, Metrics]:
+    """
+    Computes a range of days of a task in a worker process
+
+    :param task: Compute task
+    :param start: Index of the first day to compute
+    :param end: Index after the last day to compute
+    :param path: Temporary file to write the results
+    :return: path to the file with the results and metrics of
+        the computation
+    """
+
+    # the task has been copied with the metrics of its parent
+    task.metrics = Metrics()
+    days = task.prepare()
+    with open_collector(path, "wt", task.header(),
+                        options=task.options.for_parts(),
+                        metrics=task.metrics) as writer:
+        task.collect(days[start:end], writer, start)
+    return path, task.metrics
+
+
 class ComputeShapesTask(ComputeGridmetTask):
     """
     Class describes a compute task to aggregate data over geography shapes
@@ -210,10 +714,16 @@ class ComputeShapesTask(ComputeGridmetTask):
 
     def __init__(self, year: int, variable: GridmetVariable, infile: str,
                  outfile: str, strategy: RasterizationStrategy, shapefile: str,
-                 geography: Geography, date_filter=None):
+                 geography: Geography, date_filter=None, day_block: int = 1,
+                 workers: int = 1, geometry_cache: str = None,
+                 read_ahead: int = 0):
         """
 
         :param date_filter:
+        :param day_block: Number of days to aggregate at once
+        :param read_ahead: Number of layers (or blocks) to read in
+            background ahead of computations
+        :param workers: Number of processes, computing ranges of days
         :param year: year
         :param variable: Gridemt band (variable)
         :param infile: File with source data in  NCDF4 format
@@ -221,9 +731,12 @@ class ComputeShapesTask(ComputeGridmetTask):
         :param strategy: Rasterization strategy to use
         :param shapefile: Shapefile for used collection of geographies
         :param geography: Type of geography, e.g. zip code or county
+        :param geometry_cache: Optional directory with cached geometries
+            of shapefiles
         """
 
-        super().__init__(year, variable, infile, outfile, date_filter)
+        super().__init__(year, variable, infile, outfile, date_filter,
+                         day_block, workers, read_ahead)
 
         if strategy == RasterizationStrategy.downscale:
             self.factor = 5
@@ -231,20 +744,131 @@ class ComputeShapesTask(ComputeGridmetTask):
         self.strategy = strategy
         self.shapefile = shapefile
         self.geography = geography
+        self.geometry_cache = geometry_cache
+
+        self.weights = None
 
     def get_key(self):
         return self.geography.value.upper()
 
+    def input_files(self) -> List[str]:
+        return [self.infile, self.shapefile]
+
+    def parameters(self) -> dict:
+        parameters = super().parameters()
+        parameters["strategy"] = self.strategy.value
+        parameters["geography"] = self.geography.value
+        return parameters
+
+    def prepare(self):
+        days = super().prepare()
+        if self.window is None:
+            self.set_window()
+        return days
+
+    def set_window(self):
+        """
+        Restricts reading of the data to the bounding box of the shapes,
+        so that regional collections of shapes (e.g., a single state)
+        read and aggregate only a small part of the grid
+        """
+
+        bounds = total_bounds(self.shapefile, self.geometry_cache)
+        shape2d = self.dataset[self.variable].shape[1:]
+        window = None
+        if bounds is not None:
+            window = get_window(self.affine, shape2d, bounds, self.factor)
+        if window is None:
+            self.window = (slice(None), slice(None))
+            return
+        self.window = window
+        self.affine = shift_affine(self.affine, window, self.factor)
+        rows, cols = window
+        logging.info("Reading rows %d:%d, columns %d:%d of %s grid",
+                     rows.start, rows.stop, cols.start, cols.stop,
+                     "x".join(str(n) for n in shape2d))
+
+    def get_weights(self, layer) -> ZonalWeights:
+        """
+        Returns sparse weight matrix mapping grid cells to the
+        geographies. The matrix is built once per shapefile, grid and
+        strategy and is reused for all days (and bands)
+
+        :param layer: a layer of data at the native resolution
+        :return: Zonal weights
+        """
+
+        if self.weights is None:
+            with self.metrics.stage("weights"):
+                self.weights = ZonalWeights.get(
+                    self.strategy, self.shapefile, self.affine, layer,
+                    self.factor, self.geometry_cache
+                )
+            self.metrics.set("geographies", len(self.weights.keys))
+        return self.weights
+
+    def metrics_labels(self) -> dict:
+        labels = super().metrics_labels()
+        labels["geography"] = self.geography.value
+        labels["strategy"] = self.strategy.value
+        return labels
+
+    def aggregate(self, weights: ZonalWeights, data) -> numpy.ndarray:
+        """
+        Computes means of a layer or a block of layers, measuring
+        time of unpacking and aggregation
+
+        :param weights: Zonal weights
+        :param data: A 2D layer or a 3D block of layers
+        :return: Array of means, see `ZonalWeights.compute()`
+        """
+
+        with self.metrics.stage("unpack"):
+            values, valid = weights.split(data)
+        with self.metrics.stage("aggregate"):
+            means = weights.aggregate(values, valid)
+        self.metrics.count("rows", means.size)
+        return means
+
+    def collect_data_parallel(self, days: List, collector: Collector):
+        # build weights once, they are passed to the worker processes
+        if len(days) > 0:
+            self.get_weights(self.read(0))
+        super().collect_data_parallel(days, collector)
+
+    def collect(self, days: List, collector: Collector, offset: int = 0):
+        if self.memory_limit and len(days) > 0:
+            # weights take memory, blocks are sized after they are built
+            self.get_weights(self.read(offset))
+        return super().collect(days, collector, offset)
+
     def compute_one_day(self, writer: Collector, day, layer):
         dt = self.to_date(day)
 
-        if self.factor > 1:
-            layer = disaggregate(layer, self.factor)
-
         logging.info("%s:%s:%s", self.geography.value, self.band.value, dt)
 
-        for record in StatsCounter.process(self.strategy, self.shapefile, self.affine, layer):
-            writer.writerow([record.mean, dt.strftime("%Y-%m-%d"), record.prop])
+        weights = self.get_weights(layer)
+        date_str = dt.strftime("%Y-%m-%d")
+        writer.write_columns(self.aggregate(weights, layer), date_str,
+                             weights.keys)
+
+    def compute_block(self, writer: Collector, days: List, block):
+        weights = self.get_weights(block[0, :, :])
+        self.write_block(writer, days, self.aggregate(weights, block))
+
+    def write_block(self, writer: Collector, days: List, means):
+        """
+        Outputs means computed for a block of days
+
+        :param writer: CSV Writer to output the result
+        :param days: days in the block
+        :param means: 2D array of means (geographies x days)
+        :return: Nothing
+        """
+
+        for idx in range(len(days)):
+            date_str = self.to_date(days[idx]).strftime("%Y-%m-%d")
+            writer.write_columns(means[:, idx], date_str, self.weights.keys)
 
 
 class ComputePointsTask(ComputeGridmetTask):
@@ -256,6 +880,9 @@ class ComputePointsTask(ComputeGridmetTask):
     """
 
     force_standard_api = False
+    """If True, every point is interpolated individually by
+    `PointInRaster`, otherwise all points are interpolated at once by
+    `BilinearInterpolator`"""
 
     def __init__(self, year: int,
                  variable: GridmetVariable,
@@ -264,7 +891,9 @@ class ComputePointsTask(ComputeGridmetTask):
                  points_file:str,
                  coordinates: List,
                  metadata: List,
-                 date_filter=None):
+                 date_filter=None,
+                 day_block: int = 1,
+                 read_ahead: int = 0):
         """
 
         :param year: year
@@ -277,9 +906,13 @@ class ComputePointsTask(ComputeGridmetTask):
             corresponding to coordinates
         :param metadata: A list of column names in csv that should be
             interpreted as metadata (e.g. ZIP, site_id, etc.)
+        :param day_block: Number of days to read and interpolate at once
+        :param read_ahead: Number of blocks to read in background
+            ahead of interpolation
         """
 
-        super().__init__(year, variable, infile, outfile, date_filter)
+        super().__init__(year, variable, infile, outfile, date_filter,
+                         day_block, read_ahead=read_ahead)
         self.points_file = points_file
 
         assert len(coordinates) == 2
@@ -290,6 +923,15 @@ class ComputePointsTask(ComputeGridmetTask):
     def get_key(self):
         return self.metadata[0]
 
+    def input_files(self) -> List[str]:
+        return [self.infile, self.points_file]
+
+    def parameters(self) -> dict:
+        parameters = super().parameters()
+        parameters["coordinates"] = list(self.coordinates)
+        parameters["metadata"] = list(self.metadata)
+        return parameters
+
     def prepare(self):
         ret = super().prepare()
 
@@ -306,7 +948,113 @@ class ComputePointsTask(ComputeGridmetTask):
         point = PointInRaster(self.first_layer, self.affine, x, y)
         return point
 
+    def read_points(self) -> List:
+        with fopen(self.points_file, "r") as points_file:
+            reader = csv.DictReader(points_file)
+            return [row for row in reader]
+
+    def rasters_fit(self) -> bool:
+        """
+        :return: False if rasters of all days, that are held in memory
+            by `execute_per_point()`, exceed the memory budget
+        """
+
+        budget = self.memory_budget()
+        if budget is None:
+            return True
+        with Dataset(self.infile) as dataset:
+            shape = dataset[self.get_variable(dataset, self.band)].shape
+        nbytes = shape[0] * shape[1] * shape[2] * RAW_BYTES_PER_CELL
+        if budget.fits(nbytes):
+            return True
+        logging.warning("Rasters for %d days do not fit into memory "
+                        "limit, using vectorized interpolation", shape[0])
+        return False
+
     def execute(self, mode: str = "w") -> None:
+        """
+        Interpolates values for all points and days and writes them
+        point by point, i.e. all days of a point are written together.
+        Therefore, the resulting file is always written from scratch,
+        checkpoints are not saved.
+
+        :param mode: mode to use opening result file, appending is
+            not supported
+        :return: None
+        """
+
+        if 'a' in mode or self.incremental:
+            raise ValueError("Incremental mode and appending are not "
+                             "supported for points, results are written "
+                             "point by point: " + self.outfile)
+        if self.options.resumable:
+            raise ValueError("Checkpoints and resuming are not supported "
+                             "for points, results are written point by "
+                             "point: " + self.outfile)
+        if self.force_standard_api and self.rasters_fit():
+            return self.execute_per_point(mode)
+        started = datetime.now()
+        days = self.prepare()
+
+        logging.info("Read points")
+        rows = self.read_points()
+        x = numpy.array([float(row[self.coordinates[0]]) for row in rows])
+        y = numpy.array([float(row[self.coordinates[1]]) for row in rows])
+        interpolator = BilinearInterpolator(
+            self.affine, self.first_layer.shape, x, y
+        )
+        # like `PointInRaster`, points with masked neighbors are kept,
+        # they get values of the nearest neighbors
+        selected = numpy.nonzero(interpolator.inside)[0]
+        logging.info("%d points, %d inside the grid",
+                     len(rows), len(selected))
+        interpolator = BilinearInterpolator(
+            self.affine, self.first_layer.shape, x[selected], y[selected]
+        )
+
+        logging.info("Interpolate")
+        shape = (len(selected), len(days))
+        budget = self.memory_budget()
+        if budget is None or budget.fits(shape[0] * shape[1] * 8):
+            values = numpy.empty(shape, dtype=numpy.float64)
+        else:
+            logging.info("Interpolated values are stored in a "
+                         "temporary file")
+            values = numpy.memmap(tempfile.TemporaryFile(),
+                                  dtype=numpy.float64, mode="w+",
+                                  shape=shape)
+        t0 = datetime.now()
+        chunk = get_chunk_days(self.dataset[self.variable])
+        # interpolation needs 4 neighbours and weights for every point
+        day_block = self.get_day_block(
+            self.window_cells() * RAW_BYTES_PER_CELL * (1 + self.read_ahead)
+            + len(selected) * 80
+        )
+        ranges = block_ranges(0, len(days), day_block, chunk)
+        reader = LayerReader(self.read, ranges, self.read_ahead)
+        for (start, end), block in tqdm(zip(ranges, reader),
+                                        total=len(ranges)):
+            with self.metrics.stage("aggregate"):
+                values[:, start:end] = interpolator.interpolate(block)
+        reader.report(str(self.band.value), datetime.now() - t0)
+        self.metrics.set("geographies", len(selected))
+
+        logging.info("Write results")
+        dates = [str(self.to_date(day)) for day in days]
+        with open_collector(self.outfile, "wt", self.header(),
+                            numeric_ids=False,
+                            options=self.options,
+                            metrics=self.metrics) as writer:
+            for n, i in enumerate(selected):
+                metadata = [rows[i][p] for p in self.metadata]
+                writer.write_columns(values[n], dates, *metadata)
+                if n % 10_000 == 0:
+                    with self.metrics.stage("flush"):
+                        writer.flush()
+        self.metrics.count("rows", values.size)
+        self.report_metrics(datetime.now() - started)
+
+    def execute_per_point(self, mode: str = "w") -> None:
         days = self.prepare()
 
         logging.info("Prepare rasters")
@@ -343,13 +1091,234 @@ class ComputePointsTask(ComputeGridmetTask):
         pass
 
 
+class ComputeBandsTask:
+    """
+    Class describes a compute task to aggregate several bands for the
+    same year over the same geography shapes in a single pass.
+
+    The shapes are rasterized once, and for every block of days,
+    all bands are read and aggregated before moving to the next block.
+    The result is either written to a separate file per band (the
+    same files as would be produced by `ComputeShapesTask`) or to a
+    single "wide" file with one column per band.
+    """
+
+    def __init__(self, year: int, variables: List[GridmetVariable],
+                 infiles: List[str], outfiles: List[str],
+                 strategy: RasterizationStrategy, shapefile: str,
+                 geography: Geography, date_filter=None, day_block: int = 1,
+                 wide_file: str = None, geometry_cache: str = None,
+                 read_ahead: int = 0):
+        """
+
+        :param year: year
+        :param variables: Gridmet bands (variables)
+        :param infiles: Files with source data in NCDF4 format, one
+            per band
+        :param outfiles: Resulting CSV files, one per band, ignored if
+            `wide_file` is given
+        :param strategy: Rasterization strategy to use
+        :param shapefile: Shapefile for used collection of geographies
+        :param geography: Type of geography, e.g. zip code or county
+        :param date_filter:
+        :param day_block: Number of days to aggregate at once
+        :param wide_file: Optional resulting CSV file with a column
+            for every band
+        :param geometry_cache: Optional directory with cached geometries
+            of shapefiles
+        :param read_ahead: Number of blocks to read in background
+            ahead of computations
+        """
+
+        assert len(variables) == len(infiles) == len(outfiles)
+        self.year = year
+        self.tasks = [
+            ComputeShapesTask(year, variables[i], infiles[i], outfiles[i],
+                              strategy, shapefile, geography, date_filter,
+                              day_block, geometry_cache=geometry_cache)
+            for i in range(len(variables))
+        ]
+        self.day_block = max(day_block, 1)
+        self.read_ahead = read_ahead
+        self.wide_file = wide_file
+        self.options = OutputOptions()
+        self.metrics = Metrics()
+        '''Time per stage and counters, shared by all bands'''
+        for task in self.tasks:
+            task.metrics = self.metrics
+        self.metrics_dir = None
+        self.memory_limit = None
+
+    def prepare(self):
+        days = None
+        affine = None
+        for task in self.tasks:
+            d = task.prepare()
+            if days is None:
+                days, affine = d, task.affine
+            elif list(d) != list(days) or task.affine != affine:
+                raise Exception("Files for different bands do not match: "
+                                + task.infile)
+        return days
+
+    def manifest(self) -> Optional[Manifest]:
+        """
+        :return: Manifest of the resulting files, None if the results
+            are copied into a database
+        """
+        if self.options.database:
+            return None
+        if self.wide_file:
+            outputs = [self.wide_file]
+        else:
+            outputs = [task.outfile for task in self.tasks]
+        task = self.tasks[0]
+        inputs = [t.infile for t in self.tasks] + [task.shapefile]
+        parameters = {
+            "task": type(self).__name__,
+            "year": self.year,
+            "bands": [t.band.value for t in self.tasks],
+            "dates": str(task.date_filter) if task.date_filter else None,
+            "strategy": task.strategy.value,
+            "geography": task.geography.value,
+            "wide": bool(self.wide_file),
+            "precision": self.options.precision
+        }
+        return Manifest(outputs, inputs, parameters)
+
+    def execute(self, mode: str = "wt"):
+        """
+        Executes computational task
+
+        :param mode: mode to use opening result files
+        :type mode: str
+        :return:
+        """
+
+        if self.options.resumable:
+            raise ValueError("Checkpoints and resuming are not supported "
+                             "for several bands in a single pass")
+        t0 = datetime.now()
+        days = self.prepare()
+        if self.wide_file:
+            outfiles = [self.wide_file]
+        else:
+            outfiles = [task.outfile for task in self.tasks]
+
+        if self.wide_file:
+            headers = [
+                [task.band.value for task in self.tasks]
+                + ["date", self.tasks[0].get_key().lower()]
+            ]
+        else:
+            headers = [task.header() for task in self.tasks]
+
+        with ExitStack() as stack:
+            writers = [
+                stack.enter_context(open_collector(outfile, mode, header,
+                                                   options=self.options,
+                                                   metrics=self.metrics))
+                for outfile, header in zip(outfiles, headers)
+            ]
+            self.collect_data(days, writers)
+        self.report_metrics(datetime.now() - t0)
+
+    def report_metrics(self, total: timedelta):
+        """
+        Logs metrics of the task and exports them if `metrics_dir`
+        is set
+
+        :param total: Total time of the task
+        """
+
+        task = self.tasks[0]
+        bands = "_".join(t.band.value for t in self.tasks)
+        name = "{}_{}_{:d}".format(bands, task.geography.value, self.year)
+        self.metrics.set("peak_rss_bytes", peak_rss())
+        if self.memory_limit:
+            MemoryBudget(self.memory_limit).report(name)
+        seconds = total.total_seconds()
+        self.metrics.log(name, seconds)
+        if self.metrics_dir:
+            labels = {
+                "task": name,
+                "band": ",".join(t.band.value for t in self.tasks),
+                "year": str(self.year),
+                "geography": task.geography.value,
+                "strategy": task.strategy.value
+            }
+            self.metrics.export(self.metrics_dir, name, labels, seconds)
+
+    def read(self, start: int, end: int) -> List:
+        return [task.read(start, end) for task in self.tasks]
+
+    def collect_data(self, days: List, writers: List[Collector]):
+        t0 = datetime.now()
+        task0 = self.tasks[0]
+        chunk = get_chunk_days(task0.dataset[task0.variable])
+        ranges = block_ranges(0, len(days), self.get_day_block(days), chunk)
+        reader = LayerReader(self.read, ranges, self.read_ahead)
+        for (start, end), blocks in zip(ranges, reader):
+            t1 = datetime.now()
+            means = []
+            for task, block in zip(self.tasks, blocks):
+                weights = task.get_weights(block[0, :, :])
+                means.append(task.aggregate(weights, block))
+            if self.wide_file:
+                self.write_wide(writers[0], days[start:end], means)
+            else:
+                for task, writer, m in zip(self.tasks, writers, means):
+                    task.write_block(writer, days[start:end], m)
+            with self.metrics.stage("flush"):
+                for writer in writers:
+                    writer.flush()
+            t3 = datetime.now()
+            t = datetime.now() - t0
+            logging.info("%d bands: %s - %s \t%s [%s]", len(self.tasks),
+                         self.tasks[0].to_date(days[start]),
+                         self.tasks[0].to_date(days[end - 1]),
+                         str(t3 - t1), str(t))
+        reader.report("{:d} bands".format(len(self.tasks)),
+                      datetime.now() - t0)
+
+    def get_day_block(self, days: List) -> int:
+        """
+        Returns the number of days to read and aggregate at once,
+        reduced to fit into the memory limit, if it is set
+
+        :param days: list of days to process
+        :return: Number of days in a block
+        """
+
+        if not self.memory_limit or len(days) == 0:
+            return self.day_block
+        # weights take memory, blocks are sized after they are built
+        for task in self.tasks:
+            task.get_weights(task.read(0))
+        task0 = self.tasks[0]
+        bytes_per_day = task0.window_cells() * len(self.tasks) * (
+            AGGREGATION_BYTES_PER_CELL + RAW_BYTES_PER_CELL * self.read_ahead
+        )
+        maximum = self.day_block if self.day_block > 1 else AUTO_MAX_DAYS
+        return MemoryBudget(self.memory_limit).day_block(
+            bytes_per_day, maximum,
+            get_chunk_days(task0.dataset[task0.variable])
+        )
+
+    def write_wide(self, writer: Collector, days: List, means: List):
+        task = self.tasks[0]
+        keys = task.weights.keys
+        for idx in range(len(days)):
+            date_str = task.to_date(days[idx]).strftime("%Y-%m-%d")
+            columns = [m[:, idx] for m in means]
+            writer.write_columns(*columns, date_str, keys)
+
+
 class DownloadGridmetTask:
     """
     Task to download source file in NCDF4 format
     """
 
-    BLOCK_SIZE = 65536
-
     @classmethod
     def get_url(cls, year:int, variable: GridmetVariable) -> str:
         """
@@ -363,11 +1332,14 @@ class DownloadGridmetTask:
 
     def __init__(self, year: int,
                  variable: GridmetVariable,
-                 destination: str):
+                 destination: str,
+                 segments: int = 1):
         """
         :param year: year
         :param variable: Gridmet band (variable)
         :param destination: Destination directory for all downloads
+        :param segments: Number of concurrent connections used to
+            download the file
         """
         if not os.path.isdir(destination):
             os.makedirs(destination)
@@ -375,6 +1347,7 @@ class DownloadGridmetTask:
         url = self.get_url(year, variable)
         target = os.path.join(destination, url.split('/')[-1])
         self.download_task = DownloadTask(target, [url])
+        self.segments = segments
 
     def target(self):
         """
@@ -382,29 +1355,27 @@ class DownloadGridmetTask:
         """
         return self.download_task.destination
 
-    def execute(self):
+    def execute(self) -> bool:
         """
         Executes the task
-        :return: None
+        :return: True if the file has been downloaded, False if the
+            existing file is up to date
         """
 
         logging.info(str(self.download_task))
-        if self.download_task.is_up_to_date():
+        download = ResumableDownload(self.download_task.urls[0],
+                                     self.target(), self.segments)
+        try:
+            downloaded = download.execute()
+        except requests.RequestException as x:
+            if not os.path.isfile(self.target()):
+                raise
+            logging.warning("Could not validate %s, using existing file: %s",
+                            self.target(), str(x))
+            return False
+        if not downloaded:
             logging.info("Up to date")
-            return
-        buffer = bytearray(self.BLOCK_SIZE)
-        with fopen(self.target(), "wb") as writer, \
-                as_stream(self.download_task.urls[0]) as reader:
-            n = 0
-            while True:
-                ret = reader.readinto(buffer)
-                if not ret:
-                    break
-                writer.write(buffer[:ret])
-                n += 1
-                if (n % 20) == 0:
-                    print("*", end='')
-        return
+        return downloaded
 
 
 class GridmetTask:
@@ -423,14 +1394,69 @@ class GridmetTask:
         :param context: Configuration object for the pipeline
         :param year: year
         :param variable: Gridmet band (variable)
-        :return: `variable_geography_year.csv[.gz]`
+        :return: `variable_geography_year.csv[.gz|.zst]` or
+            `variable_geography_year.parquet`, for postgres format:
+            the name of the table, `gridmet.geography_variable`
         """
         g = context.geography.value
+        if context.format == OutputFormat.postgres:
+            return "{}.{}".format(Registry.SCHEMA,
+                                  Registry.table_name(g, variable.value))
         s = context.shapes[0].value if len(context.shapes) == 1 else "all"
-        f = "{}_{}_{}_{:d}.csv".format(variable.value, g, s, year)
+        f = "{}_{}_{}_{:d}".format(variable.value, g, s, year)
+        return os.path.join(context.destination, f + cls.extension(context))
+
+    @classmethod
+    def extension(cls, context: GridmetContext) -> str:
+        """
+        :param context: Configuration object for the pipeline
+        :return: Extension of the resulting files, defined by the
+            output format
+        """
+        if context.format == OutputFormat.parquet:
+            return ".parquet"
         if context.compress:
-            f += ".gz"
-        return os.path.join(context.destination, f)
+            if context.compression == Compression.zstd:
+                return ".csv.zst"
+            return ".csv.gz"
+        return ".csv"
+
+    @classmethod
+    def output_options(cls, context: GridmetContext) -> OutputOptions:
+        """
+        :param context: Configuration object for the pipeline
+        :return: Options defining how the results are written
+        """
+        if context.format == OutputFormat.postgres:
+            database = (context.db, context.connection)
+        else:
+            database = None
+        return OutputOptions(database, context.precision,
+                             context.compression_level,
+                             context.compression_threads,
+                             bool(context.resume))
+
+    @classmethod
+    def shape_files(cls, context: GridmetContext, year: int) -> List[str]:
+        """
+        Returns the list of shape files with polygons to aggregate over,
+        either given explicitly in the context or found in the shapes
+        directory for the closest available year
+
+        :param context: Configuration object for the pipeline
+        :param year: year
+        :return: list of shape files, empty if only points should be
+            processed
+        """
+
+        if context.shape_files:
+            return list(context.shape_files)
+        if Shape.polygon in context.shapes or not context.points:
+            return [
+                cls.find_shape_file(context, year, shape)
+                for shape in context.shapes
+            ]
+        return []
 
     @classmethod
     def find_shape_file(cls, context: GridmetContext, year: int, shape: Shape):
@@ -458,8 +1484,15 @@ class GridmetTask:
         :param year: year
         :param variable: Gridmet band (variable)
         """
+        if Shape.point in context.shapes and context.points:
+            if context.resume:
+                raise Exception("Resuming is not supported for points")
+            if context.incremental:
+                raise Exception("Incremental mode is not supported "
+                                "for points")
         destination = context.raw_downloads
-        self.download_task = DownloadGridmetTask(year, variable, destination)
+        self.download_task = DownloadGridmetTask(year, variable, destination,
+                                                 context.segments)
 
         destination = context.destination
         if not os.path.isdir(destination):
@@ -467,26 +1500,14 @@ class GridmetTask:
 
         result = self.destination_file_name(context, year, variable)
 
-        self.compute_tasks = []
-
-        if context.shape_files:
-            self.compute_tasks = [
-                ComputeShapesTask(year, variable, self.download_task.target(),
-                                  result, context.strategy, shape_filename,
-                                  context.geography, context.dates)
-                for shape_filename in context.shape_files
-            ]
-
-        elif Shape.polygon in context.shapes or not context.points:
-            self.compute_tasks = [
-                ComputeShapesTask(year, variable, self.download_task.target(),
-                                  result, context.strategy, shape_file,
-                                  context.geography, context.dates)
-                for shape_file in [
-                    self.find_shape_file(context, year, shape)
-                    for shape in context.shapes
-                ]
-            ]
+        self.compute_tasks = [
+            ComputeShapesTask(year, variable, self.download_task.target(),
+                              result, context.strategy, shape_file,
+                              context.geography, context.dates,
+                              context.day_block, context.day_workers,
+                              context.geometry_cache, context.read_ahead)
+            for shape_file in self.shape_files(context, year)
+        ]
 
         if Shape.point in context.shapes and context.points:
             self.compute_tasks += [
@@ -496,10 +1517,22 @@ class GridmetTask:
                                   result,
                                   context.points,
                                   context.coordinates,
-                                  context.metadata)
+                                  context.metadata,
+                                  day_block=context.day_block,
+                                  read_ahead=context.read_ahead)
             ]
         if not self.compute_tasks:
             raise Exception("Invalid combination of arguments")
+        for task in self.compute_tasks:
+            task.options = self.output_options(context)
+            task.incremental = bool(context.incremental)
+            task.metrics_dir = context.metrics or None
+            task.memory_limit = context.memory_limit
+        self.force = bool(context.force)
+        self.name = "{}:{:d}".format(variable.value, year)
+
+    def __str__(self):
+        return self.name
 
     def execute(self):
         """
@@ -510,6 +1543,187 @@ class GridmetTask:
         :return: None
         """
 
-        self.download_task.execute()
+        downloaded = self.download()
+        self.compute(downloaded)
+
+    def download(self) -> bool:
+        """
+        Executes the download subtask
+        :return: True if the file has been downloaded
+        """
+
+        return self.download_task.execute()
+
+    def compute(self, downloaded: bool = True, engine=None):
+        """
+        Executes the compute subtasks, the data must be already downloaded
+
+        :param downloaded: Whether the data has been downloaded by this
+            execution. If not, incremental tasks with up to date output
+            are skipped
+        :param engine: Optional `ChunkedEngine`, aggregations over
+            shapes are added to it, to be executed later by
+            the engine, instead of being executed immediately
+        :return: None
+        """
+
+        for task in self.compute_tasks:
+            if not downloaded and task.is_up_to_date():
+                logging.info("Up to date: %s", task.outfile)
+                continue
+            if engine is not None and isinstance(task, ComputeShapesTask):
+                engine.add(task, self.force)
+                continue
+            self.run(task, self.force)
+
+    @classmethod
+    def run(cls, task, force: bool = False):
+        """
+        Executes a compute task unless its manifest shows that the
+        results have been computed from the same inputs, parameters
+        and code. Saves the manifest after the task is executed
+
+        :param task: Compute task
+        :param force: Execute the task even if it is up to date
+        :return: None
+        """
+
+        manifest = task.manifest()
+        if manifest is not None:
+            if manifest.is_up_to_date() and not force:
+                logging.info("Skipping %s, manifest %s matches",
+                             ", ".join(manifest.outputs), manifest.path)
+                return
+            manifest.invalidate()
+        task.execute()
+        if manifest is not None:
+            manifest.save()
+
+
+class GridmetBandsTask:
+    """
+    Defines a task to download and process data for a single year
+    and several variables (bands). Geography shapes are processed
+    once for all bands, see `ComputeBandsTask`
+    """
+
+    @classmethod
+    def wide_file_name(cls, context: GridmetContext, year: int):
+        """
+        Constructs a file name for a file containing all bands
+
+        :param context: Configuration object for the pipeline
+        :param year: year
+        :return: `gridmet_geography_year.csv[.gz|.zst]`
+        """
+        g = context.geography.value
+        s = context.shapes[0].value if len(context.shapes) == 1 else "all"
+        f = "gridmet_{}_{}_{:d}".format(g, s, year)
+        return os.path.join(context.destination,
+                            f + GridmetTask.extension(context))
+
+    def __init__(self, context: GridmetContext, year: int):
+        """
+        :param context: Configuration object for the pipeline
+        :param year: year
+        """
+        if context.resume:
+            raise Exception("Resuming is supported only for "
+                            "separate layout")
+        variables = context.variables
+        self.download_tasks = [
+            DownloadGridmetTask(year, variable, context.raw_downloads,
+                                context.segments)
+            for variable in variables
+        ]
+        infiles = [task.target() for task in self.download_tasks]
+
+        destination = context.destination
+        if not os.path.isdir(destination):
+            os.makedirs(destination)
+
+        outfiles = [
+            GridmetTask.destination_file_name(context, year, variable)
+            for variable in variables
+        ]
+        if context.incremental:
+            raise Exception("Incremental mode is supported only for "
+                            "separate layout")
+        if context.layout == BandsLayout.wide:
+            if context.format == OutputFormat.postgres:
+                raise Exception("Wide layout is not supported for postgres")
+            wide_file = self.wide_file_name(context, year)
+        else:
+            wide_file = None
+
+        self.compute_tasks = [
+            ComputeBandsTask(year, variables, infiles, outfiles,
+                             context.strategy, shape_file, context.geography,
+                             context.dates, context.day_block, wide_file,
+                             context.geometry_cache, context.read_ahead)
+            for shape_file in GridmetTask.shape_files(context, year)
+        ]
+
+        if Shape.point in context.shapes and context.points:
+            if wide_file:
+                raise Exception("Wide layout is not supported for points")
+            self.compute_tasks += [
+                ComputePointsTask(year,
+                                  variables[i],
+                                  infiles[i],
+                                  outfiles[i],
+                                  context.points,
+                                  context.coordinates,
+                                  context.metadata,
+                                  day_block=context.day_block,
+                                  read_ahead=context.read_ahead)
+                for i in range(len(variables))
+            ]
+        if not self.compute_tasks:
+            raise Exception("Invalid combination of arguments")
+        for task in self.compute_tasks:
+            task.options = GridmetTask.output_options(context)
+            task.metrics_dir = context.metrics or None
+            task.memory_limit = context.memory_limit
+        self.force = bool(context.force)
+        self.name = "{}:{:d}".format(
+            ",".join([v.value for v in variables]), year
+        )
+
+    def __str__(self):
+        return self.name
+
+    def execute(self):
+        """
+        Executes the task. First all download subtasks are executed
+        and then the compute tasks
+
+        :return: None
+        """
+
+        downloaded = self.download()
+        self.compute(downloaded)
+
+    def download(self) -> bool:
+        """
+        Executes the download subtasks
+        :return: True if any file has been downloaded
+        """
+
+        downloaded = [task.execute() for task in self.download_tasks]
+        return any(downloaded)
+
+    def compute(self, downloaded: bool = True, engine=None):
+        """
+        Executes the compute subtasks, the data must be already downloaded
+
+        :param downloaded: Whether any data has been downloaded by this
+            execution, not used: tasks with up to date results are
+            skipped according to their manifests
+        :param engine: Not used: bands read in a single pass are
+            always computed eagerly
+        :return: None
+        """
+
         for task in self.compute_tasks:
-            task.execute()
+            GridmetTask.run(task, self.force)
@@ -0,0 +1,430 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Precomputed zonal weights: a sparse matrix mapping grid cells to
+geographies (shapes). Rasterization of the shapes is done once, and
+then the mean values for any layer over the same grid are computed
+as a sparse matrix-vector product.
+"""
+
+import logging
+from typing import List, Optional, Tuple, Dict
+
+import numpy
+import shapely
+from rasterio import features
+from rasterio import Affine
+from rasterstats.io import read_features, bounds_window
+from scipy import sparse
+from shapely.geometry import shape
+
+from gridmet.config import WeightingStrategy
+from gridmet.geometry_cache import GeometryCache
+from gridmet.gridmet_tools import disaggregate, NO_DATA
+from nsaph_gis.compute_shape import StatsCounter
+from nsaph_gis.constants import RasterizationStrategy
+
+
+def rasterize_window(geometry, affine: Affine, all_touched: bool):
+    """
+    Rasterizes a single geometry over the smallest window of the grid
+    covering its bounding box. This is the same window that is
+    used by rasterstats.zonal_stats
+
+    :param geometry: Shapely geometry
+    :param affine: Affine transformation of the grid
+    :param all_touched: Use all cells touched by the geometry,
+        otherwise only cells with centers inside the geometry
+    :return: A tuple of arrays (rows, cols) with grid indices of
+        the cells belonging to the geometry
+    """
+
+    (row_start, row_stop), (col_start, col_stop) = \
+        bounds_window(tuple(geometry.bounds), affine)
+    west, north = affine * (col_start, row_start)
+    transform = Affine(affine.a, affine.b, west, affine.d, affine.e, north)
+    out_shape = (row_stop - row_start, col_stop - col_start)
+    if out_shape[0] < 1 or out_shape[1] < 1:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty
+    mask = features.rasterize(
+        [(geometry, 1)],
+        out_shape=out_shape,
+        transform=transform,
+        fill=0,
+        dtype="uint8",
+        all_touched=all_touched
+    )
+    rows, cols = numpy.nonzero(mask)
+    return rows + row_start, cols + col_start
+
+
+def coverage(geometry, affine: Affine, shape2d: Tuple[int, int]):
+    """
+    Computes exact fractions of grid cells areas covered by a geometry.
+
+    Only the cells crossed by the boundary of the geometry require
+    computing intersections, the other cells touched by the geometry
+    are covered completely.
+
+    :param geometry: Shapely geometry
+    :param affine: Affine transformation of the grid
+    :param shape2d: Shape of the grid: (rows, columns)
+    :return: A tuple of arrays (rows, cols, fractions)
+    """
+
+    rows, cols = rasterize_window(geometry, affine, all_touched=True)
+    inside = (rows >= 0) & (rows < shape2d[0]) \
+        & (cols >= 0) & (cols < shape2d[1])
+    rows = rows[inside]
+    cols = cols[inside]
+    fractions = numpy.ones(len(rows), dtype=numpy.float64)
+
+    b_rows, b_cols = rasterize_window(geometry.boundary, affine,
+                                      all_touched=True)
+    n_cols = shape2d[1]
+    on_boundary = numpy.isin(rows * n_cols + cols, b_rows * n_cols + b_cols)
+    idx = numpy.nonzero(on_boundary)[0]
+    x0, y0 = affine * (cols[idx], rows[idx])
+    x1, y1 = affine * (cols[idx] + 1, rows[idx] + 1)
+    cells = shapely.box(numpy.minimum(x0, x1), numpy.minimum(y0, y1),
+                        numpy.maximum(x0, x1), numpy.maximum(y0, y1))
+    cell_area = abs(affine.a * affine.e - affine.b * affine.d)
+    fractions[idx] = shapely.area(shapely.intersection(cells, geometry)) \
+        / cell_area
+    # cells touching the boundary from outside have (almost) zero area
+    covered = fractions > 1e-9
+    return rows[covered], cols[covered], fractions[covered]
+
+
+class ZonalWeights:
+    """
+    Sparse (geography x grid cell) weight matrix.
+
+    Mean value for every geography is computed as
+    `W @ (values * valid) / W @ valid`, where `valid` is 1 for
+    the cells that have data and 0 for masked (NO_DATA) cells.
+    With binary weights it is exactly the mean over the cells
+    selected by rasterization, the same as computed by
+    `StatsCounter`. When the grid has been disaggregated
+    (downscale strategy), a weight of a native cell is the number
+    of subcells selected by rasterization, thus the means are the same
+    as computed over disaggregated layer, but the disaggregated layer
+    is never allocated. For area weighted strategy, a weight of a cell
+    is the fraction of its area covered by the shape.
+    """
+
+    ALL_TOUCHED = {
+        RasterizationStrategy.default: False,
+        RasterizationStrategy.all_touched: True,
+        RasterizationStrategy.downscale: False,
+    }
+    """Rasterization mode, used for each strategy"""
+
+    _cache: Dict[Tuple, "ZonalWeights"] = dict()
+
+    def __init__(self, keys: List, matrix: sparse.csr_matrix,
+                 fallback: Optional[sparse.csr_matrix] = None):
+        """
+        :param keys: Labels of the geographies (e.g. zip codes), in the
+            same order as the rows of the matrix
+        :param matrix: Sparse weight matrix
+        :param fallback: Optional second matrix, used for
+            combined strategy for geographies that have no valid
+            cells in the first matrix
+        """
+
+        self.keys = keys
+        self.matrix = matrix
+        self.fallback = fallback
+
+    @classmethod
+    def get(cls, strategy, shapefile: str,
+            affine: Affine, layer, factor: int = 1,
+            geometry_cache: Optional[str] = None) -> "ZonalWeights":
+        """
+        Returns weights for a given shapefile and grid, building them if
+        they have not yet been built in this process
+
+        :param strategy: Rasterization strategy, either
+            RasterizationStrategy or WeightingStrategy
+        :param shapefile: Shapefile for used collection of geographies
+        :param affine: Affine transformation of the (possibly
+            disaggregated) grid
+        :param layer: A sample layer (at native resolution),
+            used to determine grid shape and labels of the geographies
+        :param factor: Factor used for disaggregation
+        :param geometry_cache: Optional directory with cached
+            geometries, see `GeometryCache`
+        :return: an instance of ZonalWeights
+        """
+
+        key = (strategy, shapefile, affine, layer.shape, factor)
+        if key not in cls._cache:
+            cls._cache[key] = cls.build(strategy, shapefile, affine, layer,
+                                        factor, geometry_cache)
+        return cls._cache[key]
+
+    @classmethod
+    def build(cls, strategy, shapefile: str,
+              affine: Affine, layer, factor: int = 1,
+              geometry_cache: Optional[str] = None) -> "ZonalWeights":
+        """
+        Rasterizes all shapes in the shapefile and builds weight matrix
+
+        See `get()` for parameters
+        """
+
+        logging.info("Building zonal weights for %s [%s]", shapefile,
+                     strategy.value)
+        keys = None
+        if geometry_cache:
+            cache = GeometryCache(geometry_cache)
+            cached = cache.load(shapefile)
+            geometries = list(cached.geometries)
+            keys = cached.ids
+        else:
+            cache = None
+            geometries = [
+                shape(feature["geometry"])
+                for feature in read_features(shapefile)
+            ]
+        if strategy == WeightingStrategy.area_weighted:
+            matrices = [cls.cover(geometries, affine, layer.shape)]
+            reference = RasterizationStrategy.default
+        else:
+            if strategy == RasterizationStrategy.combined:
+                modes = [False, True]
+            else:
+                modes = [cls.ALL_TOUCHED[strategy]]
+            matrices = [
+                cls.rasterize(geometries, affine, layer.shape, factor, mode)
+                for mode in modes
+            ]
+            reference = strategy
+        fallback = matrices[1] if len(matrices) > 1 else None
+
+        # Labels for geographies are defined by nsaph_gis,
+        # so we take them from a single run of StatsCounter, unless
+        # they have been cached. This run is also used to verify
+        # consistency of the means
+        if keys is None:
+            records = list(StatsCounter.process(
+                reference, shapefile, affine, disaggregate(layer, factor)
+            ))
+            keys = [record.prop for record in records]
+        else:
+            records = None
+        if len(keys) != matrices[0].shape[0]:
+            # means would be written with wrong labels
+            raise ValueError("{:d} labels for {:d} shapes in {}".format(
+                len(keys), matrices[0].shape[0], shapefile
+            ))
+        if records is not None and cache is not None:
+            cache.store_ids(shapefile, keys)
+        weights = ZonalWeights(keys, matrices[0], fallback)
+        if records is not None and reference == strategy:
+            weights.verify([record.mean for record in records], layer)
+        logging.info("Zonal weights: %d geographies, %d nonzero weights",
+                     len(keys), weights.matrix.nnz)
+        return weights
+
+    @staticmethod
+    def rasterize(geometries: List, affine: Affine, shape2d: Tuple[int, int],
+                  factor: int, all_touched: bool) -> sparse.csr_matrix:
+        """
+        Builds a weight matrix for a list of geometries
+
+        :param geometries: List of Shapely geometries
+        :param affine: Affine transformation of the (possibly
+            disaggregated) grid
+        :param shape2d: Shape of the native grid: (rows, columns)
+        :param factor: Factor used for disaggregation
+        :param all_touched: Rasterization mode
+        :return: CSR Matrix, with a row per geometry and a column per
+            cell of the native grid
+        """
+
+        n_rows, n_cols = shape2d
+        row_idx = []
+        col_idx = []
+        for i, geometry in enumerate(geometries):
+            rows, cols = rasterize_window(geometry, affine, all_touched)
+            inside = (rows >= 0) & (rows < n_rows * factor) \
+                & (cols >= 0) & (cols < n_cols * factor)
+            rows = rows[inside] // factor
+            cols = cols[inside] // factor
+            row_idx.append(numpy.full(len(rows), i, dtype=numpy.int64))
+            col_idx.append(rows * n_cols + cols)
+        if row_idx:
+            row_idx = numpy.concatenate(row_idx)
+            col_idx = numpy.concatenate(col_idx)
+        data = numpy.ones(len(row_idx), dtype=numpy.float64)
+        # duplicates (subcells of the same native cell) are summed
+        matrix = sparse.coo_matrix(
+            (data, (row_idx, col_idx)),
+            shape=(len(geometries), n_rows * n_cols)
+        )
+        return matrix.tocsr()
+
+    @staticmethod
+    def cover(geometries: List, affine: Affine,
+              shape2d: Tuple[int, int]) -> sparse.csr_matrix:
+        """
+        Builds a weight matrix, where weights are the fractions
+        of cell areas covered by the geometries
+
+        :param geometries: List of Shapely geometries
+        :param affine: Affine transformation of the grid
+        :param shape2d: Shape of the grid: (rows, columns)
+        :return: CSR Matrix, with a row per geometry and a column per
+            cell of the grid
+        """
+
+        n_rows, n_cols = shape2d
+        row_idx = []
+        col_idx = []
+        data = []
+        for i, geometry in enumerate(geometries):
+            rows, cols, fractions = coverage(geometry, affine, shape2d)
+            row_idx.append(numpy.full(len(rows), i, dtype=numpy.int64))
+            col_idx.append(rows * n_cols + cols)
+            data.append(fractions)
+        matrix = sparse.coo_matrix(
+            (numpy.concatenate(data),
+             (numpy.concatenate(row_idx), numpy.concatenate(col_idx))),
+            shape=(len(geometries), n_rows * n_cols)
+        )
+        return matrix.tocsr()
+
+    @staticmethod
+    def split(layer) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Splits a (possibly masked) layer or block of layers into
+        flattened arrays of values and validity flags
+
+        :param layer: numpy array or masked array, either 2D (a single
+            layer) or 3D (days x rows x columns)
+        :return: a tuple (values, valid), both with shape (cells,) for
+            a 2D layer or (cells, days) for a 3D block
+        """
+
+        data = numpy.ma.getdata(layer)
+        valid = ~numpy.ma.getmaskarray(layer)
+        valid &= (data != NO_DATA)
+        if numpy.issubdtype(data.dtype, numpy.floating):
+            valid &= ~numpy.isnan(data)
+        values = numpy.where(valid, data, 0).astype(numpy.float64)
+        if layer.ndim == 3:
+            n = layer.shape[0]
+            values = values.reshape(n, -1).T
+            valid = valid.reshape(n, -1).T
+        else:
+            values = values.ravel()
+            valid = valid.ravel()
+        return values, valid.astype(numpy.float64)
+
+    @staticmethod
+    def _means(matrix: sparse.csr_matrix, values, valid):
+        total = matrix @ values
+        count = matrix @ valid
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return numpy.where(count > 0, total / count, numpy.nan)
+
+    def compute(self, layer) -> numpy.ndarray:
+        """
+        Computes means of the layer values over every geography
+
+        :param layer: A 2D layer or a 3D block of layers (days first)
+            at the native resolution of the grid
+        :return: Array of means, with NaN for the geographies that
+            do not contain any valid cells. The shape of the array
+            is (geographies,) for a 2D layer and (geographies, days)
+            for a 3D block
+        """
+
+        return self.aggregate(*self.split(layer))
+
+    def aggregate(self, values: numpy.ndarray,
+                  valid: numpy.ndarray) -> numpy.ndarray:
+        """
+        Computes means of values returned by `split()`
+
+        :param values: Flattened values
+        :param valid: Flattened validity flags
+        :return: Array of means, see `compute()`
+        """
+
+        means = self._means(self.matrix, values, valid)
+        if self.fallback is not None:
+            missing = numpy.isnan(means)
+            if missing.any():
+                alt = self._means(self.fallback, values, valid)
+                means = numpy.where(missing, alt, means)
+        return means
+
+    def mean(self, layer) -> List[Optional[float]]:
+        """
+        Computes means for a single layer
+
+        :param layer: A 2D layer at the native resolution of the grid
+        :return: List of means in the order of `keys`, None is used for
+            geographies without valid cells
+        """
+
+        return to_list(self.compute(layer))
+
+    def verify(self, expected: List[Optional[float]], layer,
+               tolerance: float = 1e-6):
+        """
+        Checks that means computed with the weights are the same as
+        the expected values. Only geographies without masked cells are
+        compared, because the treatment of masked cells may differ
+
+        :param expected: Expected means
+        :param layer: A layer used to compute the expected values
+        :param tolerance: relative tolerance
+        :raises ValueError: if any of the compared means differ
+        """
+
+        values, valid = self.split(layer)
+        actual = self.aggregate(values, valid)
+        unmasked = (self.matrix @ (1 - valid)) == 0
+        e = numpy.array([numpy.nan if v is None else v for v in expected],
+                        dtype=numpy.float64)
+        compared = unmasked & numpy.isfinite(actual) & numpy.isfinite(e)
+        mismatch = compared & (
+            numpy.abs(actual - e) > tolerance * numpy.maximum(numpy.abs(e), 1)
+        )
+        if mismatch.any():
+            i = numpy.flatnonzero(mismatch)[0]
+            raise ValueError("Zonal weights differ from StatsCounter for "
+                             "{:d} out of {:d} compared geographies, e.g. "
+                             "{}: {} instead of {}".format(
+                                 int(mismatch.sum()), int(compared.sum()),
+                                 self.keys[i], actual[i], e[i]))
+        logging.info("Zonal weights verified for %d out of %d geographies",
+                     int(compared.sum()), len(expected))
+
+
+def to_list(means: numpy.ndarray) -> List[Optional[float]]:
+    return [
+        None if m != m else m for m in means.tolist()
+    ]
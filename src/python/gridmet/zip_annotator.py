@@ -0,0 +1,400 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Annotation of points with ZIP codes.
+
+Every row of a CSV file with coordinates of a point gets attributes
+(by default ZIP, STATE and NAME) of the ZIP code polygon containing
+the point. Attributes of points outside of all polygons are empty;
+a point on a border of several polygons gets the attributes of the
+first of them in the shapefile. Rows are written in the same order
+and the values of the original columns are copied unchanged.
+
+The file is read in blocks, coordinates are parsed into arrays and
+all points of a block are matched to the polygons at once, using a
+spatial index built once per process. Blocks can be annotated by
+several processes, the results are written in the order of blocks.
+
+    python -m gridmet.zip_annotator --year 2016 --shapes_dir shapes -i sites.csv.gz -o sites_zip.csv.gz --latitude ycoord --longitude xcoord --quote SiteCode --workers 8
+"""
+
+import argparse
+import csv
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import numpy
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.csv
+import shapely
+from nsaph import init_logging
+from nsaph_utils.utils.io_utils import fopen
+
+from gridmet.compression import open_compressed
+from gridmet.geometry_cache import CachedGeometries, GeometryCache
+from gridmet.gridmet_tools import find_shape_file
+
+
+BLOCK_SIZE = 16 * 1024 * 1024
+NEEDS_QUOTES = '[,"\r\n]'
+
+
+def quote_values(values: pyarrow.Array, always: bool = False) \
+        -> pyarrow.Array:
+    """
+    Converts values into CSV fields
+
+    :param values: Column of values
+    :param always: Whether all values are enclosed in quotes,
+        otherwise only values containing delimiters, quotes
+        or line breaks
+    :return: Array of strings, nulls are converted to empty strings
+    """
+
+    values = pc.fill_null(pc.cast(values, pyarrow.string()), "")
+    quoted = pc.binary_join_element_wise(
+        '"', pc.replace_substring(values, '"', '""'), '"', ""
+    )
+    if always:
+        return quoted
+    return pc.if_else(pc.match_substring_regex(values, NEEDS_QUOTES),
+                      quoted, values)
+
+
+def join_rows(columns: List[pyarrow.Array]) -> str:
+    """
+    :param columns: Columns of CSV fields
+    :return: Lines of CSV text, each ending with a line break
+    """
+
+    lines = pc.binary_join_element_wise(*columns, ",")
+    text = pc.binary_join(pyarrow.ListArray.from_arrays(
+        pyarrow.array([0, len(lines)], pyarrow.int32()), lines
+    ), "\n")[0].as_py()
+    return text + "\n" if text else ""
+
+
+def to_coordinates(values: pyarrow.Array) -> numpy.ndarray:
+    """
+    :param values: Column of coordinates as read from CSV
+    :return: Array of floats, missing values are NaN
+    """
+
+    values = pc.utf8_trim_whitespace(values)
+    values = pc.if_else(pc.equal(values, ""), None, values)
+    return pc.fill_null(pc.cast(values, pyarrow.float64()), numpy.nan)\
+        .to_numpy(zero_copy_only=False)
+
+
+class ZipAnnotator:
+    """
+    Adds attributes of ZIP code polygons to the points in a CSV file
+    """
+
+    SHAPE_COLUMNS = ["ZIP", "STATE", "NAME"]
+    ALIASES = {"NAME": "PO_NAME"}
+    '''Attributes of the shapefile used for the columns, if the
+    shapefile has no attribute with the name of the column'''
+
+    def __init__(self, shapefile: str, source: str, destination: str,
+                 latitude: str = "ycoord", longitude: str = "xcoord",
+                 to_quote: Optional[List[str]] = None,
+                 shape_columns: Optional[List[str]] = None,
+                 geometry_cache: Optional[str] = None,
+                 block_size: int = BLOCK_SIZE, workers: int = 1,
+                 compression_level: Optional[int] = None,
+                 compression_threads: int = 1):
+        """
+        :param shapefile: Shapefile with ZIP code polygons
+        :param source: CSV file with points, optionally compressed
+        :param destination: Resulting CSV file, compressed according
+            to its extension
+        :param latitude: Column with latitudes of the points
+        :param longitude: Column with longitudes of the points
+        :param to_quote: Columns, whose values are always enclosed
+            in quotes, e.g. codes with leading zeros
+        :param shape_columns: Attributes of the polygons to add
+        :param geometry_cache: Optional directory with cached geometries
+            of shapefiles
+        :param block_size: Approximate size of a block of the CSV
+            file in bytes, annotated at once
+        :param workers: Number of processes annotating blocks
+        :param compression_level: Compression level of the result
+        :param compression_threads: Number of threads compressing
+            the result
+        """
+
+        self.shapefile = shapefile
+        self.src = source
+        self.dest = destination
+        self.latitude = latitude
+        self.longitude = longitude
+        self.to_quote = set(to_quote or [])
+        self.shape_columns = shape_columns or self.SHAPE_COLUMNS
+        self.geometry_cache = geometry_cache
+        self.block_size = block_size
+        self.workers = max(workers, 1)
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.geometries: Optional[CachedGeometries] = None
+        self.attributes: Optional[List[pyarrow.Array]] = None
+
+    def __getstate__(self):
+        # every worker process loads geometries and builds its index
+        state = self.__dict__.copy()
+        state["geometries"] = None
+        state["attributes"] = None
+        return state
+
+    def load(self):
+        """
+        Reads the polygons and their attributes. The spatial index
+        is built by the first `match()`
+        """
+
+        if self.geometries is not None:
+            return
+        if self.geometry_cache:
+            geometries = GeometryCache(self.geometry_cache)\
+                .load(self.shapefile)
+        else:
+            geometries = CachedGeometries(GeometryCache.parse(self.shapefile))
+        names = geometries.table.column_names
+        attributes = []
+        for column in self.shape_columns:
+            name = column
+            if name not in names:
+                name = self.ALIASES.get(column)
+            if name not in names:
+                raise ValueError("No attribute {} in {}".format(
+                    column, self.shapefile
+                ))
+            attributes.append(
+                pc.cast(geometries.table.column(name), pyarrow.string())
+                .combine_chunks()
+            )
+        self.attributes = attributes
+        self.geometries = geometries
+
+    def match(self, x: numpy.ndarray, y: numpy.ndarray) -> numpy.ndarray:
+        """
+        Finds polygons containing the points
+
+        :param x: Longitudes
+        :param y: Latitudes
+        :return: Index of the first polygon containing every point,
+            -1 if the point is outside of all polygons
+        """
+
+        points = shapely.points(x, y)
+        inputs, polygons = self.geometries.tree.query(
+            points, predicate="intersects"
+        )
+        result = numpy.full(len(points), -1, dtype=numpy.int64)
+        if len(inputs) > 0:
+            order = numpy.lexsort((polygons, inputs))
+            inputs = inputs[order]
+            polygons = polygons[order]
+            _, first = numpy.unique(inputs, return_index=True)
+            result[inputs[first]] = polygons[first]
+        return result
+
+    def annotate_block(self, block: pyarrow.RecordBatch) \
+            -> Tuple[str, int, int]:
+        """
+        Annotates a block of rows
+
+        :param block: Columns of a block of the CSV file
+        :return: CSV text of the annotated rows, the number of rows
+            and the number of points found within polygons
+        """
+
+        self.load()
+        x = to_coordinates(block.column(self.longitude))
+        y = to_coordinates(block.column(self.latitude))
+        match = self.match(x, y)
+        indices = pyarrow.array(match, mask=match < 0)
+        columns = [
+            quote_values(block.column(i), name in self.to_quote)
+            for i, name in enumerate(block.schema.names)
+        ]
+        columns += [
+            quote_values(values.take(indices), name in self.to_quote)
+            for name, values in zip(self.shape_columns, self.attributes)
+        ]
+        return join_rows(columns), block.num_rows, \
+            int(numpy.count_nonzero(match >= 0))
+
+    def read_header(self) -> List[str]:
+        with fopen(self.src, "rt") as f:
+            return next(csv.reader(f))
+
+    def blocks(self, columns: List[str]):
+        """
+        Reads the CSV file in blocks, values of all columns are
+        read as strings and written unchanged
+
+        :param columns: Names of the columns
+        :return: Iterator over blocks
+        """
+
+        reader = pyarrow.csv.open_csv(
+            self.src,
+            read_options=pyarrow.csv.ReadOptions(block_size=self.block_size),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={c: pyarrow.string() for c in columns}
+            )
+        )
+        for block in reader:
+            if block.num_rows > 0:
+                yield block
+
+    def annotate(self):
+        """
+        Annotates all points and writes the resulting file
+
+        :return: None
+        """
+
+        t0 = datetime.now()
+        columns = self.read_header()
+        for c in [self.latitude, self.longitude]:
+            if c not in columns:
+                raise ValueError("No column {} in {}".format(c, self.src))
+        header = [
+            pyarrow.array([name]) for name in columns + self.shape_columns
+        ]
+        with open_compressed(self.dest, "wt", self.compression_level,
+                             self.compression_threads) as output:
+            output.write(join_rows([quote_values(h) for h in header]))
+            if self.workers > 1:
+                results = self.annotate_parallel(columns)
+            else:
+                results = (
+                    self.annotate_block(block)
+                    for block in self.blocks(columns)
+                )
+            rows = 0
+            matched = 0
+            for text, n, m in results:
+                output.write(text)
+                rows += n
+                matched += m
+                t = (datetime.now() - t0).total_seconds()
+                logging.info("%d rows, %d within polygons, %.0f rows/s [%s]",
+                             rows, matched, rows / t if t > 0 else 0,
+                             str(datetime.now() - t0))
+        logging.info("Annotated %d rows (%d within polygons) in %s",
+                     rows, matched, str(datetime.now() - t0))
+
+    def annotate_parallel(self, columns: List[str]):
+        """
+        Annotates blocks in a pool of processes
+
+        :param columns: Names of the columns
+        :return: Iterator over results of `annotate_block()` in
+            the order of blocks
+        """
+
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=init_worker,
+                                 initargs=(self,)) as executor:
+            for block in self.blocks(columns):
+                pending.append(executor.submit(annotate_block, block))
+                while len(pending) > 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+_annotator: Optional[ZipAnnotator] = None
+
+
+def init_worker(annotator: ZipAnnotator):
+    global _annotator
+    annotator.load()
+    _annotator = annotator
+
+
+def annotate_block(block: pyarrow.RecordBatch) -> Tuple[str, int, int]:
+    return _annotator.annotate_block(block)
+
+
+if __name__ == '__main__':
+    init_logging()
+    ap = argparse.ArgumentParser(
+        description="Adds attributes of ZIP code polygons to points "
+                    "in a CSV file"
+    )
+    ap.add_argument("--input", "-i", required=True,
+                    help="CSV file with points, optionally compressed")
+    ap.add_argument("--output", "-o", required=True,
+                    help="Resulting CSV file, compressed if its name "
+                         "ends with .gz or .zst")
+    ap.add_argument("--shape_file", "-s",
+                    help="Shapefile with ZIP code polygons")
+    ap.add_argument("--year", "-y", type=int,
+                    help="Year of ZIP code polygons, used with "
+                         "shapes_dir if shape_file is not given")
+    ap.add_argument("--shapes_dir", default="shapes",
+                    help="Directory containing shape files, organized "
+                         "as ${year}/zip/polygon")
+    ap.add_argument("--latitude", "--lat", default="ycoord",
+                    help="Column with latitudes")
+    ap.add_argument("--longitude", "--lon", default="xcoord",
+                    help="Column with longitudes")
+    ap.add_argument("--quote", nargs="+", default=[],
+                    help="Columns, whose values are always quoted")
+    ap.add_argument("--columns", nargs="+",
+                    default=ZipAnnotator.SHAPE_COLUMNS,
+                    help="Attributes of the polygons to add")
+    ap.add_argument("--geometry_cache",
+                    help="Directory to cache parsed shape files")
+    ap.add_argument("--block_size", type=int, default=16,
+                    help="Size of a block of the input file in MB")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Number of processes annotating blocks")
+    ap.add_argument("--compression_level", type=int,
+                    help="Compression level of the resulting file")
+    ap.add_argument("--compression_threads", type=int, default=1,
+                    help="Number of threads compressing the resulting file")
+    args = ap.parse_args()
+    if not args.shape_file and args.year is None:
+        ap.error("Either shape_file or year is required")
+    if args.shape_file:
+        shape_file = args.shape_file
+    else:
+        shape_file = find_shape_file(args.shapes_dir, args.year, "zip",
+                                     "polygon")
+    annotator = ZipAnnotator(
+        shape_file, args.input, args.output,
+        latitude=args.latitude, longitude=args.longitude,
+        to_quote=args.quote, shape_columns=args.columns,
+        geometry_cache=args.geometry_cache,
+        block_size=args.block_size * 1024 * 1024, workers=args.workers,
+        compression_level=args.compression_level,
+        compression_threads=args.compression_threads
+    )
+    annotator.annotate()
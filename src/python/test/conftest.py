@@ -0,0 +1,65 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Synthetic gridMET files shared by tests of compute tasks
+"""
+
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from netCDF4 import Dataset
+
+from utils.benchmark import make_netcdf, make_polygons, CELL, ORIGIN
+
+
+NLAT = 48
+NLON = 64
+DAYS = 10
+
+
+@pytest.fixture(scope="session")
+def grid(tmp_path_factory) -> SimpleNamespace:
+    """
+    Packed netCDF files of two bands with a masked corner, chunked
+    by 4 days, and polygons covering a part of the grid, including the
+    masked corner
+    """
+
+    d = str(tmp_path_factory.mktemp("grid"))
+    netcdf = os.path.join(d, "tmmx_2001.nc")
+    make_netcdf(netcdf, NLAT, NLON, DAYS, chunk_days=4)
+    # another band with different values on the same grid
+    tmmn = os.path.join(d, "tmmn_2001.nc")
+    make_netcdf(tmmn, NLAT, NLON, DAYS, chunk_days=4, seed=1)
+    with Dataset(tmmn, "a") as ds:
+        ds["air_temperature"].standard_name = "tmmn"
+    shapefile = os.path.join(d, "zip.shp")
+    bounds = (ORIGIN[0] + 3 * CELL, ORIGIN[1] - 36 * CELL,
+              ORIGIN[0] + 44 * CELL, ORIGIN[1] - 2 * CELL)
+    make_polygons(shapefile, 40, 4.5 * CELL, bounds)
+    return SimpleNamespace(netcdf=netcdf, tmmn=tmmn, shapefile=shapefile,
+                           directory=d)
+
+
+def read_text(path: str) -> str:
+    with open(path) as f:
+        return f.read()
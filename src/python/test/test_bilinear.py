@@ -0,0 +1,181 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Tests of vectorized bilinear interpolation with masked cells
+"""
+
+import csv
+
+import numpy
+from netCDF4 import Dataset
+from rasterio import Affine
+
+from gridmet.bilinear import BilinearInterpolator
+from gridmet.config import GridmetVariable
+from gridmet.gridmet_tools import NO_DATA
+from gridmet.task import ComputePointsTask
+
+
+# 1 degree cells, the center of cell (row, col) is (col + 0.5, -row - 0.5)
+AFFINE = Affine(1.0, 0.0, 0.0, 0.0, -1.0, 0.0)
+
+
+def make_block(days: int = 3) -> numpy.ma.MaskedArray:
+    data = numpy.arange(days * 4 * 5, dtype=numpy.float64)\
+        .reshape((days, 4, 5)) * 1.5
+    return numpy.ma.MaskedArray(data, mask=numpy.zeros(data.shape, bool))
+
+
+def expected(layer: numpy.ndarray, x: float, y: float) -> float:
+    col = x - 0.5
+    row = -y - 0.5
+    c0, r0 = int(numpy.floor(col)), int(numpy.floor(row))
+    dx, dy = col - c0, row - r0
+    return (layer[r0, c0] * (1 - dx) * (1 - dy)
+            + layer[r0, c0 + 1] * dx * (1 - dy)
+            + layer[r0 + 1, c0] * (1 - dx) * dy
+            + layer[r0 + 1, c0 + 1] * dx * dy)
+
+
+def test_unmasked_points():
+    block = make_block()
+    x = numpy.array([1.2, 2.7, 3.1])
+    y = numpy.array([-1.3, -2.2, -0.9])
+    result = BilinearInterpolator(AFFINE, (4, 5), x, y).interpolate(block)
+    assert result.shape == (3, 3)
+    for p in range(3):
+        for d in range(3):
+            assert numpy.isclose(result[p, d],
+                                 expected(block.data[d], x[p], y[p]))
+
+
+def test_masked_neighbor_falls_back_to_nearest():
+    block = make_block()
+    # neighbors of the first point: rows 0-1, columns 0-1,
+    # the nearest one is (1, 1)
+    block.data[1, 0, 0] = 1.0e6
+    block.mask[1, 0, 0] = True
+    block.data[2, 1, 1] = NO_DATA
+    x = numpy.array([1.2, 3.1])
+    y = numpy.array([-1.3, -2.2])
+    interpolator = BilinearInterpolator(AFFINE, (4, 5), x, y)
+    result = interpolator.interpolate(block)
+    assert numpy.isclose(result[0, 0], expected(block.data[0], x[0], y[0]))
+    assert result[0, 1] == block.data[1, 1, 1]
+    # the nearest neighbor is masked as well
+    assert numpy.isnan(result[0, 2])
+    # the other point does not use masked cells
+    for d in range(3):
+        assert numpy.isclose(result[1, d],
+                             expected(block.data[d], x[1], y[1]))
+    # a single layer is interpolated the same way
+    layer = interpolator.interpolate(block[1])
+    assert layer[0] == result[0, 1] and numpy.isclose(layer[1], result[1, 1])
+    assert list(interpolator.is_masked(block[1])) == [True, False]
+
+
+def test_points_outside():
+    block = make_block(1)
+    # the first point is outside, the second one is at the edge
+    # of the raster, closer to the cell (0, 0)
+    x = numpy.array([-3.0, 0.3])
+    y = numpy.array([-1.3, -0.6])
+    interpolator = BilinearInterpolator(AFFINE, (4, 5), x, y)
+    result = interpolator.interpolate(block)
+    assert numpy.isnan(result[0, 0])
+    assert result[1, 0] == block.data[0, 0, 0]
+    assert list(interpolator.is_masked(block[0])) == [True, True]
+
+
+def make_masked_netcdf(path: str, nlat: int = 12, nlon: int = 16,
+                       days: int = 4):
+    """
+    Creates a gridMET-shaped file, cells without data are stored as
+    NO_DATA: a corner of the grid on all days (e.g., the ocean) and
+    some cells on single days
+    """
+
+    rng = numpy.random.default_rng(0)
+    with Dataset(path, "w") as ds:
+        ds.createDimension("day", days)
+        ds.createDimension("lat", nlat)
+        ds.createDimension("lon", nlon)
+        lat = ds.createVariable("lat", "f8", ("lat",))
+        lat.units = "degrees_north"
+        lat[:] = 40 - (numpy.arange(nlat) + 0.5) / 24
+        lon = ds.createVariable("lon", "f8", ("lon",))
+        lon.units = "degrees_east"
+        lon[:] = -100 + (numpy.arange(nlon) + 0.5) / 24
+        day = ds.createVariable("day", "f8", ("day",))
+        day.units = "days since 1900-01-01 00:00:00"
+        day[:] = 36890 + numpy.arange(days)
+        var = ds.createVariable("air_temperature", "f4",
+                                ("day", "lat", "lon"), fill_value=NO_DATA)
+        var.standard_name = GridmetVariable.tmmx.value
+        data = rng.uniform(250, 310, (days, nlat, nlon))
+        mask = numpy.zeros(data.shape, dtype=bool)
+        mask[:, :4, :5] = True
+        mask[1:, 6:8, 6:9] = rng.uniform(size=(days - 1, 2, 3)) < 0.5
+        var[:] = numpy.ma.masked_array(data, mask=mask)
+
+
+def read_csv(path: str):
+    with open(path) as f:
+        return list(csv.reader(f))
+
+
+def test_execute_same_as_per_point(tmp_path, monkeypatch):
+    netcdf = str(tmp_path / "tmmx_2001.nc")
+    make_masked_netcdf(netcdf)
+    points = str(tmp_path / "points.csv")
+    rng = numpy.random.default_rng(1)
+    with open(points, "wt") as f:
+        f.write("site,lon,lat\n")
+        for i in range(200):
+            # some points are outside of the grid
+            f.write("s{:d},{:f},{:f}\n".format(
+                i, -100 + rng.uniform(-0.02, 16 / 24 + 0.02),
+                40 - rng.uniform(-0.02, 12 / 24 + 0.02)
+            ))
+
+    results = []
+    for standard in [True, False]:
+        monkeypatch.setattr(ComputePointsTask, "force_standard_api",
+                            standard)
+        outfile = str(tmp_path / "points_{}.csv".format(standard))
+        task = ComputePointsTask(2001, GridmetVariable.tmmx, netcdf, outfile,
+                                 points, ["lon", "lat"], ["site"],
+                                 day_block=3)
+        task.execute()
+        results.append(read_csv(outfile))
+
+    expected, actual = results
+    assert len(actual) == len(expected) > 100
+    assert actual[0] == expected[0]
+    empty = 0
+    for a, e in zip(actual[1:], expected[1:]):
+        assert a[1:] == e[1:]
+        if e[0] == "":
+            empty += 1
+            assert a[0] == ""
+        else:
+            assert numpy.isclose(float(a[0]), float(e[0]), rtol=1e-12)
+    # the grid is partially masked
+    assert empty > 0
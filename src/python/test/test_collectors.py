@@ -0,0 +1,131 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Tests of collectors writing the results into files
+"""
+
+import io
+import os
+import subprocess
+import sys
+
+import numpy
+import pyarrow.parquet
+import pytest
+
+from gridmet.collectors import ParquetWriter, Collector, CSVWriter
+from gridmet.compression import open_compressed
+from gridmet.metrics import Metrics
+
+
+HEADER = ["tmmx", "date", "zip"]
+KEYS = ["02138", "02139", "10001", "90210"]
+
+
+def write(path: str, columns_method, numeric_ids: bool = True):
+    writer = ParquetWriter(path, HEADER, numeric_ids)
+    writer.metrics = Metrics()
+    for day in range(3):
+        values = numpy.array([280.5, numpy.nan, 290.25 + day, 1.0e-3])
+        columns_method(writer, values, "2020-01-0{:d}".format(day + 1), KEYS)
+        writer.flush()
+    writer.close()
+    return writer.metrics
+
+
+@pytest.mark.parametrize("numeric_ids", [True, False])
+def test_write_columns_same_as_rows(tmp_path, numeric_ids):
+    by_rows = str(tmp_path / "rows.parquet")
+    by_columns = str(tmp_path / "columns.parquet")
+    write(by_rows, Collector.write_columns, numeric_ids)
+    metrics = write(by_columns, ParquetWriter.write_columns, numeric_ids)
+    expected = pyarrow.parquet.read_table(by_rows)
+    actual = pyarrow.parquet.read_table(by_columns)
+    assert actual.schema == expected.schema
+    assert actual.equals(expected)
+    assert actual.column("tmmx").null_count == 3
+    assert pyarrow.parquet.ParquetFile(by_columns).num_row_groups == 3
+    assert metrics.counters["bytes"] > 0
+    assert metrics.seconds["serialize"] > 0
+
+
+def test_files_do_not_need_database_driver():
+    code = "import sys, gridmet.collectors; " \
+           "assert 'nsaph.db' not in sys.modules"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=root)
+
+
+@pytest.mark.parametrize("name,stage", [("out.csv", "flush"),
+                                        ("out.csv.gz", "compress"),
+                                        ("out.csv.zst", "compress")])
+def test_csv_writes_are_timed_by_compression(tmp_path, name, stage):
+    with open_compressed(str(tmp_path / name), "wt") as out:
+        writer = CSVWriter(out)
+        writer.metrics = Metrics()
+        writer.write_columns(numpy.arange(1000.0), "2020-01-01",
+                             [str(i) for i in range(1000)])
+    other = "flush" if stage == "compress" else "compress"
+    assert writer.metrics.seconds[stage] > 0
+    assert writer.metrics.seconds[other] == 0
+
+
+def write_csv(method, *columns) -> str:
+    out = io.StringIO(newline="")
+    writer = CSVWriter(out)
+    method(writer, *columns)
+    return out.getvalue()
+
+
+VALUES = numpy.array([280.15000000000003, numpy.nan, 0.1, -0.0, 1e-7,
+                      1.5e20, 300.0, -12.345678901234567])
+LABELS = ["{:05d}".format(i) for i in range(len(VALUES))]
+
+
+@pytest.mark.parametrize("columns", [
+    (VALUES, "2020-01-01", LABELS),
+    # wide layout: several bands
+    (VALUES, VALUES[::-1].copy(), "2020-01-01", LABELS),
+    # points: dates vary, constant metadata
+    (VALUES, ["2020-01-{:02d}".format(i + 1) for i in range(len(VALUES))],
+     "S0001", "MA"),
+    # labels, that are not strings
+    (VALUES, "2020-01-01", list(range(len(VALUES)))),
+])
+def test_csv_write_columns_same_as_rows(columns):
+    expected = write_csv(Collector.write_columns, *columns)
+    actual = write_csv(CSVWriter.write_columns, *columns)
+    assert actual == expected
+    lines = actual.split("\r\n")
+    assert lines[-1] == "" and len(lines) == len(VALUES) + 1
+    # missing values are empty, other values have all digits
+    assert lines[1].startswith(",")
+    assert lines[0].startswith("280.15000000000003,")
+    assert lines[4].startswith("1e-07,")
+
+
+def test_csv_write_columns_with_precision():
+    actual = write_csv(CSVWriter.write_columns, VALUES, "2020-01-01", LABELS)
+    out = io.StringIO(newline="")
+    writer = CSVWriter(out, precision=2)
+    writer.write_columns(VALUES, "2020-01-01", LABELS)
+    rounded = [line.split(",")[0] for line in out.getvalue().split("\r\n")]
+    assert rounded[:3] == ["280.15", "", "0.1"]
+    assert len(actual) > len(out.getvalue())
@@ -0,0 +1,205 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Tests of resumable downloads against a local HTTP server, that honours
+Range requests and can drop connections in the middle of a transfer
+"""
+
+import os
+import re
+import shutil
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from gridmet.download import ResumableDownload
+
+
+DATA = os.urandom(1024 * 1024 + 123)
+MODIFIED = formatdate(1600000000, usegmt=True)
+
+
+class RangeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.drops = 0
+        '''Number of following GET responses to cut in the middle'''
+        self.ranges = []
+        '''Values of Range headers received'''
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{:d}/data.nc".format(self.server_address[1])
+
+    def take_drop(self) -> bool:
+        with self.lock:
+            if self.drops > 0:
+                self.drops -= 1
+                return True
+            return False
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_common_headers(self, length: int):
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", MODIFIED)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_common_headers(len(DATA))
+        self.end_headers()
+
+    def do_GET(self):
+        start, end = 0, len(DATA) - 1
+        status = 200
+        header = self.headers.get("Range")
+        if header:
+            with self.server.lock:
+                self.server.ranges.append(header)
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", header)
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            status = 206
+        body = DATA[start:end + 1]
+        self.send_response(status)
+        self.send_common_headers(len(body))
+        if status == 206:
+            self.send_header("Content-Range", "bytes {:d}-{:d}/{:d}".format(
+                start, end, len(DATA)
+            ))
+        self.end_headers()
+        if self.server.take_drop():
+            # a part of the body, then the connection is lost
+            self.wfile.write(body[:len(body) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = RangeServer()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def leftovers(target: str):
+    d = os.path.dirname(target)
+    name = os.path.basename(target)
+    return sorted(f for f in os.listdir(d) if f.startswith(name + "."))
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+def test_download(server, tmp_path, segments):
+    target = str(tmp_path / "data.nc")
+    assert ResumableDownload(server.url, target, segments).execute()
+    with open(target, "rb") as f:
+        assert f.read() == DATA
+    assert leftovers(target) == []
+    assert not ResumableDownload(server.url, target, segments).execute()
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+def test_interrupted_segment_is_retried(server, tmp_path, segments):
+    target = str(tmp_path / "data.nc")
+    server.drops = 2
+    download = ResumableDownload(server.url, target, segments)
+    assert download.execute()
+    with open(target, "rb") as f:
+        assert f.read() == DATA
+    # retried segments continue from the received bytes
+    starts = {start for start, _ in download.split()}
+    offsets = [int(r[len("bytes="):].split("-")[0]) for r in server.ranges]
+    assert any(offset not in starts for offset in offsets)
+    assert leftovers(target) == []
+
+
+def test_resume_after_failed_download(server, tmp_path):
+    target = str(tmp_path / "data.nc")
+    server.drops = ResumableDownload.RETRIES
+    with pytest.raises(IOError):
+        ResumableDownload(server.url, target).execute()
+    received = os.path.getsize(target + ".part0")
+    assert 0 < received < len(DATA)
+    assert not os.path.exists(target)
+
+    server.ranges.clear()
+    assert ResumableDownload(server.url, target).execute()
+    assert server.ranges == ["bytes={:d}-".format(received)]
+    with open(target, "rb") as f:
+        assert f.read() == DATA
+    assert leftovers(target) == []
+
+
+def test_failed_assembly_is_repeated(server, tmp_path, monkeypatch):
+    target = str(tmp_path / "data.nc")
+    copy = shutil.copyfileobj
+    calls = []
+
+    def crash(reader, writer, *args):
+        calls.append(1)
+        if len(calls) == 2:
+            raise OSError("Simulated crash")
+        copy(reader, writer, *args)
+
+    monkeypatch.setattr(shutil, "copyfileobj", crash)
+    with pytest.raises(OSError):
+        ResumableDownload(server.url, target, 4).execute()
+    monkeypatch.setattr(shutil, "copyfileobj", copy)
+    assert not os.path.exists(target)
+    assert not os.path.exists(target + ".assembling")
+    # complete parts are kept and not downloaded again
+    server.ranges.clear()
+    assert ResumableDownload(server.url, target, 4).execute()
+    assert server.ranges == []
+    with open(target, "rb") as f:
+        assert f.read() == DATA
+    assert leftovers(target) == []
+
+
+def test_size_mismatch_keeps_parts(server, tmp_path):
+    target = str(tmp_path / "data.nc")
+    download = ResumableDownload(server.url, target, 4)
+    assert download.execute()
+    # parts of a download, one of them truncated
+    ranges = download.split()
+    for i, (start, end) in enumerate(ranges):
+        with open(download.part(i), "wb") as f:
+            f.write(DATA[start:end + 1 if i != 1 else end])
+    with pytest.raises(IOError):
+        download.assemble(len(ranges))
+    assert not os.path.exists(target + ".assembling")
+    assert all(os.path.isfile(download.part(i)) for i in range(len(ranges)))
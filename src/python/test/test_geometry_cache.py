@@ -0,0 +1,97 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Tests of invalidation of cached shapefiles
+"""
+
+import os
+
+import pytest
+import shapefile as pyshp
+
+from gridmet.geometry_cache import GeometryCache
+
+
+WGS84 = 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",' \
+        'SPHEROID["WGS_1984",6378137.0,298.257223563]],' \
+        'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]'
+
+
+def write_shapefile(path: str, labels):
+    with pyshp.Writer(path, shapeType=pyshp.POLYGON) as writer:
+        writer.field("ZIP", "C", size=5)
+        for i, label in enumerate(labels):
+            writer.poly([[[i, 0], [i, 1], [i + 1, 1], [i + 1, 0], [i, 0]]])
+            writer.record(label)
+
+
+def touch(path: str, offset: int):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + offset))
+
+
+@pytest.fixture
+def shapefile(tmp_path):
+    path = str(tmp_path / "zip.shp")
+    write_shapefile(path, ["00001", "00002"])
+    return path
+
+
+def test_cached_geometries(tmp_path, shapefile):
+    cache = GeometryCache(str(tmp_path / "cache"))
+    cached = cache.load(shapefile)
+    assert len(cached) == 2
+    assert cached.properties("ZIP") == ["00001", "00002"]
+    assert cached.ids is None
+    cache.store_ids(shapefile, ["1", "2"])
+    assert cache.load(shapefile).ids == ["1", "2"]
+
+
+@pytest.mark.parametrize("ext", [".dbf", ".shx", ".prj"])
+def test_modified_sidecar_invalidates_entry(tmp_path, shapefile, ext):
+    cache = GeometryCache(str(tmp_path / "cache"))
+    cache.load(shapefile)
+    cache.store_ids(shapefile, ["1", "2"])
+    path = cache.path(shapefile)
+    sidecar = shapefile[:-4] + ext
+    if ext == ".prj":
+        with open(sidecar, "wt") as f:
+            f.write(WGS84)
+    else:
+        touch(sidecar, 1_000_000_000)
+    assert cache.path(shapefile) != path
+    assert cache.load(shapefile).ids is None
+
+
+def test_edited_attributes_are_reloaded(tmp_path, shapefile):
+    cache = GeometryCache(str(tmp_path / "cache"))
+    cache.load(shapefile)
+    # the same geometries, only attributes are edited
+    shp = shapefile[:-4]
+    stat = os.stat(shapefile)
+    with pyshp.Reader(shapefile) as reader:
+        shapes = reader.shapes()
+    with pyshp.Writer(dbf=shp + ".dbf") as writer:
+        writer.field("ZIP", "C", size=5)
+        writer.record("00003")
+        writer.record("00004")
+    os.utime(shapefile, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert len(shapes) == 2
+    assert cache.load(shapefile).properties("ZIP") == ["00003", "00004"]
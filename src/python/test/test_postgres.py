@@ -0,0 +1,160 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Tests of copying the results into a local PostgreSQL database.
+
+The tests are skipped unless GRIDMET_TEST_DSN environment variable
+contains a connection string of a database, in which the tests
+can create and drop a schema, e.g.:
+
+    GRIDMET_TEST_DSN="host=localhost dbname=test" pytest test
+"""
+
+import datetime
+import os
+
+import numpy
+import pytest
+
+from gridmet.collectors import PostgresCopyWriter, CSVWriter
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+
+SCHEMA = "gridmet_test"
+TABLE = SCHEMA + ".zip_tmmx"
+HEADER = ["tmmx", "date", "zip"]
+KEYS = ["2138", "2139", "10001", "90210"]
+
+
+@pytest.fixture
+def connection():
+    dsn = os.environ.get("GRIDMET_TEST_DSN")
+    if not dsn:
+        pytest.skip("GRIDMET_TEST_DSN is not set")
+    cn = psycopg2.connect(dsn)
+    with cn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(SCHEMA))
+        cursor.execute("CREATE SCHEMA {}".format(SCHEMA))
+        cursor.execute(
+            "CREATE TABLE {} (tmmx numeric, observation_date date, "
+            "zip int, PRIMARY KEY (zip, observation_date))".format(TABLE)
+        )
+    cn.commit()
+    yield cn
+    cn.rollback()
+    with cn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+    cn.commit()
+    cn.close()
+
+
+def values(day: int, run: int) -> numpy.ndarray:
+    return numpy.array([280.5, numpy.nan, 290.25, 1.0e-3]) + day + 100 * run
+
+
+def date(day: int) -> str:
+    return (datetime.date(2020, 1, 1)
+            + datetime.timedelta(days=day)).strftime("%Y-%m-%d")
+
+
+def run_task(connection, days, run: int, day_block: int = 1,
+             fail_after: int = None):
+    """
+    Copies the values of given days into the table in a single
+    transaction, the same way as `open_collector()`
+
+    :param days: Days to write
+    :param run: Number of the run, defining the values
+    :param day_block: Number of days written before every flush
+    :param fail_after: Number of days written before the task fails
+    """
+
+    writer = PostgresCopyWriter(connection, TABLE, HEADER)
+    try:
+        for i, day in enumerate(days):
+            if i == fail_after:
+                raise RuntimeError("Task has failed")
+            writer.write_columns(values(day, run), date(day), KEYS)
+            if (i + 1) % day_block == 0:
+                writer.flush()
+        writer.flush()
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+
+
+def fetch(connection) -> dict:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT observation_date, zip, tmmx FROM " + TABLE)
+        rows = cursor.fetchall()
+    return {
+        (d.strftime("%Y-%m-%d"), str(z)): None if v is None else float(v)
+        for d, z, v in rows
+    }
+
+
+def expected(runs) -> dict:
+    table = dict()
+    for days, run in runs:
+        for day in days:
+            for key, value in zip(KEYS, values(day, run)):
+                table[(date(day), key)] = None if value != value else value
+    return table
+
+
+@pytest.mark.parametrize("day_block", [1, 2])
+def test_rerun_replaces_rows_of_same_days(connection, day_block):
+    run_task(connection, range(0, 3), 0, day_block)
+    run_task(connection, range(1, 5), 1, day_block)
+    assert fetch(connection) == expected([(range(0, 3), 0),
+                                          (range(1, 5), 1)])
+
+
+def test_rerun_after_failure(connection):
+    run_task(connection, range(0, 2), 0)
+    with pytest.raises(RuntimeError):
+        run_task(connection, range(0, 4), 1, fail_after=3)
+    assert fetch(connection) == expected([(range(0, 2), 0)])
+    run_task(connection, range(0, 4), 2)
+    assert fetch(connection) == expected([(range(0, 4), 2)])
+
+
+def test_rerun_appending_parts(connection, tmp_path):
+    # as in ComputeGridmetTask.collect_data_parallel()
+    run_task(connection, range(0, 3), 0)
+    parts = []
+    for i, days in enumerate([range(2, 4), range(4, 6)]):
+        path = str(tmp_path / "{:d}.csv".format(i))
+        with open(path, "wt", newline="") as out:
+            writer = CSVWriter(out)
+            writer.writerow(HEADER)
+            for day in days:
+                writer.write_columns(values(day, 1), date(day), KEYS)
+        parts.append(path)
+    for _ in range(2):
+        writer = PostgresCopyWriter(connection, TABLE, HEADER)
+        for path in parts:
+            writer.append_file(path)
+            writer.flush()
+        connection.commit()
+    assert fetch(connection) == expected([(range(0, 3), 0),
+                                          (range(2, 6), 1)])
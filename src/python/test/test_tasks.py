@@ -0,0 +1,229 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Tests of compute tasks on small synthetic gridMET files
+"""
+
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+from gridmet.collectors import OutputOptions
+from gridmet.config import Shape, BandsLayout, GridmetVariable, \
+    WeightingStrategy, Scheduler
+from gridmet.engine import ChunkedEngine
+from gridmet.task import GridmetTask, GridmetBandsTask, ComputeBandsTask, \
+    ComputeShapesTask
+from nsaph_gis.constants import Geography, RasterizationStrategy
+from test.conftest import read_text
+
+
+RASTERIZATION = [RasterizationStrategy.default,
+                 RasterizationStrategy.all_touched,
+                 RasterizationStrategy.combined,
+                 RasterizationStrategy.downscale]
+
+
+def compute_shapes(grid, tmp_path, strategy, name: str, **kwargs) -> str:
+    """
+    Aggregates the synthetic file over the polygons
+
+    :return: Content of the resulting CSV file
+    """
+
+    outfile = str(tmp_path / "{}_{}.csv".format(strategy.value, name))
+    task = ComputeShapesTask(2001, GridmetVariable.tmmx, grid.netcdf,
+                             outfile, strategy, grid.shapefile,
+                             Geography.zip, **kwargs)
+    task.execute()
+    return read_text(outfile)
+
+
+def make_context(tmp_path, **options) -> SimpleNamespace:
+    context = SimpleNamespace(
+        variables=[GridmetVariable.tmmx], shapes=[Shape.point],
+        points=str(tmp_path / "points.csv"), layout=BandsLayout.separate,
+        resume=False, incremental=False
+    )
+    for name, value in options.items():
+        setattr(context, name, value)
+    return context
+
+
+def test_resume_is_rejected_for_points(tmp_path):
+    context = make_context(tmp_path, resume=True)
+    with pytest.raises(Exception, match="not supported for points"):
+        GridmetTask(context, 2001, GridmetVariable.tmmx)
+
+
+def test_incremental_mode_is_rejected_for_points(tmp_path):
+    context = make_context(tmp_path, incremental=True)
+    with pytest.raises(Exception, match="not supported for points"):
+        GridmetTask(context, 2001, GridmetVariable.tmmx)
+
+
+def test_resume_is_rejected_for_fused_bands(tmp_path):
+    context = make_context(tmp_path, resume=True, shapes=[Shape.polygon],
+                           layout=BandsLayout.fused)
+    with pytest.raises(Exception, match="only for separate layout"):
+        GridmetBandsTask(context, 2001)
+
+
+def test_compute_bands_task_rejects_resume(tmp_path):
+    variables = [GridmetVariable.tmmx, GridmetVariable.tmmn]
+    task = ComputeBandsTask(
+        2001, variables, [str(tmp_path / "missing.nc")] * 2,
+        [str(tmp_path / "a.csv"), str(tmp_path / "b.csv")],
+        RasterizationStrategy.default, str(tmp_path / "missing.shp"),
+        Geography.zip
+    )
+    task.options = OutputOptions(resumable=True)
+    with pytest.raises(ValueError, match="resuming are not supported"):
+        task.execute()
+
+
+@pytest.mark.parametrize("strategy", RASTERIZATION)
+@pytest.mark.parametrize("day_block", [3, 4, 32])
+def test_cube_mode_same_as_per_day(grid, tmp_path, strategy, day_block):
+    expected = compute_shapes(grid, tmp_path, strategy, "day")
+    actual = compute_shapes(grid, tmp_path, strategy, "cube",
+                            day_block=day_block)
+    assert len(expected.splitlines()) == 40 * 10 + 1
+    assert actual == expected
+
+
+@pytest.mark.parametrize("strategy", [RasterizationStrategy.default,
+                                      RasterizationStrategy.downscale])
+@pytest.mark.parametrize("day_block", [1, 3])
+@pytest.mark.parametrize("workers", [2, 3])
+def test_parallel_days_same_as_serial(grid, tmp_path, strategy, day_block,
+                                      workers):
+    expected = compute_shapes(grid, tmp_path, strategy, "serial",
+                              day_block=day_block)
+    actual = compute_shapes(grid, tmp_path, strategy, "parallel",
+                            day_block=day_block, workers=workers)
+    assert actual == expected
+
+
+def test_parallel_days_same_as_serial_parquet(grid, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    tables = []
+    for workers in [1, 2]:
+        outfile = str(tmp_path / "{:d}.parquet".format(workers))
+        ComputeShapesTask(2001, GridmetVariable.tmmx, grid.netcdf, outfile,
+                          RasterizationStrategy.default, grid.shapefile,
+                          Geography.zip, workers=workers).execute()
+        tables.append(pq.read_table(outfile))
+    assert tables[0].num_rows == 40 * 10
+    assert tables[1].equals(tables[0])
+
+
+@pytest.mark.parametrize("strategy", [RasterizationStrategy.default,
+                                      RasterizationStrategy.combined])
+@pytest.mark.parametrize("day_block", [1, 3])
+def test_fused_bands_same_as_separate(grid, tmp_path, strategy, day_block):
+    bands = [GridmetVariable.tmmx, GridmetVariable.tmmn]
+    infiles = [grid.netcdf, grid.tmmn]
+    separate = []
+    for band, infile in zip(bands, infiles):
+        outfile = str(tmp_path / "{}.csv".format(band.value))
+        ComputeShapesTask(2001, band, infile, outfile, strategy,
+                          grid.shapefile, Geography.zip,
+                          day_block=day_block).execute()
+        separate.append(read_text(outfile))
+    assert separate[0] != separate[1]
+
+    outfiles = [str(tmp_path / "fused_{}.csv".format(band.value))
+                for band in bands]
+    ComputeBandsTask(2001, bands, infiles, outfiles, strategy,
+                     grid.shapefile, Geography.zip,
+                     day_block=day_block).execute()
+    assert [read_text(f) for f in outfiles] == separate
+
+    wide = str(tmp_path / "wide.csv")
+    ComputeBandsTask(2001, bands, infiles, outfiles, strategy,
+                     grid.shapefile, Geography.zip, day_block=day_block,
+                     wide_file=wide).execute()
+    rows = [line.split(",") for line in read_text(wide).splitlines()]
+    assert rows[0] == ["tmmx", "tmmn", "date", "zip"]
+    for i, text in enumerate(separate):
+        lines = text.splitlines()
+        assert lines[0].split(",")[0] == bands[i].value
+        assert [[row[i]] + row[2:] for row in rows[1:]] == \
+            [line.split(",") for line in lines[1:]]
+
+
+def read_values(path: str):
+    """
+    :return: Means as floats (NaN for empty values) and the remaining
+        columns of a CSV file
+    """
+
+    lines = read_text(path).splitlines()[1:]
+    rows = [line.split(",") for line in lines]
+    values = [float(row[0]) if row[0] else numpy.nan for row in rows]
+    return numpy.array(values), [row[1:] for row in rows]
+
+
+@pytest.mark.parametrize("strategy, rtol", [
+    (strategy, 0) for strategy in RASTERIZATION
+] + [(WeightingStrategy.area_weighted, 1e-9)])
+def test_window_same_as_full_grid(grid, tmp_path, strategy, rtol):
+    results = []
+    for name in ["window", "full"]:
+        outfile = str(tmp_path / "{}.csv".format(name))
+        task = ComputeShapesTask(2001, GridmetVariable.tmmx, grid.netcdf,
+                                 outfile, strategy, grid.shapefile,
+                                 Geography.zip)
+        if name == "full":
+            task.window = (slice(None), slice(None))
+        task.execute()
+        if name == "window":
+            rows, cols = task.window
+            assert (rows.stop - rows.start) * (cols.stop - cols.start) \
+                < 48 * 64 / 2
+        results.append(read_values(outfile))
+    (actual, labels), (expected, expected_labels) = results
+    assert labels == expected_labels
+    numpy.testing.assert_allclose(actual, expected, rtol=rtol, atol=0)
+
+
+@pytest.mark.parametrize("scheduler", [Scheduler.threads,
+                                       Scheduler.processes])
+def test_chunked_engine_same_as_eager(grid, tmp_path, scheduler):
+    engine = ChunkedEngine(scheduler, 2)
+    tasks = []
+    for band, infile in [(GridmetVariable.tmmx, grid.netcdf),
+                         (GridmetVariable.tmmn, grid.tmmn)]:
+        outfile = str(tmp_path / "{}.csv".format(band.value))
+        task = ComputeShapesTask(2001, band, infile, outfile,
+                                 RasterizationStrategy.default,
+                                 grid.shapefile, Geography.zip, day_block=3)
+        engine.add(task)
+        tasks.append(task)
+    engine.execute()
+    for task in tasks:
+        assert task.dataset is None
+        expected = str(tmp_path / "eager.csv")
+        ComputeShapesTask(2001, task.band, task.infile, expected,
+                          RasterizationStrategy.default, grid.shapefile,
+                          Geography.zip).execute()
+        assert read_text(task.outfile) == read_text(expected)
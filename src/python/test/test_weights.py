@@ -0,0 +1,81 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Tests of consistency checks of zonal weights
+"""
+
+from types import SimpleNamespace
+
+import numpy
+import pytest
+from rasterio import Affine
+from scipy import sparse
+
+from gridmet import weights as weights_module
+from gridmet.weights import ZonalWeights
+from nsaph_gis.constants import RasterizationStrategy
+from utils.benchmark import make_polygons, CELL, ORIGIN
+
+
+def make_weights() -> ZonalWeights:
+    # geography "a" covers cells 0 and 1, "b" cells 2 and 3
+    matrix = sparse.csr_matrix(numpy.array([
+        [1.0, 1.0, 0.0, 0.0],
+        [0.0, 0.0, 1.0, 1.0]
+    ]))
+    return ZonalWeights(["a", "b"], matrix)
+
+
+def make_layer() -> numpy.ma.MaskedArray:
+    layer = numpy.ma.MaskedArray(numpy.array([[1.0, 3.0], [5.0, 7.0]]))
+    layer[1, 1] = numpy.ma.masked
+    return layer
+
+
+def test_verify_skips_geographies_with_masked_cells():
+    # masked cells may be treated differently by StatsCounter
+    make_weights().verify([2.0, 6.0], make_layer())
+    make_weights().verify([2.0, None], make_layer())
+
+
+def test_verify_raises_on_mismatch():
+    with pytest.raises(ValueError, match="differ from StatsCounter"):
+        make_weights().verify([2.5, 5.0], make_layer())
+
+
+def test_build_checks_number_of_labels(tmp_path, monkeypatch):
+    shapefile = str(tmp_path / "zip.shp")
+    make_polygons(shapefile, 5, 0.2,
+                  (ORIGIN[0], ORIGIN[1] - 20 * CELL,
+                   ORIGIN[0] + 20 * CELL, ORIGIN[1]))
+    affine = Affine(CELL, 0.0, ORIGIN[0], 0.0, -CELL, ORIGIN[1])
+    layer = numpy.ma.MaskedArray(numpy.ones((20, 20)))
+
+    class StatsCounter:
+        @staticmethod
+        def process(strategy, shapefile, affine, layer):
+            # one of the shapes is skipped
+            return [SimpleNamespace(prop="{:05d}".format(i), mean=1.0)
+                    for i in range(4)]
+
+    monkeypatch.setattr(weights_module, "StatsCounter", StatsCounter)
+    with pytest.raises(ValueError, match="4 labels for 5 shapes"):
+        ZonalWeights.build(RasterizationStrategy.default, shapefile,
+                           affine, layer)
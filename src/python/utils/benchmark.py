@@ -0,0 +1,496 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Benchmarks of gridMET computations on synthetic data.
+
+Generates a gridMET-shaped netCDF4 file (configurable grid size,
+number of days, packing and chunking), a shapefile with square
+polygons and a CSV file with points, then times aggregation over
+polygons with every strategy, interpolation to points,
+`disaggregate`, `get_affine_transform` and `CSVWriter`. Every
+benchmark runs in a separate process, its wall time and peak
+resident memory are written as JSON, e.g.:
+
+    python -m utils.benchmark --days 30 --polygons 2000 -o bench.json
+    python -m utils.benchmark --days 30 --polygons 2000 --baseline bench.json
+
+Runs offline, no downloads are needed.
+
+To compare with a commit older than this harness, copy this file into
+`src/python/utils/` of the tree checked out at that commit and run it
+there. Features that do not exist yet in such a tree (`area_weighted`
+strategy, blocks of days, `CSVWriter.write_columns`) are skipped or
+replaced by what the tree supports; they are recorded in "features"
+of the report.
+"""
+
+import argparse
+import csv
+import inspect
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy
+import shapefile as pyshp
+from netCDF4 import Dataset
+
+from gridmet.config import GridmetVariable
+from gridmet.gridmet_tools import get_affine_transform, disaggregate
+from gridmet.task import ComputeShapesTask, ComputePointsTask
+from nsaph_gis.constants import Geography, RasterizationStrategy
+
+# Older trees, that can be benchmarked as well, lack some of the APIs
+try:
+    from gridmet.collectors import CSVWriter
+except ImportError:
+    from gridmet.task import CSVWriter
+try:
+    from gridmet.config import WeightingStrategy
+except ImportError:
+    WeightingStrategy = None
+
+VARIABLE = GridmetVariable.tmmx
+CELL = 1 / 24
+ORIGIN = (-124.79, 49.4)
+FILL_VALUE = 32767
+
+
+def make_netcdf(path: str, nlat: int, nlon: int, days: int,
+                packed: bool = True, chunk_days: int = 0, seed: int = 0):
+    """
+    Creates a netCDF4 file shaped like a gridMET file:
+    dimensions (day, lat, lon), latitudes in descending order and
+    a variable identified by its standard name
+
+    :param path: Path to the file
+    :param nlat: Number of rows of the grid
+    :param nlon: Number of columns of the grid
+    :param days: Number of days
+    :param packed: If True, values are packed into 16-bit integers
+        with scale factor and offset, as in gridMET files
+    :param chunk_days: Number of days in a chunk, 0 means a
+        contiguous variable
+    :param seed: Seed of random values
+    """
+
+    rng = numpy.random.default_rng(seed)
+    with Dataset(path, "w") as ds:
+        ds.createDimension("day", days)
+        ds.createDimension("lat", nlat)
+        ds.createDimension("lon", nlon)
+        lat = ds.createVariable("lat", "f8", ("lat",))
+        lat.units = "degrees_north"
+        lat[:] = ORIGIN[1] - (numpy.arange(nlat) + 0.5) * CELL
+        lon = ds.createVariable("lon", "f8", ("lon",))
+        lon.units = "degrees_east"
+        lon[:] = ORIGIN[0] + (numpy.arange(nlon) + 0.5) * CELL
+        day = ds.createVariable("day", "f8", ("day",))
+        day.units = "days since 1900-01-01 00:00:00"
+        day[:] = 36890 + numpy.arange(days)
+
+        kwargs = dict(fill_value=FILL_VALUE)
+        if chunk_days > 0:
+            kwargs.update(chunksizes=(chunk_days, nlat, nlon), zlib=True)
+        else:
+            kwargs.update(contiguous=True)
+        dtype = "u2" if packed else "f4"
+        var = ds.createVariable("air_temperature", dtype,
+                                ("day", "lat", "lon"), **kwargs)
+        var.standard_name = VARIABLE.value
+        var.units = "K"
+        if packed:
+            var.scale_factor = 0.1
+            var.add_offset = 220.0
+        # Smooth field with noise, the corner of the grid has no data
+        y, x = numpy.mgrid[0:nlat, 0:nlon]
+        base = 270 + 20 * numpy.sin(x / 40) * numpy.cos(y / 30)
+        corner = (slice(0, max(nlat // 10, 1)), slice(0, max(nlon // 10, 1)))
+        for d in range(days):
+            layer = base + rng.normal(0, 2, (nlat, nlon)) + 5 * numpy.sin(d)
+            layer = numpy.ma.masked_array(layer, mask=False)
+            layer[corner] = numpy.ma.masked
+            var[d, :, :] = layer
+
+
+def grid_bounds(nlat: int, nlon: int):
+    return (ORIGIN[0], ORIGIN[1] - nlat * CELL,
+            ORIGIN[0] + nlon * CELL, ORIGIN[1])
+
+
+def make_polygons(path: str, n: int, size: float, bounds, seed: int = 0):
+    """
+    Creates a shapefile with square polygons labeled as zip codes
+
+    :param path: Path to the shapefile
+    :param n: Number of polygons
+    :param size: Side of a square in degrees
+    :param bounds: (minx, miny, maxx, maxy) of the grid
+    :param seed: Seed of random positions
+    """
+
+    rng = numpy.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    x = rng.uniform(minx, maxx - size, n)
+    y = rng.uniform(miny, maxy - size, n)
+    with pyshp.Writer(path, shapeType=pyshp.POLYGON) as writer:
+        writer.field("ZIP", "C", size=5)
+        for i in range(n):
+            x0, y0 = x[i], y[i]
+            writer.poly([[[x0, y0], [x0, y0 + size], [x0 + size, y0 + size],
+                          [x0 + size, y0], [x0, y0]]])
+            writer.record("{:05d}".format(i + 1))
+
+
+def make_points(path: str, n: int, bounds, seed: int = 0):
+    """
+    Creates a CSV file with points labeled as monitoring sites
+
+    :param path: Path to the file
+    :param n: Number of points
+    :param bounds: (minx, miny, maxx, maxy) of the grid
+    :param seed: Seed of random positions
+    """
+
+    rng = numpy.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    x = rng.uniform(minx, maxx, n)
+    y = rng.uniform(miny, maxy, n)
+    with open(path, "wt", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["site_id", "Longitude", "Latitude"])
+        for i in range(n):
+            writer.writerow(["S{:07d}".format(i + 1), x[i], y[i]])
+
+
+class Fixtures:
+    """
+    Synthetic input files, generated once per set of parameters
+    """
+
+    def __init__(self, args):
+        self.args = args
+        name = "{:d}x{:d}x{:d}_{}_{:d}".format(
+            args.nlat, args.nlon, args.days,
+            "packed" if args.packed else "float", args.chunk_days
+        )
+        self.directory = os.path.join(args.workdir, name)
+        self.netcdf = os.path.join(self.directory, "tmmx_2001.nc")
+        self.shapefile = os.path.join(
+            self.directory, "polygons_{:d}_{:g}.shp".format(
+                args.polygons, args.polygon_size
+            )
+        )
+        self.points = os.path.join(
+            self.directory, "points_{:d}.csv".format(args.points)
+        )
+        self.output = os.path.join(self.directory, "output")
+
+    def generate(self):
+        args = self.args
+        os.makedirs(self.output, exist_ok=True)
+        bounds = grid_bounds(args.nlat, args.nlon)
+        if not os.path.isfile(self.netcdf):
+            logging.info("Generating %s", self.netcdf)
+            make_netcdf(self.netcdf, args.nlat, args.nlon, args.days,
+                        args.packed, args.chunk_days)
+        if not os.path.isfile(self.shapefile):
+            logging.info("Generating %s", self.shapefile)
+            make_polygons(self.shapefile, args.polygons, args.polygon_size,
+                          bounds)
+        if not os.path.isfile(self.points):
+            logging.info("Generating %s", self.points)
+            make_points(self.points, args.points, bounds)
+
+
+def weighting_strategies() -> List:
+    return list(WeightingStrategy) if WeightingStrategy is not None else []
+
+
+def strategies() -> List:
+    return [s for s in RasterizationStrategy
+            if s.value in ("default", "all_touched", "combined",
+                           "downscale")] + weighting_strategies()
+
+
+def task_options(cls, **options) -> Dict:
+    """
+    Selects keyword arguments accepted by the constructor of a task,
+    so that trees, in which the task does not yet have some options,
+    can be benchmarked
+
+    :param cls: Class of the task
+    :param options: Keyword arguments
+    :return: Accepted keyword arguments
+    """
+
+    accepted = inspect.signature(cls.__init__).parameters
+    return {
+        name: value for name, value in options.items() if name in accepted
+    }
+
+
+def features() -> Dict:
+    """
+    :return: Optional features supported by the benchmarked tree
+    """
+
+    return {
+        "weighting_strategies": [s.value for s in weighting_strategies()],
+        "day_block": "day_block" in task_options(ComputeShapesTask,
+                                                 day_block=1),
+        "write_columns": hasattr(CSVWriter, "write_columns")
+    }
+
+
+def bench_shapes(fixtures: Fixtures, strategy: str) -> int:
+    if strategy in [s.value for s in weighting_strategies()]:
+        strategy = WeightingStrategy(strategy)
+    else:
+        strategy = RasterizationStrategy[strategy]
+    outfile = os.path.join(fixtures.output,
+                           "shapes_{}.csv".format(strategy.value))
+    task = ComputeShapesTask(2001, VARIABLE, fixtures.netcdf, outfile,
+                             strategy, fixtures.shapefile, Geography.zip,
+                             **task_options(ComputeShapesTask,
+                                            day_block=fixtures.args.day_block))
+    task.execute()
+    return fixtures.args.polygons * fixtures.args.days
+
+
+def bench_points(fixtures: Fixtures) -> int:
+    outfile = os.path.join(fixtures.output, "points.csv")
+    task = ComputePointsTask(2001, VARIABLE, fixtures.netcdf, outfile,
+                             fixtures.points, ["Longitude", "Latitude"],
+                             ["site_id"],
+                             **task_options(ComputePointsTask,
+                                            day_block=fixtures.args.day_block))
+    task.execute()
+    return fixtures.args.points * fixtures.args.days
+
+
+def bench_disaggregate(fixtures: Fixtures) -> int:
+    with Dataset(fixtures.netcdf) as ds:
+        layer = ds["air_temperature"][0, :, :]
+    for _ in range(fixtures.args.repeat):
+        disaggregate(layer, 5)
+    return fixtures.args.repeat
+
+
+def bench_affine(fixtures: Fixtures) -> int:
+    for _ in range(fixtures.args.repeat):
+        get_affine_transform(fixtures.netcdf, 5)
+    return fixtures.args.repeat
+
+
+def bench_csv_writer(fixtures: Fixtures) -> int:
+    args = fixtures.args
+    rng = numpy.random.default_rng(0)
+    values = rng.uniform(250, 310, args.polygons)
+    values[::50] = numpy.nan
+    labels = ["{:05d}".format(i + 1) for i in range(args.polygons)]
+    out = io.StringIO()
+    writer = CSVWriter(out)
+    for d in range(args.days):
+        date = "2001-01-{:02d}".format(d % 28 + 1)
+        if hasattr(writer, "write_columns"):
+            writer.write_columns(values, date, labels)
+        else:
+            for value, label in zip(values, labels):
+                writer.writerow([value, date, label])
+        out.seek(0)
+        out.truncate()
+    return args.polygons * args.days
+
+
+BENCHMARKS = {
+    "get_affine_transform": bench_affine,
+    "disaggregate": bench_disaggregate,
+    "csv_writer": bench_csv_writer,
+    "points": bench_points,
+}
+
+
+def benchmark_names() -> List[str]:
+    return ["shapes_" + s.value for s in strategies()] + list(BENCHMARKS)
+
+
+def run_one(name: str, args) -> Dict:
+    """
+    Runs a single benchmark, called in a new process
+
+    :param name: Name of the benchmark
+    :param args: Parsed command line arguments
+    :return: Result of the benchmark
+    """
+
+    logging.basicConfig(level=logging.WARNING)
+    fixtures = Fixtures(args)
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    if name.startswith("shapes_"):
+        items = bench_shapes(fixtures, name[len("shapes_"):])
+    else:
+        items = BENCHMARKS[name](fixtures)
+    wall = time.perf_counter() - t0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "name": name,
+        "wall_s": round(wall, 4),
+        "items": items,
+        "items_per_s": round(items / wall, 1) if wall > 0 else None,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(rss / 1024, 1),
+        "baseline_rss_mb": round(rss0 / 1024, 1)
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> Dict:
+    fixtures = Fixtures(args)
+    fixtures.generate()
+    names = args.only or benchmark_names()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in names:
+        logging.info("Running %s", name)
+        try:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_one, (name, args))
+        except Exception as x:
+            logging.exception("Benchmark %s has failed", name)
+            result = {"name": name, "error": str(x)}
+        else:
+            logging.info("%s: %.3fs, peak RSS %.1f MB", name,
+                         result["wall_s"], result["peak_rss_mb"])
+        results.append(result)
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "features": features(),
+        "parameters": {
+            "nlat": args.nlat,
+            "nlon": args.nlon,
+            "days": args.days,
+            "packed": args.packed,
+            "chunk_days": args.chunk_days,
+            "polygons": args.polygons,
+            "polygon_size": args.polygon_size,
+            "points": args.points,
+            "day_block": args.day_block,
+            "repeat": args.repeat
+        },
+        "results": results
+    }
+
+
+def compare(report: Dict, baseline: Dict):
+    """
+    Prints wall time and peak memory relative to a baseline report
+    """
+
+    if baseline.get("parameters") != report["parameters"]:
+        print("Warning: parameters differ from the baseline")
+    if baseline.get("features") != report.get("features"):
+        print("Warning: benchmarked trees support different features")
+    before = {r["name"]: r for r in baseline["results"] if "error" not in r}
+    print("{:<28}{:>12}{:>12}{:>9}{:>12}{:>12}".format(
+        "benchmark", "base, s", "now, s", "ratio", "base, MB", "now, MB"
+    ))
+    for r in report["results"]:
+        b = before.get(r["name"])
+        if b is None or "error" in r:
+            continue
+        print("{:<28}{:>12.3f}{:>12.3f}{:>9.2f}{:>12.1f}{:>12.1f}".format(
+            r["name"], b["wall_s"], r["wall_s"],
+            r["wall_s"] / b["wall_s"] if b["wall_s"] else float("nan"),
+            b["peak_rss_mb"], r["peak_rss_mb"]
+        ))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    ap = argparse.ArgumentParser(
+        description="Benchmarks gridMET computations on synthetic data"
+    )
+    ap.add_argument("--nlat", type=int, default=585,
+                    help="Number of rows of the grid, default: 585")
+    ap.add_argument("--nlon", type=int, default=1386,
+                    help="Number of columns of the grid, default: 1386")
+    ap.add_argument("--days", type=int, default=10,
+                    help="Number of days, default: 10")
+    ap.add_argument("--float", dest="packed", action="store_false",
+                    help="Store values as floats instead of packed "
+                         "16-bit integers")
+    ap.add_argument("--chunk_days", type=int, default=0,
+                    help="Number of days in a chunk of the variable, "
+                         "0 means contiguous variable, default: 0")
+    ap.add_argument("--polygons", type=int, default=1000,
+                    help="Number of polygons, default: 1000")
+    ap.add_argument("--polygon_size", type=float, default=0.1,
+                    help="Side of a polygon in degrees, default: 0.1")
+    ap.add_argument("--points", type=int, default=1000,
+                    help="Number of points, default: 1000")
+    ap.add_argument("--day_block", type=int, default=1,
+                    help="Number of days aggregated at once, default: 1")
+    ap.add_argument("--repeat", type=int, default=20,
+                    help="Repetitions of fast benchmarks, default: 20")
+    ap.add_argument("--only", nargs="+", choices=benchmark_names(),
+                    help="Benchmarks to run, by default all")
+    ap.add_argument("--workdir", default="data/benchmark",
+                    help="Directory for generated files, "
+                         "default: data/benchmark")
+    ap.add_argument("--output", "-o",
+                    help="Resulting JSON file, by default printed")
+    ap.add_argument("--baseline",
+                    help="JSON file produced by a previous run to "
+                         "compare with")
+    arguments = ap.parse_args()
+
+    result = run(arguments)
+    text = json.dumps(result, indent=2)
+    if arguments.output:
+        with open(arguments.output, "wt") as out:
+            out.write(text)
+    else:
+        print(text)
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            compare(result, json.load(f))
@@ -0,0 +1,83 @@
+#  Copyright (c) 2021. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Compares aggregations of a gridMET file over shapes computed with
+`downscale` and `area_weighted` strategies
+"""
+
+import argparse
+
+import numpy
+from netCDF4._netCDF4 import Dataset
+
+from gridmet.config import WeightingStrategy
+from gridmet.gridmet_tools import get_affine_transform, get_variable
+from gridmet.weights import ZonalWeights
+from nsaph_gis.constants import RasterizationStrategy
+
+FACTOR = 5
+
+
+def compare(infile: str, band: str, shapefile: str, n_days: int,
+            top: int = 10):
+    dataset = Dataset(infile)
+    block = dataset[get_variable(dataset, band)][:n_days, :, :]
+
+    affine = get_affine_transform(infile, FACTOR)
+    downscale = ZonalWeights.get(RasterizationStrategy.downscale, shapefile,
+                                 affine, block[0], FACTOR)
+    affine = get_affine_transform(infile)
+    area = ZonalWeights.get(WeightingStrategy.area_weighted, shapefile,
+                            affine, block[0])
+
+    a = downscale.compute(block)
+    b = area.compute(block)
+    both = ~numpy.isnan(a) & ~numpy.isnan(b)
+    diff = numpy.abs(a - b)[both]
+
+    print("Geographies: {:d}, days: {:d}".format(a.shape[0], a.shape[1]))
+    print("No value with downscale: {:d}, with area_weighted: {:d}".format(
+        int(numpy.isnan(a[:, 0]).sum()), int(numpy.isnan(b[:, 0]).sum())
+    ))
+    if diff.size == 0:
+        return
+    stats = (diff.mean(), numpy.median(diff), numpy.percentile(diff, 95),
+             diff.max())
+    print("Absolute difference: mean = {:g}, median = {:g}, "
+          "95% = {:g}, max = {:g}".format(*stats))
+    by_geography = numpy.nanmax(
+        numpy.where(both, numpy.abs(a - b), numpy.nan), axis=1
+    )
+    print("Largest differences:")
+    for i in numpy.argsort(-numpy.nan_to_num(by_geography, nan=-1))[:top]:
+        print("\t{}: {:g}".format(area.keys[i], by_geography[i]))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--input", "-i", required=True,
+                    help="Downloaded gridMET file in NCDF4 format")
+    ap.add_argument("--band", "--var", required=True, help="Gridmet band")
+    ap.add_argument("--shape_file", "-s", required=True, help="Shapefile")
+    ap.add_argument("--days", type=int, default=7,
+                    help="Number of days to compare")
+    args = ap.parse_args()
+
+    compare(args.input, args.band, args.shape_file, args.days)
@@ -17,52 +17,242 @@
 #  limitations under the License.
 #
 
-import csv
+"""
+Removes from a gzipped CSV file (f1) the lines, whose integer code in
+column c1 is found in column c2 of another gzipped CSV file without
+header (f2). Columns are numbered from 1.
+
+    python -m utils.exclude_csv f1 c1 f2 c2
+
+The result is written next to f1 as `__<f1>`, the distinct codes of f2
+as `codes_<f2>`, one per line. Lines of f1 with a value in c1, that is
+not an integer, are kept.
+
+Codes are stored as a sorted array of 64-bit integers. f1 is filtered
+in blocks of lines: the codes of a block are extracted and looked up
+at once, while the next block is decompressed by a reader thread and
+the previous ones are compressed by a pool of threads.
+"""
+
+import argparse
 import gzip
+import io
 import os
-import sys
+import queue
+import threading
+from datetime import datetime
+from typing import Iterator, Tuple
 
+import numpy
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.csv
 
-if __name__ == '__main__':
-    f1 = sys.argv[1]
-    c1 = int(sys.argv[2]) - 1
-    f2 = sys.argv[3]
-    c2 = int(sys.argv[4]) - 1
+from gridmet.compression import ParallelGzipWriter
 
-    print("{}:{:d} - {}:{:d}".format(f1, c1, f2, c2))
 
+BLOCK_SIZE = 16 * 1024 * 1024
+# Integers with more digits may not fit into int64
+INTEGER = r"^\s*[+-]?\d{1,18}\s*$"
+
+
+def load_codes(path: str, column: int) -> numpy.ndarray:
+    """
+    Reads distinct codes from a column of a gzipped CSV file
+
+    :param path: Path to the file without header
+    :param column: Index of the column, starting from 0
+    :return: Sorted array of distinct codes
+    """
+
+    t0 = datetime.now()
+    name = "f{:d}".format(column)
+    source = pyarrow.CompressedInputStream(pyarrow.OSFile(path), "gzip")
+    reader = pyarrow.csv.open_csv(
+        source,
+        read_options=pyarrow.csv.ReadOptions(
+            autogenerate_column_names=True, block_size=BLOCK_SIZE
+        ),
+        convert_options=pyarrow.csv.ConvertOptions(
+            include_columns=[name], column_types={name: pyarrow.int64()}
+        )
+    )
+    parts = []
     n = 0
-    codes = set()
-    with (gzip.open(f2, "rt")) as s:
-        reader = csv.reader(s)
-        #next(reader)
-        for row in reader:
-            codes.add(int(row[c2]))
-            n += 1
-            if (n % 10000000) == 0:
-                print("{:d} codes from {:,} lines".format(len(codes), n))
+    for batch in reader:
+        parts.append(
+            numpy.unique(batch.column(0).to_numpy(zero_copy_only=False))
+        )
+        n += batch.num_rows
+        # merging keeps memory proportional to the number of codes
+        if len(parts) >= 16:
+            parts = [numpy.unique(numpy.concatenate(parts))]
+            print("{:,} codes from {:,} lines [{}]".format(
+                len(parts[0]), n, str(datetime.now() - t0)
+            ))
+    if not parts:
+        return numpy.empty(0, dtype=numpy.int64)
+    codes = numpy.unique(numpy.concatenate(parts))
+    print("Set created: {:,} codes from {:,} lines in {}".format(
+        len(codes), n, str(datetime.now() - t0)
+    ))
+    return codes
+
+
+def save_codes(codes: numpy.ndarray, path: str):
+    """
+    Writes codes into a gzipped file, one per line
+    """
+
+    with gzip.open(path, "wt") as writer:
+        for part in numpy.array_split(codes, len(codes) // 1000000 + 1):
+            if len(part) > 0:
+                lines = pc.cast(pyarrow.array(part), pyarrow.string())
+                writer.write(join_lines(lines) + "\n")
+
+
+def join_lines(lines: pyarrow.Array) -> str:
+    return pc.binary_join(pyarrow.ListArray.from_arrays(
+        pyarrow.array([0, len(lines)], pyarrow.int32()), lines
+    ), "\n")[0].as_py()
+
+
+def contains(codes: numpy.ndarray, values: numpy.ndarray) -> numpy.ndarray:
+    """
+    :param codes: Sorted array of codes
+    :param values: Values to look up
+    :return: Boolean array, True for values found among the codes
+    """
+
+    if len(codes) == 0:
+        return numpy.zeros(len(values), dtype=bool)
+    idx = numpy.searchsorted(codes, values)
+    idx[idx == len(codes)] = 0
+    return codes[idx] == values
 
+
+def filter_block(text: str, codes: numpy.ndarray,
+                 column: int) -> Tuple[str, int, int]:
+    """
+    Removes lines with excluded codes from a block of lines
+
+    :param text: Lines, every line except the last line of the file
+        ends with a line break
+    :param codes: Sorted array of excluded codes
+    :param column: Index of the column with codes, starting from 0
+    :return: Remaining lines, the number of lines in the block and
+        the number of remaining lines
+    """
+
+    terminated = text.endswith("\n")
+    if terminated:
+        text = text[:-1]
+    lines = pc.split_pattern(pyarrow.array([text]), "\n").flatten()
+    fields = pc.extract_regex(
+        lines, r"^(?:[^,]*,){" + str(column) + r"}(?P<code>[^,]*)"
+    ).field("code")
+    integer = pc.fill_null(pc.match_substring_regex(fields, INTEGER), False)
+    values = pc.utf8_trim_whitespace(pc.if_else(integer, fields, "0"))
+    values = pc.cast(pc.utf8_ltrim(values, "+"), pyarrow.int64())\
+        .to_numpy(zero_copy_only=False)
+    exclude = numpy.asarray(integer) & contains(codes, values)
+    keep = pyarrow.array(~exclude)
+    remaining = lines.filter(keep)
+    m = len(remaining)
+    if m == 0:
+        return "", len(lines), 0
+    result = join_lines(remaining)
+    if terminated or exclude[-1]:
+        result += "\n"
+    return result, len(lines), m
+
+
+def read_blocks(stream, block_size: int = BLOCK_SIZE) -> Iterator[str]:
+    """
+    Reads blocks of complete lines in a background thread
+
+    :param stream: Text stream
+    :param block_size: Approximate number of characters in a block
+    :return: Iterator over blocks
+    """
+
+    blocks = queue.Queue(maxsize=2)
+
+    def read():
+        try:
+            tail = ""
+            while True:
+                data = stream.read(block_size)
+                if not data:
+                    break
+                data = tail + data
+                end = data.rfind("\n") + 1
+                tail = data[end:]
+                if end > 0:
+                    blocks.put(data[:end])
+            if tail:
+                blocks.put(tail)
+            blocks.put(None)
+        except BaseException as x:
+            blocks.put(x)
+
+    reader = threading.Thread(target=read, name="csv-reader", daemon=True)
+    reader.start()
+    while True:
+        block = blocks.get()
+        if block is None:
+            break
+        if isinstance(block, BaseException):
+            raise block
+        yield block
+    reader.join()
+
+
+def exclude(f1: str, c1: int, f2: str, c2: int, threads: int = 4):
+    """
+    Writes lines of f1, whose codes are not found in f2, into `__<f1>`
+
+    :param f1: Gzipped CSV file with header to filter
+    :param c1: Index of the column of f1, starting from 0
+    :param f2: Gzipped CSV file without header with excluded codes
+    :param c2: Index of the column of f2, starting from 0
+    :param threads: Number of threads compressing the result
+    """
+
+    print("{}:{:d} - {}:{:d}".format(f1, c1, f2, c2))
+    codes = load_codes(f2, c2)
     f4 = os.path.join(os.path.dirname(f2), "codes_" + os.path.basename(f2))
-    with (gzip.open(f4, "wt")) as writer:
-        writer.writelines([str(code) for code in codes])
+    save_codes(codes, f4)
 
-    print("Set created: {:d} codes from {:,} lines".format(len(codes), n))
+    t0 = datetime.now()
     n = 0
     m = 0
     f3 = os.path.join(os.path.dirname(f1), "__" + os.path.basename(f1))
-    with (gzip.open(f1, "rt")) as reader, (gzip.open(f3, "wt")) as writer:
-        writer.write(next(reader))
-        for line in reader:
-            n += 1
-            data = line.split(',')
-            try:
-                code = int(data[c1])
-            except Exception as x:
-                print(x)
-                code = data[c1]
-            if code not in codes:
-                writer.write(line)
-                m += 1
-            if (n % 100000) == 0:
-                print("{:d} / {:d}".format(n, m))
-    print("All done: {:d} / {:d}".format(n, m))
\ No newline at end of file
+    with gzip.open(f1, "rt") as reader, io.TextIOWrapper(
+            ParallelGzipWriter(f3, "wb", threads=threads)) as writer:
+        writer.write(reader.readline())
+        for block in read_blocks(reader):
+            text, lines, remaining = filter_block(block, codes, c1)
+            writer.write(text)
+            n += lines
+            m += remaining
+            t = (datetime.now() - t0).total_seconds()
+            print("{:,} / {:,} \t{:,.0f} lines/s [{}]".format(
+                n, m, n / t if t > 0 else 0, str(datetime.now() - t0)
+            ))
+    print("All done: {:d} / {:d} in {}".format(n, m,
+                                               str(datetime.now() - t0)))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(
+        description="Removes lines of f1 with codes found in f2"
+    )
+    ap.add_argument("f1", help="Gzipped CSV file to filter")
+    ap.add_argument("c1", type=int, help="Column of f1, starting from 1")
+    ap.add_argument("f2", help="Gzipped CSV file with codes to exclude")
+    ap.add_argument("c2", type=int, help="Column of f2, starting from 1")
+    ap.add_argument("--threads", type=int, default=4,
+                    help="Number of threads compressing the result")
+    args = ap.parse_args()
+    exclude(args.f1, args.c1 - 1, args.f2, args.c2 - 1, args.threads)